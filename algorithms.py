@@ -1,29 +1,171 @@
-import nibabel as nb
-import numpy as np
-from nipype.algorithms.confounds import TSNR
+from collections import OrderedDict
+from volumes import VOLUMES
+from profiling import hot_path
 
 
-def calc_tsnr(fname, in_file, epi_mask):
+# numpy and nibabel are imported by the functions that use them, so that importing this module (and the entry points)
+# stays fast.
 
-    tsnr = TSNR()
-    tsnr.inputs.in_file = in_file
-    tsnr.inputs.tsnr_file = "{}.nii.gz".format(fname)
-    tsnr.inputs.mean_file = "{}_mean.nii.gz".format(fname)
-    tsnr.inputs.stddev_file = "{}_stddev.nii.gz".format(fname)
-    tsnr.run()
+# dtypes used by the metric code: voxel data is computed in "voxel" and masks are boolean. Sums over many voxels or
+# time points accumulate in "reduce", only in the reduction itself, so no 4D array is ever held in that precision.
+DTYPE_POLICY = {
+    "voxel": "float32",
+    "mask": "bool",
+    "reduce": "float64"
+}
 
-    # FROM MRIQC
-    # Get EPI data (with mc done) and get it ready
-    msknii = nb.load(epi_mask)
-    mskdata = np.nan_to_num(msknii.get_data())
-    mskdata = mskdata.astype(np.uint8)
-    mskdata[mskdata < 0] = 0
-    mskdata[mskdata > 0] = 1
 
-    tsnr_data = nb.load("{}.nii.gz".format(fname)).get_data()
-    tsnr_val = float(np.median(tsnr_data[mskdata > 0]))
+def set_dtype_policy(voxel=None, reduce=None):
 
-    return tsnr_val
+    if voxel:
+        DTYPE_POLICY["voxel"] = voxel
+    if reduce:
+        DTYPE_POLICY["reduce"] = reduce
+
+
+def _dtype(kind):
+    import numpy as np
+    return np.dtype(DTYPE_POLICY[kind]).type
+
+
+def load_voxels(fpath, store=VOLUMES):
+
+    import numpy as np
+
+    # Read-only voxel data in the policy dtype, with the non-finite values of float images zeroed
+    img, data = store.load(fpath, _dtype("voxel"))
+
+    if img.get_data_dtype().kind == "f" and not np.isfinite(data).all():
+        data = np.nan_to_num(data)
+
+    return img, data
+
+
+def load_mask(fpath, store=VOLUMES):
+
+    # Voxels with a positive value, NaNs excluded
+    return (store.get(fpath) > 0).astype(_dtype("mask"), copy=False)
+
+
+# Voxels further than this many standard deviations from their trend are outliers (as 3dToutcount, with the
+# standard deviation in place of the MAD)
+OUTLIER_Z = 3.5
+
+# Phase encoding axis of the EPI runs, along which the N/2 ghost is shifted
+GHOST_AXIS = 1
+
+
+def _gsr(mean_data, mask, reduce):
+
+    import numpy as np
+
+    # Ghost to signal ratio (as MRIQC): mean of the N/2 ghost of the mask outside of it, minus the mean of the
+    # remaining background, relative to the mean signal
+    ghost = np.roll(mask, mask.shape[GHOST_AXIS] // 2, axis=GHOST_AXIS) & ~mask
+    background = ~(mask | ghost)
+
+    if not ghost.any() or not background.any() or not mask.any():
+        return None
+
+    signal = mean_data[mask].mean(dtype=reduce)
+
+    return float((mean_data[ghost].mean(dtype=reduce) - mean_data[background].mean(dtype=reduce)) / signal)
+
+
+def calc_epi_metrics(fname, in_file, epi_mask, store=VOLUMES):
+
+    import numpy as np
+    import nibabel as nb
+
+    # Single pass over the registered run: linear detrending (as 3dDetrend -polort 1 with the mean added back), the
+    # tSNR, mean and stddev maps (as nipype's TSNR, written next to fname), the global signal drift, DVARS, the
+    # per-volume outlier fraction and the ghost to signal ratio. The per-volume series are saved to {fname}_qc.tsv.
+    img, data = load_voxels(in_file, store)
+    mask = load_mask(epi_mask, store)
+
+    voxel, reduce = _dtype("voxel"), _dtype("reduce")
+    n_tr = data.shape[3]
+
+    trend = np.arange(n_tr, dtype=reduce) - (n_tr - 1) / 2.0
+    trend_ss = float(np.dot(trend, trend)) or 1.0
+
+    mean_data = (data.sum(axis=3, dtype=reduce) / n_tr).astype(voxel)
+
+    # The only 4D temporary: the run minus its mean and linear trend, detrended one volume at a time
+    residuals = data - mean_data[..., np.newaxis]
+    # The reductions accumulate in reduce, the operands are cast on the fly (buffered), not copied
+    slope = (np.einsum("...t,t->...", residuals, trend, dtype=reduce) / trend_ss).astype(voxel)
+
+    for t in range(n_tr):
+        residuals[..., t] -= slope * voxel(trend[t])
+
+    stddev_data = np.sqrt(np.einsum("...t,...t->...", residuals, residuals, dtype=reduce) / n_tr).astype(voxel)
+
+    tsnr_data = np.zeros_like(mean_data)
+    stddev_nonzero = stddev_data > 1.e-3
+    np.divide(mean_data, stddev_data, out=tsnr_data, where=stddev_nonzero)
+
+    header = img.header.copy()
+    header.set_data_dtype(voxel)
+
+    for out_data, out_fname in ((tsnr_data, "{}.nii.gz".format(fname)),
+                                (mean_data, "{}_mean.nii.gz".format(fname)),
+                                (stddev_data, "{}_stddev.nii.gz".format(fname))):
+        nb.save(nb.Nifti1Image(out_data, img.affine, header), out_fname)
+
+    metrics = OrderedDict([
+        ("tsnr_val", float(np.median(tsnr_data[mask])) if mask.any() else None),
+        ("gs_drift", None),
+        ("mean_dvars", None),
+        ("max_dvars", None),
+        ("mean_outlier_frac", None),
+        ("max_outlier_frac", None),
+        ("gsr", _gsr(mean_data, mask, reduce))
+    ])
+
+    if not mask.any():
+        return metrics
+
+    # Global signal of the registered run, from the masked means of the three components
+    mask_mean = mean_data[mask].mean(dtype=reduce)
+    mask_slope = slope[mask].mean(dtype=reduce)
+    global_signal = mask_mean + mask_slope * trend
+
+    outlier_threshold = voxel(OUTLIER_Z) * stddev_data[mask]
+    outlier_frac = np.zeros(n_tr, dtype=reduce)
+    dvars = np.zeros(n_tr, dtype=reduce)
+    previous = None
+
+    for t in range(n_tr):
+
+        volume = residuals[..., t][mask]
+        global_signal[t] += volume.sum(dtype=reduce) / volume.size
+        outlier_frac[t] = np.count_nonzero(np.abs(volume) > outlier_threshold) / float(volume.size)
+
+        if previous is not None:
+            previous -= volume
+            dvars[t] = np.sqrt(np.square(previous, out=previous).sum(dtype=reduce) / previous.size)
+
+        previous = volume
+
+    del residuals
+
+    # Drift of the global signal over the run, in percent of its mean
+    metrics["gs_drift"] = float(100.0 * mask_slope * (n_tr - 1) / mask_mean) if mask_mean else None
+    metrics["mean_dvars"] = float(dvars[1:].mean()) if n_tr > 1 else None
+    metrics["max_dvars"] = float(dvars.max())
+    metrics["mean_outlier_frac"] = float(outlier_frac.mean())
+    metrics["max_outlier_frac"] = float(outlier_frac.max())
+
+    np.savetxt("{}_qc.tsv".format(fname), np.column_stack([global_signal, dvars, outlier_frac]), fmt="%.6f",
+               delimiter="\t", header="global_signal\tdvars\toutlier_fraction", comments="")
+
+    return metrics
+
+
+@hot_path("calc_tsnr")
+def calc_tsnr(fname, in_file, epi_mask, store=VOLUMES):
+    return calc_epi_metrics(fname, in_file, epi_mask, store)["tsnr_val"]
 
 
 def parse_fwhm(in_file):
@@ -39,6 +181,7 @@ def parse_fwhm(in_file):
 
 
 # Got this from MRIQC
+@hot_path("fd_jenkinson")
 def fd_jenkinson(in_file, rmax=80., out_file=None):
     """
     Compute the :abbr:`FD (framewise displacement)` [Jenkinson2002]_
@@ -90,7 +233,7 @@ def fd_jenkinson(in_file, rmax=80., out_file=None):
             b = M[0:3, 3]
 
             FD_J = math.sqrt(
-                (rmax * rmax / 5) * np.trace(np.dot(A.T, A)) + np.dot(b.T, b))
+                (rmax * rmax / 5) * np.trace(np.dot(A.T, A)) + np.dot(b.T, b).item())
             X.append(FD_J)
 
         T_rb_prev = T_rb
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import random
+import shutil
+
+
+# Stand-in for the AFNI programs and dcm2niix used by the workflows. The harness (orchestration.py) puts symlinks named
+# after each tool on PATH; the tool is picked from the name the script is called as. Each tool sleeps and allocates
+# memory as configured in the JSON profile named by FAKE_TOOLS_PROFILE, then writes outputs with the shapes the
+# workflow expects.
+
+TOOLS = ["3dDespike", "3dTshift", "3dvolreg", "3dFWHMx", "3dAutomask", "3dTstat", "3dDetrend", "3dcalc", "dcm2niix",
+         "Dimon"]
+
+# Used for tools missing from the profile. sleep is in seconds, sleep_per_mb in seconds per MB of the (first) input
+# image, alloc_mb is held while sleeping, fail_rate is the probability of exiting with an error and hang_rate the
+# probability of never finishing (until killed).
+DEFAULT_PROFILE = {"sleep": 0.05, "sleep_per_mb": 0.0, "alloc_mb": 10, "fail_rate": 0.0, "hang_rate": 0.0}
+
+
+def _profile(tool):
+
+    profile = dict(DEFAULT_PROFILE)
+
+    fpath = os.environ.get("FAKE_TOOLS_PROFILE")
+
+    if fpath:
+        with open(fpath, "r") as infile:
+            config = json.load(infile)
+        profile.update(config.get("default", {}))
+        profile.update(config.get(tool, {}))
+
+    return profile
+
+
+def _opt(args, flag, default=None):
+    if flag in args and args.index(flag) + 1 < len(args):
+        return args[args.index(flag) + 1]
+    return default
+
+
+def _inputs(args):
+    return [a for a in args if ".nii" in a and os.path.isfile(a)]
+
+
+def _nifti(fpath):
+    import nibabel as nb
+    return nb.load(fpath)
+
+
+def _save(data, like, fpath):
+    import nibabel as nb
+    nb.save(nb.Nifti1Image(data, like.affine, like.header), fpath)
+
+
+def _first_volume(img):
+    import numpy as np
+    data = np.asanyarray(img.dataobj[..., 0] if len(img.shape) > 3 else img.dataobj)
+    return data
+
+
+def _n_tr(fpath):
+    img = _nifti(fpath)
+    return img.shape[3] if len(img.shape) > 3 else 1
+
+
+def _simulate(profile, in_fpath):
+
+    ballast = None
+
+    if profile.get("alloc_mb"):
+        # Touch every page so the allocation is resident
+        ballast = bytearray(int(profile["alloc_mb"] * 1024 * 1024))
+        for i in range(0, len(ballast), 4096):
+            ballast[i] = 1
+
+    duration = profile.get("sleep", 0.0)
+
+    if in_fpath and profile.get("sleep_per_mb"):
+        duration += profile["sleep_per_mb"] * os.path.getsize(in_fpath) / (1024.0 * 1024.0)
+
+    if random.random() < profile.get("hang_rate", 0.0):
+        while True:
+            time.sleep(3600)
+
+    time.sleep(duration)
+
+    del ballast
+
+    if random.random() < profile.get("fail_rate", 0.0):
+        sys.stdout.write("** FATAL ERROR: simulated failure\n")
+        sys.exit(1)
+
+
+def _write_1d(fpath, rows, cols, header=None):
+    with open(fpath, "w") as outfile:
+        if header:
+            outfile.write(header)
+        for r in range(rows):
+            outfile.write(" ".join("0.0" if (c % 4 != c // 4 or cols != 12) else "1.0" for c in range(cols)) + "\n")
+
+
+def main(tool, args):
+
+    inputs = _inputs(args)
+    in_fpath = inputs[-1] if inputs else None
+
+    _simulate(_profile(tool), in_fpath)
+
+    prefix = _opt(args, "-prefix")
+
+    if tool in ("3dDespike", "3dTshift", "3dDetrend"):
+        shutil.copyfile(in_fpath, prefix)
+
+    elif tool == "3dvolreg":
+        shutil.copyfile(in_fpath, prefix)
+
+        n_tr = _n_tr(in_fpath)
+
+        if _opt(args, "-1Dfile"):
+            _write_1d(_opt(args, "-1Dfile"), n_tr, 6)
+        if _opt(args, "-maxdisp1D"):
+            _write_1d(_opt(args, "-maxdisp1D"), n_tr, 1)
+        if _opt(args, "-1Dmatrix_save"):
+            _write_1d(_opt(args, "-1Dmatrix_save"), n_tr, 12,
+                      header="# 3dvolreg matrices (DICOM-to-DICOM, row-by-row):\n")
+
+    elif tool == "3dFWHMx":
+        sys.stdout.write("++ 3dFWHMx: AFNI version=fake\n")
+        sys.stdout.write(" 2.50000  2.60000  2.40000     2.49800\n")
+
+    elif tool in ("3dAutomask", "3dTstat"):
+        img = _nifti(in_fpath)
+        data = _first_volume(img)
+        if tool == "3dAutomask":
+            data = (data > data.mean()).astype("uint8")
+        _save(data, img, prefix)
+
+    elif tool == "3dcalc":
+        # 4D output whenever any of the inputs is 4D (detrend + mean), otherwise the first input
+        four_d = [f for f in inputs if _n_tr(f) > 1]
+        shutil.copyfile(four_d[0] if four_d else inputs[0], prefix)
+
+    elif tool == "dcm2niix":
+        dcm_dir = args[-1]
+        out_dir = _opt(args, "-o", dcm_dir)
+        out_fname = os.path.join(out_dir, _opt(args, "-f", "out"))
+        template = os.environ.get("FAKE_TOOLS_NIFTI")
+
+        if template:
+            shutil.copyfile(template, out_fname + ".nii.gz")
+        else:
+            open(out_fname + ".nii.gz", "w").close()
+
+        if _opt(args, "-b") == "y":
+            with open(out_fname + ".json", "w") as sidecar:
+                json.dump({"ConversionSoftware": "fake dcm2niix"}, sidecar)
+
+        n_files = len([f for f in os.listdir(dcm_dir) if ".dcm" in f])
+
+        sys.stdout.write("Chris Rorden's dcm2niiX version fake\n")
+        sys.stdout.write("Convert {} DICOM as {} (64x64x32x{})\n".format(n_files, out_fname, n_files))
+
+    elif tool == "Dimon":
+        out_fname = _opt(args, "-gert_to3d_prefix")
+        template = os.environ.get("FAKE_TOOLS_NIFTI")
+
+        if template:
+            shutil.copyfile(template, out_fname)
+        else:
+            open(out_fname, "w").close()
+
+        sys.stdout.write("Dimon: fake conversion done\n")
+
+    else:
+        sys.stderr.write("fake_tools: unknown tool {}\n".format(tool))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(os.path.basename(sys.argv[0]), sys.argv[1:])
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Checks that the entry points start fast: "<script> --help" must not import any of the heavy dependencies (they are
+# imported when first used) and must finish within the time budget. Exits with an error otherwise, so it can run in CI.
+
+ENTRY_POINTS = ["run_analysis.py", "gen_bids.py", "recover_mapping.py", "results_db.py", "cluster.py"]
+
+HEAVY_MODULES = ["numpy", "nibabel", "dicom", "pydicom", "nipype", "scipy", "pyarrow"]
+
+
+def imported_modules(importtime_output):
+
+    # Top-level packages listed by python -X importtime ("import time: self | cumulative | module")
+    modules = set()
+
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            modules.add(name.split(".")[0])
+
+    return modules
+
+
+def check_entry_point(script, budget, repeats):
+
+    cmd = [sys.executable, "-X", "importtime", os.path.join(REPO_DIR, script), "--help"]
+
+    times = []
+    output = ""
+
+    for _ in range(repeats):
+        start = time.time()
+        proc = subprocess.Popen(cmd, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        _, output = proc.communicate()
+        times.append(time.time() - start)
+
+        if proc.returncode:
+            return min(times), ["exited with code {}".format(proc.returncode)]
+
+    errors = []
+
+    heavy = sorted(set(HEAVY_MODULES) & imported_modules(output))
+    if heavy:
+        errors.append("imports {}".format(", ".join(heavy)))
+
+    # Best of the repeats, to leave out the noise of a busy machine
+    if min(times) > budget:
+        errors.append("took {:.3f}s, budget is {:.3f}s".format(min(times), budget))
+
+    return min(times), errors
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check that the entry points start without importing the heavy "
+                                                 "dependencies and within a time budget.")
+
+    parser.add_argument(
+        "--budget",
+        help="maximum seconds for '<entry point> --help' (default: 0.3)",
+        default=0.3,
+        type=float
+    )
+
+    parser.add_argument(
+        "--repeats",
+        help="number of runs per entry point, the fastest one is checked",
+        default=3,
+        type=int
+    )
+
+    settings = parser.parse_args()
+
+    failed = False
+
+    for script in ENTRY_POINTS:
+
+        best, errors = check_entry_point(script, settings.budget, settings.repeats)
+
+        print("{:<20} {:.3f}s {}".format(script, best, "; ".join(errors) if errors else "OK"))
+
+        failed = failed or bool(errors)
+
+    if failed:
+        sys.exit(1)
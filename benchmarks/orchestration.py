@@ -0,0 +1,499 @@
+import os
+import sys
+import json
+import shlex
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from glob import glob
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+import synthetic
+from fake_tools import TOOLS, DEFAULT_PROFILE
+
+
+# Measures the orchestration overhead of the workflows and of the two entry points with the AFNI programs and dcm2niix
+# replaced by the stand-ins in fake_tools.py, so that thousands of images can be pushed through on a laptop.
+
+# Tools called by the workflows, in order, used to compute the ideal (tool time only) duration of one item
+FUNC_STEPS = ["3dDespike", "3dTshift", "3dFWHMx", "3dvolreg", "3dFWHMx", "3dAutomask"]
+CONVERT_STEPS = ["dcm2niix"]
+
+SMALL_BOLD = ((8, 8, 4), 20)
+SMALL_T1W = (16, 16, 8)
+
+
+def install_fake_tools(bin_dir):
+
+    # Symlinks named after each tool, pointing to fake_tools.py
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+
+    script = os.path.join(BENCH_DIR, "fake_tools.py")
+    os.chmod(script, 0o755)
+
+    for tool in TOOLS:
+        link = os.path.join(bin_dir, tool)
+        if not os.path.lexists(link):
+            os.symlink(script, link)
+
+    return bin_dir
+
+
+def fake_env(bin_dir, profile_fpath, nifti_template=None):
+
+    env = os.environ.copy()
+    env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+    env["FAKE_TOOLS_PROFILE"] = profile_fpath
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+
+    if nifti_template:
+        env["FAKE_TOOLS_NIFTI"] = nifti_template
+
+    return env
+
+
+def tool_time(profile, steps):
+
+    total = 0.0
+
+    for tool in steps:
+        tool_profile = dict(DEFAULT_PROFILE)
+        tool_profile.update(profile.get("default", {}))
+        tool_profile.update(profile.get(tool, {}))
+        total += tool_profile["sleep"]
+
+    return total
+
+
+def stand_in_startup(bin_dir, env, repeats=5):
+
+    # Wall time of one stand-in call that does nothing, to separate the cost of the stand-ins themselves from the
+    # overhead of the code under test
+    zero_env = dict(env)
+    zero_profile = os.path.join(bin_dir, "zero_profile.json")
+
+    with open(zero_profile, "w") as outfile:
+        json.dump({"default": {"sleep": 0.0, "alloc_mb": 0}}, outfile)
+
+    zero_env["FAKE_TOOLS_PROFILE"] = zero_profile
+
+    start = time.time()
+    for _ in range(repeats):
+        subprocess.check_output([os.path.join(bin_dir, "3dFWHMx")], env=zero_env)
+
+    return (time.time() - start) / repeats
+
+
+def make_bids_func(bids_dir, n_images, work_dir):
+
+    template = synthetic.make_bold(os.path.join(work_dir, "template_bold.nii.gz"), shape=SMALL_BOLD[0],
+                                   n_tr=SMALL_BOLD[1])
+
+    images = []
+
+    for i in range(n_images):
+        sub = "sub-{:04d}".format(i // 4 + 1)
+        ses = "ses-{:04d}".format(i % 4 + 1)
+        func_dir = os.path.join(bids_dir, sub, ses, "func")
+        if not os.path.isdir(func_dir):
+            os.makedirs(func_dir)
+        img = os.path.join(func_dir, "{}_{}_task-fmri_run-0001_bold.nii.gz".format(sub, ses))
+        shutil.copyfile(template, img)
+        images.append(img)
+
+    return images
+
+
+def make_bids_anat(bids_dir, n_sessions, work_dir, runs=3):
+
+    import nibabel as nb
+    import numpy as np
+
+    template = os.path.join(work_dir, "template_T1w.nii.gz")
+    nb.save(nb.Nifti1Image(np.ones(SMALL_T1W, dtype=np.int16), np.eye(4)), template)
+
+    sessions = []
+
+    for i in range(n_sessions):
+        sub = "sub-{:04d}".format(i + 1)
+        anat_dir = os.path.join(bids_dir, sub, "ses-0001", "anat")
+        os.makedirs(anat_dir)
+        for r in range(runs):
+            shutil.copyfile(template, os.path.join(anat_dir, "{}_ses-0001_run-{:02d}_T1w.nii.gz".format(sub, r + 1)))
+        sessions.append(anat_dir)
+
+    return sessions
+
+
+def make_oxygen(oxygen_dir, n_series, series_per_session=4):
+
+    series = []
+
+    for i in range(n_series):
+        scan_dir = os.path.join(oxygen_dir, "Doe_John-{:05d}".format(i // series_per_session),
+                                "2016-01-01-{:05d}".format(i // series_per_session),
+                                "mr_{:04d}".format(i % series_per_session + 1))
+        os.makedirs(scan_dir)
+        with open(os.path.join(scan_dir, "000001.dcm"), "w") as dcm:
+            dcm.write("fake dicom {}".format(i))
+        series.append(scan_dir)
+
+    return series
+
+
+class ProcessSampler(threading.Thread):
+
+    # Samples the thread count and resident memory of a process (and keeps the peaks) from /proc
+
+    def __init__(self, pid, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = 0.0
+        self.running = True
+
+    def run(self):
+        status = "/proc/{}/status".format(self.pid)
+        while self.running:
+            try:
+                with open(status, "r") as infile:
+                    for line in infile:
+                        if line.startswith("Threads:"):
+                            self.peak_threads = max(self.peak_threads, int(line.split()[1]))
+                        elif line.startswith("VmRSS:"):
+                            self.peak_rss_mb = max(self.peak_rss_mb, int(line.split()[1]) / 1024.0)
+            except (IOError, OSError):
+                pass
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+
+
+def run_cli(cmd, env, n_items, per_item, nthreads):
+
+    start = time.time()
+
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+
+    sampler = ProcessSampler(proc.pid)
+    sampler.start()
+
+    output, _ = proc.communicate()
+
+    sampler.stop()
+
+    makespan = time.time() - start
+
+    # Best case: all the tool time perfectly spread over the workers
+    ideal = per_item * n_items / max(nthreads, 1)
+
+    return {
+        "returncode": proc.returncode,
+        "makespan": makespan,
+        "items": n_items,
+        "items_per_min": 60.0 * n_items / makespan if makespan else None,
+        "ideal_makespan": ideal,
+        "efficiency": ideal / makespan if makespan else None,
+        "peak_threads": sampler.peak_threads,
+        "peak_rss_mb": sampler.peak_rss_mb,
+        "output_tail": output[-2000:] if proc.returncode else "",
+    }
+
+
+def bench_run_analysis(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    bids_dir = os.path.join(work_dir, "bids")
+    make_bids_func(bids_dir, n_images, work_dir)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "run_analysis.py"), bids_dir, os.path.join(work_dir, "results"),
+           "--log_dir", os.path.join(work_dir, "logs"), "--nthreads", str(nthreads)] + list(cli_args)
+
+    return run_cli(cmd, env, n_images, tool_time(profile, FUNC_STEPS), nthreads)
+
+
+def bench_run_analysis_incremental(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    # A weekly QC run: a full analysis of n_images, then 10% new images arrive and one is reconverted, and only the
+    # incremental run is measured
+    bids_dir = os.path.join(work_dir, "bids")
+    make_bids_func(bids_dir, n_images, work_dir)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "run_analysis.py"), bids_dir, os.path.join(work_dir, "results"),
+           "--log_dir", os.path.join(work_dir, "logs"), "--nthreads", str(nthreads)] + list(cli_args)
+
+    subprocess.check_output(cmd, env=env, stderr=subprocess.STDOUT)
+
+    n_new = max(n_images // 10, 1)
+    new_images = make_bids_func(os.path.join(work_dir, "bids_new"), n_images + n_new, work_dir)
+
+    for img in new_images[n_images:]:
+        dest = os.path.join(bids_dir, os.path.relpath(img, os.path.join(work_dir, "bids_new")))
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(img, dest)
+
+    os.utime(glob(os.path.join(bids_dir, "*", "*", "func", "*.nii.gz"))[0])
+
+    return run_cli(cmd + ["--incremental"], env, n_new + 1, tool_time(profile, FUNC_STEPS), nthreads)
+
+
+def bench_cluster_local(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    # The sharded func analysis with the local launcher: 4 shards of nthreads // 4 threads each, then the merge
+    bids_dir = os.path.join(work_dir, "bids")
+    make_bids_func(bids_dir, n_images, work_dir)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "cluster.py"), "local", os.path.join(work_dir, "results"),
+           "--bids_dir", bids_dir, "--n_shards", "4", "--cpus", str(max(nthreads // 4, 1)), "--max_parallel", "4",
+           "--run_args", " ".join(shlex.quote(arg) for arg in cli_args)]
+
+    return run_cli(cmd, env, n_images, tool_time(profile, FUNC_STEPS), nthreads)
+
+
+def bench_run_analysis_anat(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    # n_images sessions of three T1w runs: two registrations and one average each
+    bids_dir = os.path.join(work_dir, "bids")
+    make_bids_anat(bids_dir, n_images, work_dir)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "run_analysis.py"), bids_dir, os.path.join(work_dir, "results"),
+           "--log_dir", os.path.join(work_dir, "logs"), "--nthreads", str(nthreads), "--workflow", "anat"] + \
+        list(cli_args)
+
+    return run_cli(cmd, env, n_images, tool_time(profile, ["3dvolreg", "3dvolreg", "3dcalc"]), nthreads)
+
+
+def bench_run_analysis_all(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    # n_images func images and n_images anat sessions in one BIDS directory, analysed by one --workflow all run. Its
+    # makespan compares with the ones of the run_analysis and run_analysis_anat targets (and their sum).
+    bids_dir = os.path.join(work_dir, "bids")
+    make_bids_func(bids_dir, n_images, work_dir)
+    make_bids_anat(bids_dir, n_images, work_dir)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "run_analysis.py"), bids_dir, os.path.join(work_dir, "results"),
+           "--log_dir", os.path.join(work_dir, "logs"), "--nthreads", str(nthreads), "--workflow", "all"] + \
+        list(cli_args)
+
+    per_item = (tool_time(profile, FUNC_STEPS) + tool_time(profile, ["3dvolreg", "3dvolreg", "3dcalc"])) / 2.0
+
+    return run_cli(cmd, env, 2 * n_images, per_item, nthreads)
+
+
+def bench_gen_bids(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    oxygen_dir = os.path.join(work_dir, "oxygen")
+    make_oxygen(oxygen_dir, n_images)
+
+    cmd = [sys.executable, os.path.join(REPO_DIR, "gen_bids.py"), os.path.join(work_dir, "bids"), oxygen_dir,
+           "--mapping_dir", os.path.join(work_dir, "mappings"), "--log_dir", os.path.join(work_dir, "logs"),
+           "--nthreads", str(nthreads)] + list(cli_args)
+
+    return run_cli(cmd, env, n_images, tool_time(profile, CONVERT_STEPS), nthreads)
+
+
+def bench_per_call(work_dir, env, profile, n_images, nthreads, cli_args=()):
+
+    # Sequential calls of the workflow functions in this process: wall time per call minus the tools' own time is
+    # the Python and process-spawning overhead of one item.
+    os.environ.update(env)
+
+    from workflows import seven_tesla_wf, anat_average_wf
+    from converters import dcm_to_nifti
+
+    # Log to a file like the entry points do, the cost of logging is part of the overhead
+    logger = logging.getLogger("orchestration_per_call")
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(os.path.join(work_dir, "per_call.log"))
+    logger.addHandler(handler)
+
+    images = make_bids_func(os.path.join(work_dir, "bids"), n_images, work_dir)
+    sessions = make_bids_anat(os.path.join(work_dir, "bids_anat"), n_images, work_dir)
+    series = make_oxygen(os.path.join(work_dir, "oxygen"), n_images)
+
+    out_dir = os.path.join(work_dir, "results")
+    out_bids = os.path.join(work_dir, "bids_out", "sub-0001", "ses-0001", "func")
+    os.makedirs(out_bids)
+
+    calls = [
+        ("seven_tesla_wf", FUNC_STEPS,
+         [lambda img=img: seven_tesla_wf(img, out_dir, logger=logger) for img in images]),
+        ("anat_average_wf", ["3dvolreg", "3dvolreg", "3dcalc"],
+         [lambda i=i, s=s: anat_average_wf(s, os.path.join(out_dir, "anat_{}".format(i)),
+                                                     logger=logger)
+          for i, s in enumerate(sessions)]),
+        ("dcm_to_nifti", CONVERT_STEPS,
+         [lambda i=i, s=s: dcm_to_nifti(s, "series_{}".format(i), out_bids, "dcm2niix", logger=logger,
+                                           bids_meta=True)
+          for i, s in enumerate(series)]),
+    ]
+
+    results = {}
+
+    for name, steps, fns in calls:
+
+        if name == "anat_average_wf":
+            for i in range(len(sessions)):
+                os.makedirs(os.path.join(out_dir, "anat_{}".format(i)))
+
+        try:
+            start = time.time()
+            for fn in fns:
+                fn()
+            wall = (time.time() - start) / len(fns)
+        except Exception as e:
+            results[name] = {"error": "{}: {}".format(type(e).__name__, e)}
+            continue
+
+        results[name] = {
+            "calls": len(fns),
+            "wall_per_call": wall,
+            "tool_time_per_call": tool_time(profile, steps),
+            "overhead_per_call": wall - tool_time(profile, steps),
+        }
+
+    logger.removeHandler(handler)
+    handler.close()
+
+    return results
+
+
+TARGETS = [
+    ("per_call", bench_per_call),
+    ("run_analysis", bench_run_analysis),
+    ("run_analysis_incremental", bench_run_analysis_incremental),
+    ("cluster_local", bench_cluster_local),
+    ("run_analysis_anat", bench_run_analysis_anat),
+    ("run_analysis_all", bench_run_analysis_all),
+    ("gen_bids", bench_gen_bids),
+]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure orchestration overhead, throughput and makespan of the "
+                                                 "workflows and entry points using stand-in AFNI and dcm2niix "
+                                                 "executables.")
+
+    parser.add_argument(
+        "--targets",
+        help="what to measure (default: all)",
+        nargs="+",
+        choices=[name for name, _ in TARGETS],
+        default=None
+    )
+
+    parser.add_argument(
+        "--n_images",
+        help="number of images (sessions for the anat workflow, series for gen_bids) per target",
+        default=1000,
+        type=int
+    )
+
+    parser.add_argument(
+        "--nthreads",
+        help="value passed to --nthreads of the entry points",
+        default=32,
+        type=int
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="JSON profile of the stand-in tools: {\"default\": {...}, \"3dvolreg\": {\"sleep\": 0.5, "
+             "\"sleep_per_mb\": 0.0, \"alloc_mb\": 50, \"fail_rate\": 0.0, \"hang_rate\": 0.0}, ...}",
+        default=None
+    )
+
+    parser.add_argument(
+        "--cli_args",
+        help="extra arguments for the entry points, e.g. \"--timeout_min 5\" with a profile that has a hang_rate",
+        default=""
+    )
+
+    parser.add_argument(
+        "--out_file",
+        help="JSON file to save the results to",
+        default=os.path.join(os.getcwd(), "orchestration_{}.json".format(
+            datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+    )
+
+    parser.add_argument(
+        "--keep",
+        help="keep the generated data and outputs",
+        action="store_true",
+        default=False
+    )
+
+    settings = parser.parse_args()
+
+    work_root = tempfile.mkdtemp(prefix="bench_orchestration_")
+
+    if settings.profile:
+        with open(settings.profile, "r") as infile:
+            profile = json.load(infile)
+    else:
+        profile = {}
+
+    profile_fpath = os.path.join(work_root, "profile.json")
+    with open(profile_fpath, "w") as outfile:
+        json.dump(profile, outfile)
+
+    bin_dir = install_fake_tools(os.path.join(work_root, "bin"))
+
+    template = synthetic.make_bold(os.path.join(work_root, "dcm2niix_template.nii.gz"), shape=SMALL_BOLD[0],
+                                   n_tr=SMALL_BOLD[1])
+    env = fake_env(bin_dir, profile_fpath, nifti_template=template)
+
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "n_images": settings.n_images,
+            "nthreads": settings.nthreads,
+            "profile": profile,
+            "stand_in_startup": stand_in_startup(bin_dir, env),
+        },
+        "results": {}
+    }
+
+    try:
+        for name, target in TARGETS:
+
+            if settings.targets and name not in settings.targets:
+                continue
+
+            work_dir = os.path.join(work_root, name)
+            os.makedirs(work_dir)
+
+            try:
+                results["results"][name] = target(work_dir, env, profile, settings.n_images, settings.nthreads,
+                                                  cli_args=shlex.split(settings.cli_args))
+            except Exception as e:
+                results["results"][name] = {"error": "{}: {}".format(type(e).__name__, e)}
+
+            print("{}: {}".format(name, json.dumps(results["results"][name], indent=4, sort_keys=True)))
+    finally:
+        if not settings.keep:
+            shutil.rmtree(work_root, ignore_errors=True)
+        else:
+            print("Generated data kept in {}".format(work_root))
+
+    with open(settings.out_file, "w") as outfile:
+        json.dump(results, outfile, indent=4, sort_keys=True)
+
+    print("Results saved to {}".format(settings.out_file))
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from runner import CommandRunner
+from prefetch import Prefetcher
+
+
+# Measures the read-ahead of the runner (prefetch.Prefetcher) on jobs that read an input file, then compute (sleep),
+# like the first step of the func workflow. The files are evicted from the page cache (posix_fadvise(DONTNEED)) before
+# each run, so every job starts on a cold file, unless it was read ahead while the previous jobs computed. On a local
+# disk the cold reads are short; the gain grows with the latency of the filesystem (e.g. NFS).
+
+
+def make_files(out_dir, n_files, size_mb):
+
+    fpaths = []
+    block = os.urandom(1024 * 1024)
+
+    for i in range(n_files):
+        fpath = os.path.join(out_dir, "sub-{:02d}_bold.nii.gz".format(i))
+        with open(fpath, "wb") as outfile:
+            for _ in range(size_mb):
+                outfile.write(block)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        fpaths.append(fpath)
+
+    return fpaths
+
+
+def evict(fpaths):
+    for fpath in fpaths:
+        fd = os.open(fpath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def read_file(fpath):
+
+    start = time.time()
+    buf = bytearray(4 * 1024 * 1024)
+
+    with open(fpath, "rb", buffering=0) as infile:
+        while infile.readinto(buf):
+            pass
+
+    return time.time() - start
+
+
+async def job(runner, fpath, compute_seconds):
+    read_seconds = await runner.in_executor(read_file, fpath)
+    await asyncio.sleep(compute_seconds)
+    return read_seconds
+
+
+def run(fpaths, slots, compute_seconds, depth, budget_mb):
+
+    evict(fpaths)
+
+    prefetcher = None
+
+    if depth:
+        prefetcher = Prefetcher(depth=depth, budget_mb=budget_mb, logger=logging.getLogger("prefetch_bench"))
+
+    runner = CommandRunner(max_procs=slots, max_jobs=slots, prefetcher=prefetcher)
+
+    start = time.time()
+    futures = [runner.submit_job(job, runner, fpath, compute_seconds, job_inputs=[fpath]) for fpath in fpaths]
+    reads = [future.result() for future in futures]
+    makespan = time.time() - start
+
+    runner.close()
+
+    return {
+        "makespan": round(makespan, 2),
+        "read_seconds": round(sum(reads), 2),
+        "max_read_seconds": round(max(reads), 3)
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Makespan of jobs reading cold input files, with and without "
+                                                 "read-ahead.")
+
+    parser.add_argument(
+        "--n_files",
+        help="number of jobs (one input file each)",
+        default=16,
+        type=int
+    )
+
+    parser.add_argument(
+        "--size_mb",
+        help="size of each input file in MB",
+        default=128,
+        type=int
+    )
+
+    parser.add_argument(
+        "--nthreads",
+        help="jobs running at once",
+        default=2,
+        type=int
+    )
+
+    parser.add_argument(
+        "--compute",
+        help="seconds each job computes after reading its input",
+        default=0.5,
+        type=float
+    )
+
+    parser.add_argument(
+        "--prefetch_mb",
+        help="read-ahead budget in MB",
+        default=1024.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--work_dir",
+        help="directory of the input files, on the filesystem to measure. Default is a temporary directory",
+        default=None
+    )
+
+    settings = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="prefetch_bench_", dir=settings.work_dir)
+
+    try:
+        fpaths = make_files(work_dir, settings.n_files, settings.size_mb)
+
+        results = {
+            "no_prefetch": run(fpaths, settings.nthreads, settings.compute, 0, 0.0),
+            "prefetch_1": run(fpaths, settings.nthreads, settings.compute, 1, settings.prefetch_mb),
+            "prefetch_4": run(fpaths, settings.nthreads, settings.compute, 4, settings.prefetch_mb)
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(json.dumps(results, indent=4))
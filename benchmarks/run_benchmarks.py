@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+# The benchmarks import the repository modules the same way the scripts do
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import synthetic
+
+
+# Input sizes per preset. bold: (matrix, no. of TRs), dicom: (no. of files, rows/cols)
+SIZES = {
+    "small": {"bold": ((32, 32, 16), 50), "dicom": (20, 64)},
+    "medium": {"bold": ((64, 64, 32), 150), "dicom": (100, 96)},
+    "large": {"bold": ((96, 96, 60), 300), "dicom": (400, 128)},
+}
+
+
+def _timed(fn, repeats, setup=None):
+
+    times = []
+
+    for _ in range(repeats):
+        args = setup() if setup else ()
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+
+    return times
+
+
+def bench_calc_tsnr(work_dir, size, repeats):
+    from algorithms import calc_tsnr
+
+    shape, n_tr = SIZES[size]["bold"]
+    in_file, mask = synthetic.make_tsnr_inputs(work_dir, shape=shape, n_tr=n_tr)
+
+    params = {"shape": list(shape), "n_tr": n_tr}
+
+    return params, _timed(lambda: calc_tsnr(os.path.join(work_dir, "bench_TSNR"), in_file, mask), repeats)
+
+
+def bench_fd_jenkinson(work_dir, size, repeats):
+    from algorithms import fd_jenkinson
+
+    n_tr = SIZES[size]["bold"][1]
+    in_file = synthetic.make_aff12(os.path.join(work_dir, "motion.aff12.1D"), n_tr=n_tr, spikes=2)
+
+    return {"n_tr": n_tr}, _timed(lambda: fd_jenkinson(in_file, out_file=os.path.join(work_dir, "fd.txt")),
+                                  repeats)
+
+
+def bench_extract_fd_results(work_dir, size, repeats):
+    from algorithms import extract_fd_results
+
+    n_tr = SIZES[size]["bold"][1]
+    in_file = synthetic.make_fd_file(os.path.join(work_dir, "fd.txt"), n_tr=n_tr)
+
+    return {"n_tr": n_tr}, _timed(lambda: extract_fd_results(in_file, cutoff=0.2), repeats)
+
+
+def bench_parse_fwhm(work_dir, size, repeats):
+    from algorithms import parse_fwhm
+
+    in_file = synthetic.make_fwhm_out(os.path.join(work_dir, "fwhm.out"))
+
+    return {}, _timed(lambda: parse_fwhm(in_file), repeats)
+
+
+def bench_filter_series(work_dir, size, repeats):
+    from utils import filter_series
+
+    n_files, matrix = SIZES[size]["dicom"]
+    scan_dir = synthetic.make_dicom_series(os.path.join(work_dir, "mr_0001"), n_files=n_files, rows=matrix,
+                                           cols=matrix)
+    filters = {"sequences": ["epfid2d1_96", "epse2d1_104"]}
+
+    return {"n_files": n_files, "matrix": matrix}, _timed(lambda: filter_series(scan_dir, filters=filters), repeats)
+
+
+def bench_get_scanner_meta(work_dir, size, repeats):
+    from utils import get_scanner_meta
+
+    n_files, matrix = SIZES[size]["dicom"]
+    scan_dir = synthetic.make_dicom_series(os.path.join(work_dir, "mr_0001"), n_files=n_files, rows=matrix,
+                                           cols=matrix)
+
+    return {"n_files": n_files}, _timed(lambda: get_scanner_meta(scan_dir), repeats)
+
+
+def bench_extract_tgz(work_dir, size, repeats):
+    from utils import extract_tgz
+
+    n_files, matrix = SIZES[size]["dicom"]
+    archive = synthetic.make_oxygen_archive(work_dir, n_series=2, n_files=n_files, rows=matrix, cols=matrix)
+    out_dir = os.path.join(work_dir, "extracted")
+
+    def setup():
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        return ()
+
+    params = {"n_series": 2, "n_files": n_files, "matrix": matrix,
+              "archive_mb": round(os.path.getsize(archive) / (1024.0 * 1024.0), 2)}
+
+    return params, _timed(lambda: extract_tgz(archive, out_dir), repeats, setup=setup)
+
+
+BENCHMARKS = [
+    ("calc_tsnr", bench_calc_tsnr),
+    ("fd_jenkinson", bench_fd_jenkinson),
+    ("extract_fd_results", bench_extract_fd_results),
+    ("parse_fwhm", bench_parse_fwhm),
+    ("filter_series", bench_filter_series),
+    ("get_scanner_meta", bench_get_scanner_meta),
+    ("extract_tgz", bench_extract_tgz),
+]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(times):
+    ordered = sorted(times)
+    return {
+        "times": times,
+        "min": ordered[0],
+        "median": ordered[len(ordered) // 2],
+        "mean": sum(ordered) / len(ordered),
+    }
+
+
+def compare(results, baseline, threshold):
+
+    # Prints the median ratio current/baseline per benchmark and size, returns the regressions
+    base = dict(((r["benchmark"], r["size"]), r) for r in baseline["results"] if "median" in r)
+
+    regressions = []
+
+    for r in results["results"]:
+
+        key = (r["benchmark"], r["size"])
+
+        if "median" not in r or key not in base:
+            continue
+
+        ratio = r["median"] / base[key]["median"] if base[key]["median"] else float("inf")
+
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+
+        print("{:<20} {:<8} {:>10.4f}s -> {:>10.4f}s  x{:.2f}{}".format(key[0], key[1], base[key]["median"],
+                                                                        r["median"], ratio, flag))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the Python parts of the QC and conversion code on synthetic "
+                                                 "data and save the results as JSON.")
+
+    parser.add_argument(
+        "--sizes",
+        help="input size presets to run",
+        nargs="+",
+        choices=sorted(SIZES.keys()),
+        default=["small", "medium"]
+    )
+
+    parser.add_argument(
+        "--benchmarks",
+        help="benchmarks to run (default: all)",
+        nargs="+",
+        choices=[name for name, _ in BENCHMARKS],
+        default=None
+    )
+
+    parser.add_argument(
+        "--repeats",
+        help="number of timed repetitions per benchmark and size",
+        default=5,
+        type=int
+    )
+
+    parser.add_argument(
+        "--out_file",
+        help="JSON file to save the results to",
+        default=os.path.join(os.getcwd(), "benchmarks_{}.json".format(datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="JSON results of a previous run to compare against",
+        default=None
+    )
+
+    parser.add_argument(
+        "--threshold",
+        help="median slowdown ratio above which a benchmark is reported as a regression",
+        default=1.2,
+        type=float
+    )
+
+    settings = parser.parse_args()
+
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": settings.repeats,
+        },
+        "results": []
+    }
+
+    for name, bench in BENCHMARKS:
+
+        if settings.benchmarks and name not in settings.benchmarks:
+            continue
+
+        for size in settings.sizes:
+
+            work_dir = tempfile.mkdtemp(prefix="bench_{}_".format(name))
+
+            try:
+                params, times = bench(work_dir, size, settings.repeats)
+                record = dict(_summary(times), benchmark=name, size=size, params=params)
+                print("{:<20} {:<8} median {:.4f}s".format(name, size, record["median"]))
+            except ImportError as e:
+                # e.g. nipype or pydicom not installed
+                record = {"benchmark": name, "size": size, "skipped": str(e)}
+                print("{:<20} {:<8} skipped ({})".format(name, size, e))
+            except Exception as e:
+                record = {"benchmark": name, "size": size, "error": "{}: {}".format(type(e).__name__, e)}
+                print("{:<20} {:<8} failed ({})".format(name, size, record["error"].split("\n")[0]))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+            results["results"].append(record)
+
+    with open(settings.out_file, "w") as outfile:
+        json.dump(results, outfile, indent=4)
+
+    print("Results saved to {}".format(settings.out_file))
+
+    if settings.compare:
+
+        with open(settings.compare, "r") as infile:
+            baseline = json.load(infile)
+
+        if compare(results, baseline, settings.threshold):
+            sys.exit(1)
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduling import BackfillPolicy
+
+
+# Simulates the admission of the func workflow of a batch of images with a heavy tail of large runs, without running
+# anything: the makespan and the peak memory of the jobs in flight for the images taken in glob (arbitrary) order or
+# longest first, with and without a memory budget. The actual durations differ from the predicted ones by --noise.
+
+
+def make_jobs(n_jobs, seed, noise, large_frac=0.05):
+
+    # Mostly short runs, and a few long high resolution ones (more voxels, more volumes): predicted seconds, MB, and
+    # actual seconds
+    rng = random.Random(seed)
+    jobs = []
+
+    for _ in range(n_jobs):
+        if rng.random() < large_frac:
+            units = rng.uniform(200.0, 600.0)
+        else:
+            units = rng.uniform(10.0, 60.0)
+        seconds = units * 5.0
+        jobs.append((seconds, 100.0 + units * 10.0, seconds * rng.uniform(1.0 - noise, 1.0 + noise)))
+
+    return jobs
+
+
+def simulate(jobs, slots, budget_mb, backfill=True):
+
+    actual = [job[2] for job in jobs]
+
+    policy = BackfillPolicy(slots, budget_mb, backfill=backfill)
+
+    for index, (seconds, mb, _) in enumerate(jobs):
+        policy.add(index, seconds, mb)
+
+    now = 0.0
+    ends = {}
+    peak_mb = 0.0
+
+    while policy.pending or ends:
+
+        for index in policy.admit(now):
+            ends[index] = now + actual[index]
+
+        peak_mb = max(peak_mb, sum(jobs[index][1] for index in ends))
+
+        now = min(ends.values())
+        for index in [index for index, end in ends.items() if end <= now]:
+            del ends[index]
+            policy.finish(index)
+
+    # Lower bound: the busiest resource (the slots, or the budget in MB seconds) fully used, or the longest job
+    bound = max(sum(actual) / slots, max(actual))
+    if budget_mb:
+        bound = max(bound, sum(seconds * mb for _, mb, seconds in jobs) / budget_mb)
+
+    return {
+        "makespan": round(now, 1),
+        "lower_bound": round(bound, 1),
+        "peak_mb": round(peak_mb, 1)
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate the admission of images in glob order and longest first, "
+                                                 "with and without a memory budget.")
+
+    parser.add_argument(
+        "--n_images",
+        help="number of images",
+        default=500,
+        type=int
+    )
+
+    parser.add_argument(
+        "--nthreads",
+        help="images analysed at once",
+        default=32,
+        type=int
+    )
+
+    parser.add_argument(
+        "--mem_budget",
+        help="memory budget in GB",
+        default=64.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--noise",
+        help="relative error of the predicted durations",
+        default=0.3,
+        type=float
+    )
+
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int
+    )
+
+    settings = parser.parse_args()
+
+    jobs = make_jobs(settings.n_images, settings.seed, settings.noise)
+    longest_first = sorted(jobs, key=lambda job: job[0], reverse=True)
+    budget_mb = settings.mem_budget * 1024.0
+
+    results = {
+        "glob_order": simulate(jobs, settings.nthreads, None),
+        "longest_first": simulate(longest_first, settings.nthreads, None),
+        "glob_order_budget": simulate(jobs, settings.nthreads, budget_mb, backfill=False),
+        "longest_first_budget": simulate(longest_first, settings.nthreads, budget_mb, backfill=False),
+        "longest_first_budget_backfill": simulate(longest_first, settings.nthreads, budget_mb),
+    }
+
+    print(json.dumps(results, indent=4))
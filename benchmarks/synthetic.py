@@ -0,0 +1,206 @@
+import os
+import tarfile
+import numpy as np
+import nibabel as nb
+
+
+# Generators of synthetic inputs for the benchmarks: BOLD runs, 3dvolreg motion matrices, 3dFWHMx output and small
+# Oxygen-like DICOM series. The data only has to look plausible to the code under test, not to a radiologist.
+
+
+def brain_mask(shape):
+
+    # Ellipsoid filling most of the field of view
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    dist = sum(((g - (n - 1) / 2.0) / (0.42 * n)) ** 2 for g, n in zip(grid, shape))
+
+    return dist <= 1.0
+
+
+def make_bold(fpath, shape=(64, 64, 32), n_tr=200, tr=2.0, motion=0.0, spikes=0, noise=0.02, seed=0,
+              mask_fpath=None):
+
+    # 4D run: a smooth "brain" with a slow drift, thermal noise, an optional sub-voxel drift along x (motion, in
+    # voxels over the run) and a number of spike volumes.
+    rng = np.random.RandomState(seed)
+
+    mask = brain_mask(shape)
+    base = np.where(mask, 1000.0, 50.0).astype(np.float32)
+    base *= 1.0 + 0.1 * np.sin(np.linspace(0, np.pi, shape[0]))[:, None, None].astype(np.float32)
+
+    data = np.empty(shape + (n_tr,), dtype=np.float32)
+
+    drift = np.linspace(0.0, 0.01, n_tr)
+    shifts = np.linspace(0.0, motion, n_tr)
+
+    for t in range(n_tr):
+        # Linear interpolation between the volume and its copy shifted by one voxel along x
+        frac = shifts[t] - np.floor(shifts[t])
+        vol = np.roll(base, int(np.floor(shifts[t])), axis=0)
+        if frac:
+            vol = (1.0 - frac) * vol + frac * np.roll(vol, 1, axis=0)
+
+        data[..., t] = vol * (1.0 + drift[t]) + rng.normal(0.0, noise * 1000.0, shape)
+
+    for t in rng.choice(n_tr, size=min(spikes, n_tr), replace=False):
+        data[..., t] *= 1.5
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    img = nb.Nifti1Image(data.astype(np.int16), affine)
+    img.header.set_zooms((2.0, 2.0, 2.0, tr))
+    img.header.set_xyzt_units(xyz="mm", t="sec")
+    nb.save(img, fpath)
+
+    if mask_fpath:
+        nb.save(nb.Nifti1Image(mask.astype(np.uint8), affine), mask_fpath)
+
+    return fpath
+
+
+def make_tsnr_inputs(out_dir, shape=(64, 64, 32), n_tr=200, seed=0):
+
+    in_file = make_bold(os.path.join(out_dir, "bold.nii.gz"), shape=shape, n_tr=n_tr, seed=seed,
+                        mask_fpath=os.path.join(out_dir, "bold_mask.nii.gz"))
+
+    return in_file, os.path.join(out_dir, "bold_mask.nii.gz")
+
+
+def make_aff12(fpath, n_tr=200, translation=0.5, rotation=0.5, spikes=0, seed=0):
+
+    # 3dvolreg -1Dmatrix_save output: one row-by-row 3x4 affine per volume. Random walk of translation (mm) and
+    # rotation (degrees) amplitudes, with optional sudden jumps.
+    rng = np.random.RandomState(seed)
+
+    trans = np.cumsum(rng.normal(0.0, translation / np.sqrt(n_tr), (n_tr, 3)), axis=0)
+    rots = np.radians(np.cumsum(rng.normal(0.0, rotation / np.sqrt(n_tr), (n_tr, 3)), axis=0))
+
+    for t in rng.choice(n_tr, size=min(spikes, n_tr), replace=False):
+        trans[t] += rng.normal(0.0, 2.0, 3)
+
+    rows = []
+
+    for (tx, ty, tz), (a, b, c) in zip(trans, rots):
+        rx = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+        ry = np.array([[np.cos(b), 0, np.sin(b)], [0, 1, 0], [-np.sin(b), 0, np.cos(b)]])
+        rz = np.array([[np.cos(c), -np.sin(c), 0], [np.sin(c), np.cos(c), 0], [0, 0, 1]])
+        rot = rz.dot(ry).dot(rx)
+        rows.append(np.hstack([rot, [[tx], [ty], [tz]]]).ravel())
+
+    with open(fpath, "w") as outfile:
+        outfile.write("# 3dvolreg matrices (DICOM-to-DICOM, row-by-row):\n")
+        np.savetxt(outfile, np.array(rows), fmt="%.6f")
+
+    return fpath
+
+
+def make_fd_file(fpath, n_tr=200, seed=0):
+
+    # fd_jenkinson output: one FD value per volume
+    rng = np.random.RandomState(seed)
+    np.savetxt(fpath, np.abs(rng.normal(0.1, 0.1, n_tr)))
+
+    return fpath
+
+
+def make_fwhm_out(fpath, seed=0):
+
+    # Captured stdout of 3dFWHMx -detrend 1 -combine: progress lines, then the x, y, z and combined FWHM
+    rng = np.random.RandomState(seed)
+    vals = rng.uniform(2.0, 4.0, 3)
+
+    with open(fpath, "w") as outfile:
+        outfile.write("++ 3dFWHMx: AFNI version=AFNI_synthetic\n")
+        outfile.write("++ Number of voxels in mask = 123456\n")
+        outfile.write(" {:.5f}  {:.5f}  {:.5f}     {:.5f}\n".format(vals[0], vals[1], vals[2],
+                                                                   float(np.prod(vals) ** (1.0 / 3))))
+
+    return fpath
+
+
+README_SERIES = """Patient Name: Doe^John
+Patient ID: 12345
+Accession Number: A12345
+Referring Physician: Dr. Who
+Allergies: None
+Series Description: {description}
+Series Number: {number}
+Sequence Name: {sequence}
+Number of Images: {n_files}
+Repetition Time: 2000
+Echo Time: 25
+"""
+
+
+def make_dicom_series(scan_dir, n_files=50, rows=64, cols=64, sequence="epfid2d1_96", series_number=1, seed=0):
+
+    # One-slice-per-file MR series with the README-Series.txt that Oxygen exports next to it
+    from pydicom.dataset import Dataset, FileDataset
+
+    rng = np.random.RandomState(seed)
+
+    if not os.path.isdir(scan_dir):
+        os.makedirs(scan_dir)
+
+    for i in range(n_files):
+
+        file_meta = Dataset()
+        file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        file_meta.MediaStorageSOPInstanceUID = "1.2.3.{}.{}".format(series_number, i + 1)
+        file_meta.TransferSyntaxUID = "1.2.840.10008.1.2.1"
+
+        fpath = os.path.join(scan_dir, "{:06d}.dcm".format(i + 1))
+
+        ds = FileDataset(fpath, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.Modality = "MR"
+        ds.Manufacturer = "SIEMENS"
+        ds.SeriesNumber = series_number
+        ds.InstanceNumber = i + 1
+        ds.SequenceName = sequence
+        ds.EchoTime = 25.0
+        ds.RepetitionTime = 2000.0
+        ds.ImageType = ["ORIGINAL", "PRIMARY", "M", "ND"]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [0, 0, 2.0 * i]
+        ds.PixelSpacing = [2.0, 2.0]
+        ds.SliceThickness = 2.0
+        ds.Rows = rows
+        ds.Columns = cols
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = rng.randint(0, 4096, (rows, cols)).astype(np.uint16).tobytes()
+
+        ds.save_as(fpath)
+
+    with open(os.path.join(scan_dir, "README-Series.txt"), "w") as readme:
+        readme.write(README_SERIES.format(description="synthetic", number=series_number, sequence=sequence,
+                                          n_files=n_files))
+
+    return scan_dir
+
+
+def make_oxygen_archive(out_dir, subject="Doe_John-12345", session="2016-01-01-12345", n_series=2, n_files=50,
+                        rows=64, cols=64):
+
+    # Oxygen-style <subject>-<session>-DICOM.tgz holding <subject>/<session>/mr_NNNN series
+    src_dir = os.path.join(out_dir, "src")
+
+    for s in range(n_series):
+        make_dicom_series(os.path.join(src_dir, subject, session, "mr_{:04d}".format(s + 1)), n_files=n_files,
+                          rows=rows, cols=cols, series_number=s + 1, seed=s)
+
+    archive = os.path.join(out_dir, "{}-{}-DICOM.tgz".format(subject, session))
+
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(os.path.join(src_dir, subject), arcname=subject)
+
+    return archive
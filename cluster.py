@@ -0,0 +1,411 @@
+import os
+import sys
+import time
+import json
+import heapq
+import shlex
+import shutil
+import argparse
+import subprocess
+from glob import glob
+from datetime import datetime
+from utils import create_path, log_output
+
+
+# Runs the func analysis as many independent jobs: the images are split into shards of about equal expected cost, each
+# shard is analysed by run_analysis.py as one task of a SLURM job array (or one local process), writing its own results
+# and logs under <output_dir>/shards, and the merge step moves the image folders of the shards into <output_dir> and
+# assembles Statistics.csv, the results database and the logs there, as an unsharded run would have.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ARRAY_SCRIPT = """#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --array=0-{last_shard}{max_parallel}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem={mem}
+#SBATCH --time={walltime}
+#SBATCH --output={shard_root}/logs/slurm_%A_%a.out
+{sbatch_extra}
+{setup}
+
+SHARD=$(printf "%03d" "$SLURM_ARRAY_TASK_ID")
+mkdir -p {shard_root}/logs/shard_$SHARD
+
+{python} {run_analysis} {bids_dir} {shard_root}/shard_$SHARD \\
+    --image_list {shard_root}/shard_$SHARD.txt \\
+    --log_dir {shard_root}/logs/shard_$SHARD \\
+    --nthreads {nthreads} {run_args}
+"""
+
+
+class ShardingError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def shard_root(output_dir):
+    return os.path.join(output_dir, "shards")
+
+
+def shard_name(index):
+    return "shard_{:03d}".format(index)
+
+
+def split_images(images, costs, n_shards):
+
+    # Longest processing time first: the most expensive remaining image goes to the shard with the least expected cost
+    n_shards = max(min(n_shards, len(images)), 1)
+
+    shards = [(0.0, index, []) for index in range(n_shards)]
+    heapq.heapify(shards)
+
+    for cost, image in sorted(zip(costs, images), reverse=True):
+        total, index, shard = heapq.heappop(shards)
+        shard.append(image)
+        heapq.heappush(shards, (total + cost, index, shard))
+
+    return [(total, shard) for total, _, shard in sorted(shards, key=lambda s: s[1])]
+
+
+def plan_shards(bids_dir, output_dir, n_shards, incremental=False):
+
+    from timeouts import func_cost
+
+    images = sorted(glob(os.path.join(bids_dir, "*", "*", "*", "*.nii*")))
+
+    if not images:
+        raise ShardingError("No images found in {}".format(bids_dir))
+
+    if incremental:
+
+        # Only the images the manifest of output_dir (written by the merge of the previous runs) lists as out of date
+        from workflows import PIPELINE_VERSION
+        from manifest import AnalysisManifest, image_fingerprint
+
+        manifest = AnalysisManifest(output_dir, PIPELINE_VERSION)
+        images = [image for image, _ in manifest.schedule(dict((image, image_fingerprint(image))
+                                                                for image in images))]
+
+        if not images:
+            raise ShardingError("All the images in {} are up to date in {}".format(bids_dir, output_dir))
+
+    root = shard_root(output_dir)
+
+    if os.path.isdir(root) and glob(os.path.join(root, "*")):
+        raise ShardingError("{} holds the shards of an earlier run. Merge them (cluster.py merge {}), which moves "
+                            "their outputs into the output directory, then remove it.".format(root, output_dir))
+
+    create_path(os.path.join(root, "logs"))
+
+    shards = split_images(images, [func_cost(image) for image in images], n_shards)
+
+    for index, (_, shard) in enumerate(shards):
+        with open(os.path.join(root, "{}.txt".format(shard_name(index))), "w") as outfile:
+            outfile.write("".join("{}\n".format(image) for image in shard))
+
+    plan = {
+        "date": datetime.now().isoformat(),
+        "bids_dir": bids_dir,
+        "n_images": len(images),
+        "shards": [{"name": shard_name(index), "n_images": len(shard), "expected_seconds": round(total, 1)}
+                   for index, (total, shard) in enumerate(shards)]
+    }
+
+    with open(os.path.join(root, "plan.json"), "w") as outfile:
+        json.dump(plan, outfile, indent=4)
+
+    return plan
+
+
+def write_array_script(bids_dir, output_dir, n_shards, cpus=8, mem="32g", walltime="24:00:00", max_parallel=None,
+                       setup="", sbatch_extra=(), run_args=(), python=sys.executable, job_name="7t_qc"):
+
+    fpath = os.path.join(shard_root(output_dir), "run_shards.sh")
+
+    with open(fpath, "w") as outfile:
+        outfile.write(ARRAY_SCRIPT.format(
+            job_name=job_name,
+            last_shard=n_shards - 1,
+            max_parallel="%{}".format(max_parallel) if max_parallel else "",
+            cpus=cpus,
+            mem=mem,
+            walltime=walltime,
+            sbatch_extra="".join("#SBATCH {}\n".format(option) for option in sbatch_extra),
+            setup=setup,
+            shard_root=shlex.quote(shard_root(output_dir)),
+            python=shlex.quote(python),
+            run_analysis=shlex.quote(os.path.join(REPO_DIR, "run_analysis.py")),
+            bids_dir=shlex.quote(bids_dir),
+            nthreads=cpus,
+            run_args=" ".join(shlex.quote(arg) for arg in run_args)))
+
+    os.chmod(fpath, 0o755)
+
+    return fpath
+
+
+def submit(script, output_dir, python=sys.executable, merge_time="1:00:00"):
+
+    # Submits the array, and the merge as a job that starts once every task of the array has ended
+    array_id = subprocess.check_output(["sbatch", "--parsable", script], universal_newlines=True).strip().split(";")[0]
+
+    merge_cmd = " ".join(shlex.quote(arg) for arg in [python, os.path.abspath(__file__), "merge", output_dir])
+
+    merge_id = subprocess.check_output(["sbatch", "--parsable", "--dependency=afterany:{}".format(array_id),
+                                        "--time={}".format(merge_time), "--job-name=7t_qc_merge",
+                                        "--output={}".format(os.path.join(shard_root(output_dir), "logs",
+                                                                          "slurm_merge_%j.out")),
+                                        "--wrap", merge_cmd], universal_newlines=True).strip().split(";")[0]
+
+    return array_id, merge_id
+
+
+def run_local(script, n_shards, max_parallel=None):
+
+    # Stand-in for SLURM: runs the array script once per shard, with SLURM_ARRAY_TASK_ID set, at most max_parallel at a
+    # time. Returns the exit codes by shard.
+    max_parallel = max_parallel or n_shards
+    pending = list(range(n_shards))
+    running = {}
+    returncodes = {}
+
+    while pending or running:
+
+        while pending and len(running) < max_parallel:
+            index = pending.pop(0)
+            env = os.environ.copy()
+            env["SLURM_ARRAY_TASK_ID"] = str(index)
+            log_fpath = os.path.join(os.path.dirname(script), "logs", "local_{}.out".format(shard_name(index)))
+            with open(log_fpath, "w") as log_file:
+                running[index] = subprocess.Popen(["bash", script], env=env, stdout=log_file,
+                                                  stderr=subprocess.STDOUT)
+
+        time.sleep(1.0)
+
+        for index, proc in list(running.items()):
+            if proc.poll() is not None:
+                returncodes[index] = proc.returncode
+                del running[index]
+
+    return [returncodes[index] for index in range(n_shards)]
+
+
+def merge_shards(output_dir):
+
+    # Assembles the results of the shards in output_dir, updating the results of earlier runs in place: the image
+    # folders are moved (replacing the ones of earlier runs), the rows merged. Images of shards that did not finish are
+    # listed as failed. Merging again only merges the rows, the folders were already moved. Returns the names of the
+    # incomplete shards.
+    from workflows import STATISTICS_COLUMNS, PIPELINE_VERSION, statistics_row, read_statistics, write_statistics
+    from manifest import AnalysisManifest
+    from results_db import ResultsDB
+
+    root = shard_root(output_dir)
+    shard_lists = sorted(glob(os.path.join(root, "shard_*.txt")))
+
+    if not shard_lists:
+        raise ShardingError("No shards found in {}".format(root))
+
+    statistics_fpath = os.path.join(output_dir, "Statistics.csv")
+    rows = read_statistics(statistics_fpath) if os.path.isfile(statistics_fpath) else {}
+
+    manifest = AnalysisManifest(output_dir, PIPELINE_VERSION)
+    incomplete = []
+
+    for shard_list in shard_lists:
+
+        name = os.path.basename(shard_list)[:-4]
+
+        with open(shard_list, "r") as infile:
+            images = [os.path.basename(line.strip()).split(".")[0] for line in infile if line.strip()]
+
+        shard_rows = {}
+        shard_statistics = os.path.join(root, name, "Statistics.csv")
+
+        if os.path.isfile(shard_statistics):
+            shard_rows = read_statistics(shard_statistics)
+            manifest.update(AnalysisManifest(os.path.join(root, name), PIPELINE_VERSION))
+
+        if any(image not in shard_rows for image in images):
+            incomplete.append(name)
+
+        for image in images:
+
+            rows[image] = shard_rows.get(image, statistics_row(None))
+
+            # Both are under output_dir, the move is a rename
+            image_dir = os.path.join(root, name, image)
+
+            if os.path.isdir(image_dir):
+                if os.path.isdir(os.path.join(output_dir, image)):
+                    shutil.rmtree(os.path.join(output_dir, image))
+                os.rename(image_dir, os.path.join(output_dir, image))
+
+    write_statistics(statistics_fpath, rows)
+    manifest.save()
+
+    results_db = ResultsDB(os.path.join(output_dir, "results.sqlite"), [key for key, _ in STATISTICS_COLUMNS])
+
+    for shard_db in sorted(glob(os.path.join(root, "shard_*", "results.sqlite"))):
+        results_db.merge(shard_db)
+
+    results_db.export(os.path.join(output_dir, "results.csv"))
+    results_db.close()
+
+    # One log (and JSON lines file) for the whole run, the shards' logs in shard order
+    log_dir = os.path.join(output_dir, "logs")
+    create_path(log_dir)
+
+    for ext in ["log", "jsonl"]:
+        with open(os.path.join(log_dir, "run_analysis_merged.{}".format(ext)), "w") as outfile:
+            for shard_log in sorted(glob(os.path.join(root, "logs", "shard_*", "run_analysis_*.{}".format(ext)))):
+                with open(shard_log, "r") as infile:
+                    for line in infile:
+                        outfile.write(line)
+
+    return incomplete
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the func analysis as shards, as a SLURM job array or as local "
+                                                 "processes, and merge the results of the shards.")
+
+    parser.add_argument(
+        "command",
+        help="split: write the shards (image lists) and the array script. sbatch: split, then submit the array and the "
+             "merge job (with --submit). local: split, run the shards as local processes, then merge. merge: assemble "
+             "the results of the shards",
+        choices=["split", "sbatch", "local", "merge"]
+    )
+
+    parser.add_argument(
+        "output_dir",
+        help="output directory of the analysis, the shards are in its shards directory"
+    )
+
+    parser.add_argument(
+        "--bids_dir",
+        help="BIDS directory with input files (not needed for merge)",
+        default=None
+    )
+
+    parser.add_argument(
+        "--n_shards",
+        help="number of shards. Default is 8",
+        default=8,
+        type=int
+    )
+
+    parser.add_argument(
+        "--cpus",
+        help="CPUs of each array task, also its --nthreads. Default is 8",
+        default=8,
+        type=int
+    )
+
+    parser.add_argument(
+        "--mem",
+        help="memory of each array task. Default is 32g",
+        default="32g"
+    )
+
+    parser.add_argument(
+        "--time",
+        help="walltime of each array task. Default is 24:00:00",
+        default="24:00:00"
+    )
+
+    parser.add_argument(
+        "--max_parallel",
+        help="maximum number of shards running at once. Default is all of them (local: number of CPU cores // --cpus)",
+        default=None,
+        type=int
+    )
+
+    parser.add_argument(
+        "--setup",
+        help="shell lines run by each task before the analysis, e.g. \"module load afni; source activate tsnr\"",
+        default=""
+    )
+
+    parser.add_argument(
+        "--sbatch_option",
+        help="additional #SBATCH option of the array script, e.g. \"--partition=norm\" (repeatable)",
+        action="append",
+        default=[]
+    )
+
+    parser.add_argument(
+        "--run_args",
+        help="additional arguments of run_analysis.py, e.g. \"--voxel_dtype float64\"",
+        default=""
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help="only shard the images that the manifest of the output directory lists as new, changed or analysed with "
+             "an older pipeline version. The shards of the previous run must be merged, and their directory removed, "
+             "first",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--submit",
+        help="submit the array and the merge job with sbatch (sbatch command only)",
+        action="store_true",
+        default=False
+    )
+
+    settings = parser.parse_args()
+
+    settings.output_dir = os.path.abspath(settings.output_dir)
+
+    if settings.command != "merge":
+
+        if not settings.bids_dir:
+            parser.error("--bids_dir is required by the {} command".format(settings.command))
+
+        settings.bids_dir = os.path.abspath(settings.bids_dir)
+
+        if settings.command == "local" and settings.max_parallel is None:
+            settings.max_parallel = max(os.cpu_count() // settings.cpus, 1)
+
+        plan = plan_shards(settings.bids_dir, settings.output_dir, settings.n_shards,
+                           incremental=settings.incremental)
+
+        script = write_array_script(settings.bids_dir, settings.output_dir, len(plan["shards"]), cpus=settings.cpus,
+                                    mem=settings.mem, walltime=settings.time, max_parallel=settings.max_parallel,
+                                    setup=settings.setup, sbatch_extra=settings.sbatch_option,
+                                    run_args=shlex.split(settings.run_args))
+
+        for shard in plan["shards"]:
+            log_output("{}: {} images, {:.0f}s expected".format(shard["name"], shard["n_images"],
+                                                                shard["expected_seconds"]))
+
+        log_output("{} images in {} shards, array script: {}".format(plan["n_images"], len(plan["shards"]), script))
+
+        if settings.command == "sbatch" and settings.submit:
+            array_id, merge_id = submit(script, settings.output_dir)
+            log_output("Submitted array job {} and merge job {}".format(array_id, merge_id))
+
+        elif settings.command == "local":
+            returncodes = run_local(script, len(plan["shards"]), max_parallel=settings.max_parallel)
+            for index, returncode in enumerate(returncodes):
+                if returncode:
+                    log_output("{} exited with code {}, see {}".format(
+                        shard_name(index), returncode, os.path.join(shard_root(settings.output_dir), "logs",
+                                                                    "local_{}.out".format(shard_name(index)))))
+
+    if settings.command in ["local", "merge"]:
+
+        incomplete = merge_shards(settings.output_dir)
+
+        log_output("Results of the shards merged into {}".format(settings.output_dir))
+
+        if incomplete:
+            log_output("Incomplete shards (their missing images are listed as failed): {}".format(
+                ", ".join(incomplete)))
+            sys.exit(1)
@@ -1,11 +1,24 @@
 import os
+import time
+import copy
+import json
 import shutil
+import tarfile
+import tempfile
 import multiprocessing
-from subprocess import CalledProcessError, check_output, STDOUT
+from subprocess import CalledProcessError
 from glob import glob
-from concurrent.futures import ThreadPoolExecutor, wait
-from utils import log_output, create_path, extract_tgz, filter_series, get_scanner_meta
-from threading import Semaphore
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import wait
+from scheduling import AdaptiveLimiter, Stage, file_size_mb
+from runner import CommandTimeout, default_runner, output_tail
+from timeouts import TIMEOUT_POLICY, step_timeout, dicom_units
+from log_pipeline import side_file
+from utils import log_output, create_path, extract_tgz, filter_series, get_scanner_meta, fingerprint_series, \
+    hash_file, hash_series, series_size_mb
+from threading import Lock, Thread
+from profiling import section
 
 
 LOG_MESSAGES = {
@@ -23,10 +36,18 @@ LOG_MESSAGES = {
         'Error running Dimon on DICOM series in {} directory.\n'
         'Command:\n{}\n'
         'Return Code:\n{}\n\n',
+    'native_converted':
+        'Converted {} to {} in-process ({} DICOM files)\n\n',
+    'native_fallback':
+        'Series in {} not handled by the in-process converter ({}), using dcm2niix.\n\n',
+    'timeout':
+        'Timeout converting the DICOM series in {} directory.\n{}\n\n',
 }
 
 
-MAX_WORKERS = multiprocessing.cpu_count() * 5
+# Conversion is CPU bound, extraction is bound by the disk: both stages get their own (adaptive) concurrency limit
+CPU_WORKERS = multiprocessing.cpu_count()
+IO_WORKERS = min(4, CPU_WORKERS)
 
 
 class NiftyConversionFailure(Exception):
@@ -39,11 +60,71 @@ class DuplicateFile(Exception):
         self.message = message
 
 
-def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids_meta=False, semaphore=None):
+def _place_outputs(work_dir, actual_fname, out_dir, out_fname):
 
-    if conversion_tool == 'dcm2niix':
+    # work_dir lives inside out_dir, so these renames are atomic. The sidecar is placed first: once the NIfTI file
+    # exists, the conversion of the series is complete.
+    json_fpath = os.path.join(work_dir, "{}.json".format(actual_fname))
+
+    if os.path.isfile(json_fpath):
+        os.rename(json_fpath, os.path.join(out_dir, "{}.json".format(out_fname)))
+
+    os.rename(os.path.join(work_dir, "{}.nii.gz".format(actual_fname)),
+              os.path.join(out_dir, "{}.nii.gz".format(out_fname)))
+
+
+def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids_meta=False):
+
+    # Converters write into a per-series working directory on the destination filesystem, the results are then
+    # renamed into place. Nothing is written to (or cleaned up from) the raw DICOM tree.
+    work_dir = tempfile.mkdtemp(prefix=".{}.".format(out_fname), dir=out_dir)
+
+    series_dir = "/".join(dcm_dir.split("/")[-3:])
+    bids_fpath = os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz")
+
+    try:
+        return series_dir, bids_fpath, _run_converter(dcm_dir, out_fname, out_dir, work_dir, conversion_tool,
+                                                      logger=logger, bids_meta=bids_meta)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _run_converter(dcm_dir, out_fname, out_dir, work_dir, conversion_tool, logger=None, bids_meta=False):
+
+    if conversion_tool == 'native':
+
+        # In-process conversion for plain series, anything it does not handle goes through dcm2niix
+        from dicom_native import native_dcm_to_nifti, UnsupportedSeries
+
+        try:
+
+            num_files = native_dcm_to_nifti(dcm_dir, out_fname, work_dir, bids_meta=bids_meta)
+
+            _place_outputs(work_dir, out_fname, out_dir, out_fname)
+
+            log_output(LOG_MESSAGES['native_converted'].format(dcm_dir, out_fname, num_files), logger=logger)
+
+            return True
+
+        except UnsupportedSeries as e:
+
+            log_output(LOG_MESSAGES['native_fallback'].format(dcm_dir, e.message), level="DEBUG", logger=logger)
+
+            conversion_tool = 'dcm2niix'
+
+        except Exception as e:
+
+            # An unexpected error on an unusual series (CSA header, pixel data, ...) must not abort the whole run
+            log_output(LOG_MESSAGES['native_fallback'].format(dcm_dir, "{}: {}".format(type(e).__name__, e)),
+                       level="WARNING", logger=logger)
 
-        dcm2niix_workdir = dcm_dir
+            conversion_tool = 'dcm2niix'
+
+        # dcm2niix starts from an empty working directory, without what the in-process converter left in it
+        for fname in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, fname))
+
+    if conversion_tool == 'dcm2niix':
 
         if bids_meta:
             cmd = [
@@ -54,6 +135,8 @@ def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids
                 "y",
                 "-f",
                 out_fname,
+                "-o",
+                work_dir,
                 dcm_dir
             ]
         else:
@@ -63,42 +146,49 @@ def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids
                 "y",
                 "-f",
                 out_fname,
+                "-o",
+                work_dir,
                 dcm_dir
             ]
 
+        # The output goes to a side file of the run when there is one (the log refers to it), otherwise into the
+        # working directory
+        output_file = side_file("{}_dcm2niix.log".format(out_fname)) or os.path.join(work_dir, "dcm2niix.out")
+        units = dicom_units(dcm_dir)
+        fields = {"image": out_fname, "step": "dcm2niix", "units": units, "output_file": output_file}
+        start = time.time()
+
         try:
 
-            result = check_output(cmd, stderr=STDOUT, cwd=dcm2niix_workdir, universal_newlines=True)
+            max_rss_mb = default_runner().call(cmd, cwd=work_dir, output_file=output_file,
+                                               timeout=step_timeout("dcm2niix", units),
+                                               retries=TIMEOUT_POLICY["retries"], logger=logger)
+
+            with open(output_file, "r") as outfile:
+                result = outfile.read()
 
             # The following line is a hack to get the actual filename returned by the dcm2niix utility. When converting
             # the B0 dcm files, or files that specify which coil they used, or whether they contain phase information,
             # the utility appends some prefixes to the filename it saves, instead of just using
             # the specified output filename. There is no option to turn this off (and the author seemed unwilling to
             # add one). With this hack I retrieve the actual filename it used to save the file from the utility output.
-            # This might break on future updates of dcm2niix
-            actual_fname = \
-                [s for s in ([s for s in str(result).split('\n') if "Convert" in s][0].split(" "))
-                 if s[0] == '/'][0].split("/")[-1]
-
-            # Move nifti file and json bids file to anat folder
-            shutil.move(os.path.join(dcm_dir, "{}.nii.gz".format(actual_fname)),
-                        os.path.join(out_dir, "{}.nii.gz".format(out_fname)))
-            shutil.move(os.path.join(dcm_dir, "{}.json".format(actual_fname)),
-                        os.path.join(out_dir, "{}.json".format(out_fname)))
+            # This might break on future updates of dcm2niix, in which case the first image in the (per-series) working
+            # directory is used.
+            try:
+                actual_fname = \
+                    [s for s in ([s for s in str(result).split('\n') if "Convert" in s][0].split(" "))
+                     if s[0] == '/'][0].split("/")[-1]
+            except IndexError:
+                actual_fname = sorted(f for f in os.listdir(work_dir) if f.endswith(".nii.gz"))[0][:-7]
 
-            dcm_file = [f for f in os.listdir(dcm_dir) if ".dcm" in f][0]
+            # Move nifti file and json bids file to the BIDS folder
+            _place_outputs(work_dir, actual_fname, out_dir, out_fname)
 
-            log_str = LOG_MESSAGES['success_converted'].format(os.path.join(dcm_dir, dcm_file), out_fname,
-                                                               " ".join(cmd), 0)
+            log_output(LOG_MESSAGES['success_converted'].format(dcm_dir, out_fname, " ".join(cmd), 0), logger=logger,
+                       duration=round(time.time() - start, 2), max_rss_mb=round(max_rss_mb, 1), returncode=0,
+                       **fields)
 
-            if result:
-                log_str += LOG_MESSAGES['output'].format(result)
-
-            log_output(log_str, logger=logger, semaphore=semaphore)
-
-            return ("/".join(dcm2niix_workdir.split("/")[-3:]),
-                    os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz"),
-                    True)
+            return True
 
         except CalledProcessError as e:
 
@@ -107,27 +197,23 @@ def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids
             if e.output:
                 log_str += LOG_MESSAGES['output'].format(e.output)
 
-            log_output(log_str, level="ERROR", logger=logger, semaphore=semaphore)
+            log_output(log_str, level="ERROR", logger=logger, duration=round(time.time() - start, 2),
+                       returncode=e.returncode, **fields)
 
-            return ("/".join(dcm2niix_workdir.split("/")[-3:]),
-                    os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz"),
-                    False)
+            return False
 
-        finally:
+        except CommandTimeout as e:
 
-            # Clean up temporary files
-            tmp_files = glob(os.path.join(dcm2niix_workdir, "*.nii.gz"))
-            tmp_files.extend(glob(os.path.join(dcm2niix_workdir, "*.json")))
+            log_output(LOG_MESSAGES['timeout'].format(dcm_dir, e.message), level="ERROR", logger=logger,
+                       duration=round(time.time() - start, 2), attempts=TIMEOUT_POLICY["retries"] + 1, **fields)
 
-            if tmp_files:
-                list(map(os.remove, tmp_files))
+            return False
 
     elif conversion_tool == 'dimon':
 
-        dimon_workdir = dcm_dir
-
         # IMPLEMENT GENERATION OF BIDS METADATA FILES WHEN USING DIMON FOR CONVERSION OF DCM FILES
 
+        # Dimon writes its GERT_Reco/dimon.files scripts and the to3d output into its working directory
         cmd = [
             "Dimon",
             "-infile_pattern",
@@ -141,41 +227,40 @@ def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids
         dimon_env = os.environ.copy()
         dimon_env['AFNI_TO3D_OUTLIERS'] = 'No'
 
+        output_file = side_file("{}_dimon.log".format(out_fname)) or os.path.join(work_dir, "dimon.out")
+        units = dicom_units(dcm_dir)
+        fields = {"image": out_fname, "step": "dimon", "units": units, "output_file": output_file}
+        start = time.time()
+
         try:
 
-            result = check_output(cmd, stderr=STDOUT, env=dimon_env, cwd=dimon_workdir, universal_newlines=True)
+            max_rss_mb = default_runner().call(cmd, cwd=work_dir, output_file=output_file, env=dimon_env,
+                                               timeout=step_timeout("dimon", units),
+                                               retries=TIMEOUT_POLICY["retries"], logger=logger)
 
             # Check the contents of stdout for the -quit_on_err flag because to3d returns a success code
             # even if it terminates because the -quit_on_err flag was thrown
-            if "to3d kept from going into interactive mode by option -quit_on_err" in result:
-
-                log_str = LOG_MESSAGES['dimon_error'].format(dcm_dir, " ".join(cmd), 0)
+            with open(output_file, "r") as outfile:
+                quit_on_err = any("to3d kept from going into interactive mode by option -quit_on_err" in line
+                                  for line in outfile)
 
-                if result:
-                    log_str += LOG_MESSAGES['output'].format(result)
+            if quit_on_err:
 
-                log_output(log_str, level="ERROR", logger=logger, semaphore=semaphore)
-
-                return ("/".join(dimon_workdir.split("/")[-3:]),
-                        os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz"),
-                        False)
-
-            shutil.move(os.path.join(dimon_workdir, "{}.nii.gz".format(out_fname)),
-                        os.path.join(out_dir, "{}.nii.gz".format(out_fname)))
+                log_str = LOG_MESSAGES['dimon_error'].format(dcm_dir, " ".join(cmd), 0)
+                log_str += LOG_MESSAGES['output'].format(output_tail(output_file))
 
-            dcm_file = [f for f in os.listdir(dcm_dir) if ".dcm" in f][0]
+                log_output(log_str, level="ERROR", logger=logger, duration=round(time.time() - start, 2),
+                           returncode=0, **fields)
 
-            log_str = LOG_MESSAGES['success_converted'].format(os.path.join(dcm_dir, dcm_file), out_fname,
-                                                               " ".join(cmd), 0)
+                return False
 
-            if result:
-                log_str += LOG_MESSAGES['output'].format(result)
+            _place_outputs(work_dir, out_fname, out_dir, out_fname)
 
-            log_output(log_str, logger=logger, semaphore=semaphore)
+            log_output(LOG_MESSAGES['success_converted'].format(dcm_dir, out_fname, " ".join(cmd), 0), logger=logger,
+                       duration=round(time.time() - start, 2), max_rss_mb=round(max_rss_mb, 1), returncode=0,
+                       **fields)
 
-            return ("/".join(dimon_workdir.split("/")[-3:]),
-                    os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz"),
-                    True)
+            return True
 
         except CalledProcessError as e:
 
@@ -184,41 +269,199 @@ def dcm_to_nifti(dcm_dir, out_fname, out_dir, conversion_tool, logger=None, bids
             if e.output:
                 log_str += LOG_MESSAGES['output'].format(e.output)
 
-            log_output(log_str, level="ERROR", logger=logger, semaphore=semaphore)
+            log_output(log_str, level="ERROR", logger=logger, duration=round(time.time() - start, 2),
+                       returncode=e.returncode, **fields)
 
-            return ("/".join(dimon_workdir.split("/")[-3:]),
-                    os.path.join("/".join(out_dir.split("/")[-4:]), out_fname + ".nii.gz"),
-                    False)
+            return False
 
-        finally:
+        except CommandTimeout as e:
 
-            # Clean up temporary files
-            tmp_files = glob(os.path.join(dimon_workdir, "GERT_Reco_dicom*"))
-            tmp_files.extend(glob(os.path.join(dimon_workdir, "dimon.files.run.*")))
+            log_output(LOG_MESSAGES['timeout'].format(dcm_dir, e.message), level="ERROR", logger=logger,
+                       duration=round(time.time() - start, 2), attempts=TIMEOUT_POLICY["retries"] + 1, **fields)
 
-            if tmp_files:
-                list(map(os.remove, tmp_files))
+            return False
 
     else:
 
-        raise NiftyConversionFailure("Tool Error: {} is not a supported conversion tool. Please select 'dcm2niix' or "
-                                     "'dimon'".format(conversion_tool))
+        raise NiftyConversionFailure("Tool Error: {} is not a supported conversion tool. Please select 'dcm2niix', "
+                                     "'dimon' or 'native'".format(conversion_tool))
 
 
-def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='dcm2niix', logger=None,
-                    nthreads=MAX_WORKERS, overwrite=False, filters=None, scanner_meta=False):
+class _ArchiveExtractor(object):
+
+    # Extracts Oxygen archives on demand, once per archive, from any number of worker threads
+    def __init__(self, oxygen_dir, logger=None):
+        self.oxygen_dir = oxygen_dir
+        self.logger = logger
+        self.lock = Lock()
+        self.archive_locks = {}
+        self.extracted = set()
+
+    def extract(self, archive):
+
+        with self.lock:
+            archive_lock = self.archive_locks.setdefault(archive, Lock())
+
+        with archive_lock:
+            if archive not in self.extracted:
+                extract_tgz(archive, self.oxygen_dir, self.logger)
+                self.extracted.add(archive)
+
+
+def _convert_series(dcm_dir, bids_fpath, conversion_tool, archives=(), extractor=None, logger=None):
+
+    out_bdir = "/".join(bids_fpath.split("/")[:-1])
+    out_fname = bids_fpath.split("/")[-1].split(".")[0]
+
+    # Series planned from a mapping guide are only validated here, in the worker: the series directory is extracted
+    # from the archives that may hold its session if needed (until one did), and must contain DICOM files.
+    if extractor:
+        for archive in archives:
+
+            if os.path.isdir(dcm_dir):
+                break
+
+            if os.path.isfile(archive):
+                try:
+                    extractor.extract(archive)
+                except tarfile.TarError as e:
+                    log_output("Could not extract {}: {}".format(archive, e), level="ERROR", logger=logger)
+
+    if not os.path.isdir(dcm_dir) or not [f for f in os.listdir(dcm_dir) if ".dcm" in f]:
+
+        log_output("No DICOM files found for series {}. Skipping...".format(dcm_dir), level="ERROR", logger=logger)
+
+        return ("/".join(dcm_dir.split("/")[-3:]),
+                os.path.join("/".join(out_bdir.split("/")[-4:]), out_fname + ".nii.gz"),
+                False)
+
+    if not os.path.isdir(out_bdir):
+        create_path(out_bdir)
+
+    return dcm_to_nifti(dcm_dir, out_fname, out_bdir, conversion_tool=conversion_tool, bids_meta=True, logger=logger)
+
+
+def _record_conversion(mapping, journal, key, result):
+
+    subject, session, scan = key
+    series_dir, bids_fpath, success = result
+
+    if success:
+        mapping[subject]["sessions"][session]["scans"][scan]["bids_fpath"] = bids_fpath
+        mapping[subject]["sessions"][session]["scans"][scan]["conversion_status"] = True
+
+    if journal:
+        journal.record_result(subject, session, scan, bids_fpath, success)
+
+
+def _io_limiter(io_threads, logger=None):
+    return AdaptiveLimiter("Extraction", initial=max(1, min(2, io_threads)), maximum=max(1, io_threads),
+                           logger=logger)
+
+
+def _cpu_limiter(nthreads, logger=None):
+    return AdaptiveLimiter("Conversion", initial=min(nthreads, CPU_WORKERS), maximum=nthreads, logger=logger)
+
+
+def _run_io_stage(fn, items, nthreads, io_threads, logger=None, units=None, progress=None, progress_stage=None,
+                  succeeded=None):
+
+    # Runs fn over items in an I/O stage (sequentially if nthreads is 0) and returns the results in order. units gives
+    # the size of an item in MB.
+    if progress:
+        progress.queued(progress_stage, len(items))
 
     if nthreads > 0:
-        thread_semaphore = Semaphore(value=1)
-    else:
-        thread_semaphore = None
+        with Stage(_io_limiter(io_threads, logger), progress=progress, progress_stage=progress_stage,
+                   succeeded=succeeded) as io_stage:
+            futures = [io_stage.submit(fn, item, units=units(item) if units else 1.0,
+                                       nbytes=int(units(item) * 1024 * 1024) if units else 0) for item in items]
+
+        return [future.result() for future in futures]
+
+    if progress:
+        return [progress.track(progress_stage, fn, item, nbytes=int(units(item) * 1024 * 1024) if units else 0,
+                               succeeded=succeeded) for item in items]
+
+    return [fn(item) for item in items]
+
+
+def _archive_index(mapping):
+
+    # Archives recorded in a mapping, by file name, with the subject they belong to
+    index = {}
+
+    for subject in mapping.keys():
+        for name, record in mapping[subject].get("archives", {}).items():
+            index[name] = dict(record, subject=subject)
+
+    return index
+
+
+def _session_archives(mapping, subject, session, oxygen_dir):
+
+    # Archives that may hold a session of a mapping guide, most likely first: the archives recorded for its subject
+    # (the ones named after the session first), then the name built from its subject and session directories
+    names = sorted((name for name, record in mapping[subject].get("archives", {}).items()
+                    if "duplicate_of" not in record), key=lambda name: (session not in name, name))
+
+    oxygen_file = mapping[subject]["sessions"][session].get("oxygen_file")
+
+    if oxygen_file and oxygen_file not in names:
+        names.append(oxygen_file)
+
+    return [os.path.join(oxygen_dir, name) for name in names]
+
+
+def _guide_units(mapping, key):
+
+    # Number of DICOM files of a series of a mapping guide, from its fingerprint ("<files>:<hash>"), 0 if unknown
+    subject, session, scan = key
+    fingerprint = mapping[subject]["sessions"][session]["scans"][scan].get("fingerprint") or ""
+
+    try:
+        return int(fingerprint.split(":")[0])
+    except ValueError:
+        return 0
+
+
+def _iter_scans(mapping):
+    for subject in mapping.keys():
+        for session in mapping[subject]["sessions"].keys():
+            for scan in mapping[subject]["sessions"][session]["scans"].values():
+                yield scan
+
+
+def _next_run(scans):
+
+    # Next free run number of a session; duplicate series have no run number
+    runs = [int(scan["meta"]["run"]) for scan in scans.values() if "meta" in scan]
+
+    return max(runs) + 1 if runs else 1
+
+
+def _next_id(entries, key):
+
+    # Returns the next free BIDS index given the existing entries of a mapping level
+    used = [int(entry[key]) for entry in entries.values() if entry.get(key, "").isdigit()]
+
+    return max(used) + 1 if used else 1
+
+
+def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='dcm2niix', logger=None,
+                    nthreads=CPU_WORKERS, overwrite=False, filters=None, scanner_meta=False, previous_mapping=None,
+                    io_threads=IO_WORKERS, journal=None, dedup=False, progress=None):
+
+    # When a previous mapping is given the conversion is incremental: existing BIDS files are kept and only new or
+    # changed series are converted.
+    incremental = previous_mapping is not None
 
     # If BIDS directory exists, verify that it's either empty, or that overwrite is allowed. Otherwise create directory.
     if os.path.isdir(bids_dir):
 
         bids_files = glob(os.path.join(bids_dir, '*'))
 
-        if bids_files:
+        if bids_files and not incremental:
             if not overwrite:
                 raise DuplicateFile("The BIDS directory is not empty, and overwrite is set to False. Aborting...")
             else:
@@ -227,44 +470,108 @@ def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='d
     else:
         create_path(bids_dir)
 
-    # Uncompress any compressed Oxygen DICOM files
-    raw_files = os.path.join(oxygen_dir, '*')
+    if isinstance(mapping_guide, str):
+        with open(mapping_guide, "r") as guide_file:
+            mapping_guide = json.load(guide_file)
 
-    # Check if there are compressed oxygen files, and if so, uncompress them
-    compressed_files = [d for d in glob(raw_files) if os.path.isfile(d)]
+    # With a mapping guide the plan is known in advance: nothing is globbed or extracted here, the archives are
+    # extracted on demand by the conversion workers.
+    if not mapping_guide:
 
-    log_output("Extracting compressed files...", logger=logger)
+        # Uncompress any compressed Oxygen DICOM files
+        raw_files = os.path.join(oxygen_dir, '*')
 
-    if nthreads > 0:   # Run in multiple threads
+        # Check if there are compressed oxygen files, and if so, uncompress them
+        compressed_files = sorted(d for d in glob(raw_files) if os.path.isfile(d))
 
-        futures = []
+        # Archives ingested by a previous run (same name, size and modification time) are not extracted again
+        known_archives = _archive_index(previous_mapping) if incremental else {}
 
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        archives = OrderedDict()
 
-            for f in compressed_files:
+        for f in compressed_files:
 
-                futures.append(executor.submit(extract_tgz, f, oxygen_dir, logger, thread_semaphore))
+            st = os.stat(f)
+            record = {"size": st.st_size, "mtime": int(st.st_mtime)}
 
-        wait(futures)
+            known = known_archives.get(os.path.basename(f))
 
-    else:   # Run sequentially
-        for f in compressed_files:
-            extract_tgz(f, oxygen_dir, logger=logger)
+            if known is not None and known["size"] == record["size"] and known["mtime"] == record["mtime"]:
+                continue
+
+            archives[f] = record
+
+        if dedup and archives:
+
+            log_output("Hashing {} compressed files...".format(len(archives)), logger=logger)
+
+            hashes = _run_io_stage(hash_file, list(archives.keys()), nthreads, io_threads, logger=logger,
+                                   units=file_size_mb, progress=progress, progress_stage="archive_hashing")
+
+            # Content hash -> name of the first archive with that content
+            seen = dict((record["sha1"], name) for name, record in known_archives.items()
+                        if "sha1" in record and "duplicate_of" not in record)
+
+            for (f, record), sha in zip(archives.items(), hashes):
+
+                record["sha1"] = sha
 
-    log_output("Compressed file extractions complete.", logger=logger)
+                if sha in seen:
+                    record["duplicate_of"] = seen[sha]
+                    log_output("{} is a duplicate of {}. Skipping...".format(f, seen[sha]), logger=logger)
+                else:
+                    seen[sha] = os.path.basename(f)
 
-    # Now we can get a list of uncompressed directories
-    uncompressed_files = [d for d in glob(raw_files) if os.path.isdir(d)]
+        to_extract = [f for f in archives.keys() if "duplicate_of" not in archives[f]]
 
-    mapping = {}
+        def extract_archive(f):
+            try:
+                return extract_tgz(f, oxygen_dir, logger)
+            except tarfile.TarError as e:
+                log_output("Could not extract {}: {}".format(f, e), level="ERROR", logger=logger)
+
+        log_output("Extracting compressed files...", logger=logger)
+
+        # Extraction throughput is measured in MB of archive extracted per second
+        extracted_dirs = _run_io_stage(extract_archive, to_extract, nthreads, io_threads, logger=logger,
+                                       units=file_size_mb, progress=progress, progress_stage="extraction",
+                                       succeeded=lambda extracted_dir: extracted_dir is not None)
+
+        for f, extracted_dir in zip(to_extract, extracted_dirs):
+            if extracted_dir:
+                archives[f]["subject"] = os.path.relpath(extracted_dir, oxygen_dir).split(os.sep)[0].split("-")[-1]
+
+        log_output("Compressed file extractions complete.", logger=logger)
+
+    # The mapping and the execution list built from it (with --profile)
+    mapping_build = section("mapping_build").start()
+
+    # Scans that are already converted and whose DICOM files have not changed since
+    unchanged = set()
+
+    if mapping_guide:
+
+        # The guide (a mapping file as written by gen_bids.py) is the execution plan
+        mapping = copy.deepcopy(mapping_guide)
+
+        log_output("Using mapping guide as the conversion plan, discovery skipped.", logger=logger)
 
     # If a BIDS mapping has not be provided to guide the conversion process, attempt to generate mapping from
     # available information.
-    if not mapping_guide:
+    else:
+
+        # Now we can get a list of uncompressed directories
+        uncompressed_files = sorted(d for d in glob(raw_files) if os.path.isdir(d))
 
-        subject_counter = 1
+        # Start from the previous mapping so that subjects, sessions and runs keep their BIDS ids across runs, and
+        # series whose raw data has since been removed stay recorded.
+        mapping = copy.deepcopy(previous_mapping) if incremental else {}
 
-        mapping = {}
+        # Series found for the first time, and series whose DICOM files changed since the previous mapping
+        new_scans = []
+        changed_scans = []
+
+        subject_counter = _next_id(mapping, "bids_subject")
 
         for unc_file in uncompressed_files:
 
@@ -279,51 +586,132 @@ def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='d
 
                 subject_counter += 1
 
-            session_dirs = [d for d in glob(os.path.join(unc_file, '*')) if os.path.isdir(d)]
+            session_dirs = sorted(d for d in glob(os.path.join(unc_file, '*')) if os.path.isdir(d))
 
-            session_counter = 1
+            session_counter = _next_id(mapping[subject_id]["sessions"], "bids_session")
 
             for ses_dir in session_dirs:
 
                 session_id = ses_dir.split("/")[-1]
 
-                mapping[subject_id]["sessions"][session_id] = {
-                    "bids_session": "{:0>4d}".format(session_counter),
-                    "oxygen_file": "{}-{}-DICOM.tgz".format(ses_dir.split("/")[-2], ses_dir.split("/")[-1]),
-                    "scans": {}
-                }
+                if session_id not in mapping[subject_id]["sessions"].keys():
+
+                    mapping[subject_id]["sessions"][session_id] = {
+                        "bids_session": "{:0>4d}".format(session_counter),
+                        "oxygen_file": "{}-{}-DICOM.tgz".format(ses_dir.split("/")[-2], ses_dir.split("/")[-1]),
+                        "scans": {}
+                    }
 
-                session_counter += 1
+                    session_counter += 1
 
-                scan_dirs = [d for d in glob(os.path.join(ses_dir, '*')) if os.path.isdir(d) and "mr_" in d]
+                scans = mapping[subject_id]["sessions"][session_id]["scans"]
 
-                scan_counter = 1
+                scan_dirs = sorted(d for d in glob(os.path.join(ses_dir, '*')) if os.path.isdir(d) and "mr_" in d)
 
                 for sc_dir in scan_dirs:
 
                     scan_id = sc_dir.split("/")[-1]
 
+                    fingerprint = fingerprint_series(sc_dir)
+
+                    prev_scan = scans.get(scan_id)
+
+                    if prev_scan is not None and prev_scan.get("fingerprint") == fingerprint:
+                        # Converted series with unchanged DICOM files are left alone (provided the output still
+                        # exists); series that were filtered out stay filtered out.
+                        if prev_scan["conversion_status"] and \
+                                os.path.isfile(os.path.join(os.path.dirname(bids_dir.rstrip("/")),
+                                                            prev_scan["bids_fpath"])):
+                            unchanged.add((subject_id, session_id, scan_id))
+                        continue
+
                     # Filter this series directory
                     if filter_series(sc_dir, filters=filters, logger=logger):
                         continue
 
-                    mapping[subject_id]["sessions"][session_id]["scans"][scan_id] = {
-                        "series_dir": "/".join(sc_dir.split("/")[-3:]),
-                        "bids_fpath": "",
-                        "conversion_status": False,
-                        "meta": {
-                            "type": "func",
-                            "modality": "bold",
-                            "description": "task-fmri",
-                            "run": "{:0>4d}".format(scan_counter)
-                        }
-                    }
+                    if prev_scan is not None:
+                        # Changed series keep their run number
+                        prev_scan["fingerprint"] = fingerprint
+                        prev_scan["bids_fpath"] = ""
+                        prev_scan["conversion_status"] = False
+                        prev_scan.pop("duplicate_of", None)
+
+                        if scanner_meta:
+                            prev_scan["scanner_meta"] = get_scanner_meta(sc_dir)
+
+                        changed_scans.append((prev_scan, sc_dir))
+                    else:
+                        # Run numbers are assigned once duplicates are known
+                        new_scans.append((scans, scan_id, sc_dir, fingerprint))
 
-                    if scanner_meta:
-                        meta = get_scanner_meta(sc_dir)
-                        mapping[subject_id]["sessions"][session_id]["scans"][scan_id]["scanner_meta"] = meta
+        if dedup and (new_scans or changed_scans):
 
-                    scan_counter += 1
+            log_output("Hashing {} series...".format(len(new_scans) + len(changed_scans)), logger=logger)
+
+            hash_dirs = [sc_dir for _, sc_dir in changed_scans] + [sc_dir for _, _, sc_dir, _ in new_scans]
+            hashes = _run_io_stage(hash_series, hash_dirs, nthreads, io_threads, logger=logger, units=series_size_mb,
+                                   progress=progress, progress_stage="series_hashing")
+
+            for (prev_scan, _), sha in zip(changed_scans, hashes[:len(changed_scans)]):
+                prev_scan["content_hash"] = sha
+
+            new_hashes = hashes[len(changed_scans):]
+        else:
+            new_hashes = [None] * len(new_scans)
+
+        # Content hash -> series directory of the first series with that content
+        seen_series = dict((scan["content_hash"], scan["series_dir"]) for scan in _iter_scans(mapping)
+                           if "content_hash" in scan and "duplicate_of" not in scan)
+
+        for (scans, scan_id, sc_dir, fingerprint), sha in zip(new_scans, new_hashes):
+
+            series_dir = "/".join(sc_dir.split("/")[-3:])
+
+            scans[scan_id] = {
+                "series_dir": series_dir,
+                "bids_fpath": "",
+                "conversion_status": False,
+                "fingerprint": fingerprint
+            }
+
+            if sha is not None:
+                scans[scan_id]["content_hash"] = sha
+
+            if sha is not None and sha in seen_series:
+                # Repeated series are recorded but neither converted nor given a run number
+                scans[scan_id]["duplicate_of"] = seen_series[sha]
+
+                log_output("Series {} is a duplicate of {}. Skipping...".format(sc_dir, seen_series[sha]),
+                           logger=logger)
+            else:
+                scans[scan_id]["meta"] = {
+                    "type": "func",
+                    "modality": "bold",
+                    "description": "task-fmri",
+                    "run": "{:0>4d}".format(_next_run(scans))
+                }
+
+                if sha is not None:
+                    seen_series[sha] = series_dir
+
+            if scanner_meta:
+                scans[scan_id]["scanner_meta"] = get_scanner_meta(sc_dir)
+
+        # Record the archives with the subject they were extracted to
+        archive_names = dict((os.path.basename(f), record) for f, record in archives.items())
+
+        for name, record in archive_names.items():
+
+            original = record
+
+            if "duplicate_of" in record:
+                original = archive_names.get(record["duplicate_of"], known_archives.get(record["duplicate_of"], {}))
+
+            subject = original.get("subject")
+
+            if subject in mapping:
+                mapping[subject].setdefault("archives", {})[name] = dict((k, v) for k, v in record.items()
+                                                                         if k != "subject")
 
     # Mapping has been generated
     # Iterate through the mapping to create execution list to be split into threads
@@ -333,8 +721,24 @@ def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='d
         for session in mapping[subject]["sessions"].keys():
             for scan in mapping[subject]["sessions"][session]["scans"].keys():
 
+                if (subject, session, scan) in unchanged or \
+                        "duplicate_of" in mapping[subject]["sessions"][session]["scans"][scan]:
+                    continue
+
                 series_dir = os.path.join(oxygen_dir,
                                           mapping[subject]["sessions"][session]["scans"][scan]["series_dir"])
+
+                archives = ()
+
+                if mapping_guide:
+                    archives = _session_archives(mapping, subject, session, oxygen_dir)
+                    mapping[subject]["sessions"][session]["scans"][scan]["bids_fpath"] = ""
+                    mapping[subject]["sessions"][session]["scans"][scan]["conversion_status"] = False
+
+                # Series carried over from a previous mapping whose raw data is no longer available
+                elif incremental and not os.path.isdir(series_dir):
+                    continue
+
                 bids_subject = "sub-{}".format(mapping[subject]["bids_subject"])
                 bids_session = "ses-{}".format(mapping[subject]["sessions"][session]["bids_session"])
                 bids_desc = mapping[subject]["sessions"][session]["scans"][scan]["meta"]["description"]
@@ -350,62 +754,114 @@ def convert_to_bids(bids_dir, oxygen_dir, mapping_guide=None, conversion_tool='d
 
                 bids_fpath = os.path.join(bids_dir, bids_subject, bids_session, bids_type, bids_fname)
 
-                exec_list.append((series_dir, bids_fpath))
+                exec_list.append(((subject, session, scan), series_dir, bids_fpath, archives))
+
+    mapping_build.stop()
+
+    if incremental:
+        log_output("Incremental conversion: {} series unchanged, {} series to convert.".format(len(unchanged),
+                                                                                           len(exec_list)),
+                   logger=logger)
+
+    if journal:
+        journal.record_plan(mapping)
+
+    extractor = _ArchiveExtractor(oxygen_dir, logger=logger)
+
+    if progress:
+        progress.queued("conversion", len(exec_list))
 
     # Iterate through executable list and convert to nifti
     if nthreads > 0:    # Run in multiple threads
 
         futures = []
 
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        # Largest series (most DICOM files) first, and the largest archives extracted first, so that no large
+        # conversion is left running alone at the end. With a mapping guide the file counts are the ones its
+        # fingerprints recorded (series without one keep the order of the guide): no series directory is listed here.
+        if mapping_guide:
+            exec_list.sort(key=lambda e: _guide_units(mapping, e[0]), reverse=True)
+        else:
+            exec_list.sort(key=lambda e: dicom_units(e[1]) if os.path.isdir(e[1]) else 0, reverse=True)
 
-            for dcm_dir, bids_fpath in exec_list:
+        # Archives that still have to be extracted for the planned series (only when converting from a mapping guide)
+        pending_archives = OrderedDict()
 
-                out_bdir = "/".join(bids_fpath.split("/")[:-1])
-                if not os.path.isdir(out_bdir):
-                    create_path(out_bdir)
+        # A series goes with the first of its archives that exists, the conversion extracts the others if needed
+        for key, dcm_dir, bids_fpath, archives in exec_list:
+            archive = None if os.path.isdir(dcm_dir) else next((a for a in archives if os.path.isfile(a)), None)
+            pending_archives.setdefault(archive, []).append((key, dcm_dir, bids_fpath, archives))
 
-                out_fname = bids_fpath.split("/")[-1].split(".")[0]
+        pending_archives = OrderedDict(sorted(pending_archives.items(), key=lambda a: os.path.getsize(a[0])
+                                              if a[0] else 0, reverse=True))
 
-                futures.append(executor.submit(dcm_to_nifti, dcm_dir, out_fname, out_bdir,
-                                               conversion_tool=conversion_tool, bids_meta=True, logger=logger,
-                                               semaphore=thread_semaphore))
-                ## FOR TESTING
-                # break
-                #######
+        def submit_conversions(series):
+            for key, dcm_dir, bids_fpath, archives in series:
+                # Size of the series, for the bytes/s of the status file
+                nbytes = int(series_size_mb(dcm_dir) * 1024 * 1024) if progress and os.path.isdir(dcm_dir) else 0
+                future = cpu_stage.submit(_convert_series, dcm_dir, bids_fpath, conversion_tool, archives=archives,
+                                          extractor=extractor, logger=logger, nbytes=nbytes)
+                future.add_done_callback(partial(record_future, key))
+                futures.append(future)
 
-            wait(futures)
+        def record_future(key, future):
+            # Outcomes are recorded (and journaled) as each conversion completes, not once all of them are done
+            if future.exception() is None:
+                _record_conversion(mapping, journal, key, future.result())
 
-            for future in futures:
-                series_dir, bids_fpath, success = future.result()
+        def extract_and_submit(archive, series):
+            # The extraction slot is held until the converters accept this archive's series, so extraction cannot
+            # run ahead of conversion (and fill the disk) by more than the I/O stage limit.
+            try:
+                extractor.extract(archive)
+            except tarfile.TarError as e:
+                log_output("Could not extract {}: {}".format(archive, e), level="ERROR", logger=logger)
+            submit_conversions(series)
 
-                subject = series_dir.split("/")[0].split("-")[1]
-                session = series_dir.split("/")[1]
-                scan = series_dir.split("/")[2]
+        with Stage(_cpu_limiter(nthreads, logger), progress=progress, progress_stage="conversion",
+                   succeeded=lambda result: result[2]) as cpu_stage:
 
-                if success:
-                    mapping[subject]["sessions"][session]["scans"][scan]["bids_fpath"] = bids_fpath
-                    mapping[subject]["sessions"][session]["scans"][scan]["conversion_status"] = True
+            # Series that are already on disk are fed to the converters while the archives are being extracted
+            feeder = Thread(target=submit_conversions, args=(pending_archives.pop(None, []),))
+            feeder.start()
 
-    else:   # Run sequentially
+            if pending_archives:
+
+                if progress:
+                    progress.queued("extraction", len(pending_archives))
+
+                with Stage(_io_limiter(io_threads, logger), progress=progress, progress_stage="extraction") as io_stage:
 
-        for dcm_dir, bids_fpath in exec_list:
+                    extractions = [io_stage.submit(extract_and_submit, archive, series, units=file_size_mb(archive),
+                                                   nbytes=os.path.getsize(archive))
+                                   for archive, series in pending_archives.items()]
 
-            out_bdir = "/".join(bids_fpath.split("/")[:-1])
-            if not os.path.isdir(out_bdir):
-                create_path(out_bdir)
+                    wait(extractions)
 
-            out_fname = bids_fpath.split("/")[-1].split(".")[0]
+                # Surface unexpected errors of the extraction workers
+                for extraction in extractions:
+                    extraction.result()
 
-            series_dir, bids_fpath, success = dcm_to_nifti(dcm_dir, out_fname, out_bdir, conversion_tool='dcm2niix',
-                                                           bids_meta=True, logger=logger)
+            feeder.join()
 
-            subject = series_dir.split("/")[0].split("-")[1]
-            session = series_dir.split("/")[1]
-            scan = series_dir.split("/")[2]
+            wait(futures)
+
+            # Surface unexpected errors of the conversion workers
+            for future in futures:
+                future.result()
+
+    else:   # Run sequentially
+
+        for key, dcm_dir, bids_fpath, archives in exec_list:
+
+            if progress:
+                result = progress.track("conversion", _convert_series, dcm_dir, bids_fpath, conversion_tool,
+                                        archives=archives, extractor=extractor, logger=logger,
+                                        succeeded=lambda r: r[2])
+            else:
+                result = _convert_series(dcm_dir, bids_fpath, conversion_tool, archives=archives, extractor=extractor,
+                                         logger=logger)
 
-            if success:
-                mapping[subject]["sessions"][session]["scans"][scan]["bids_fpath"] = bids_fpath
-                mapping[subject]["sessions"][session]["scans"][scan]["conversion_status"] = True
+            _record_conversion(mapping, journal, key, result)
 
     return mapping
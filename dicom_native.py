@@ -0,0 +1,312 @@
+import os
+import json
+import pydicom
+import numpy as np
+import nibabel as nb
+from nibabel.nicom import csareader
+from nibabel.nicom.dicomwrappers import wrapper_from_data
+
+
+# In-process conversion of plain DICOM series (single-echo magnitude mosaic EPI, one-slice-per-file EPI and 3D
+# anatomicals such as the MPRAGE) to NIfTI. Anything else raises UnsupportedSeries so the caller can fall back to
+# dcm2niix.
+
+
+# DICOM attributes copied to the BIDS sidecar, with the factor to convert them to BIDS units (ms -> s)
+SIDECAR_FIELDS = [
+    ("Modality", None),
+    ("MagneticFieldStrength", None),
+    ("Manufacturer", None),
+    ("ManufacturersModelName", None),
+    ("SeriesDescription", None),
+    ("ProtocolName", None),
+    ("ScanningSequence", None),
+    ("SequenceVariant", None),
+    ("ScanOptions", None),
+    ("SequenceName", None),
+    ("ImageType", None),
+    ("SeriesNumber", None),
+    ("SliceThickness", None),
+    ("SpacingBetweenSlices", None),
+    ("EchoTime", 0.001),
+    ("RepetitionTime", 0.001),
+    ("InversionTime", 0.001),
+    ("FlipAngle", None),
+    ("PixelBandwidth", None),
+    ("InPlanePhaseEncodingDirection", None),
+]
+
+# DICOM patient space is LPS, NIfTI is RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# Relative tolerance used when checking that slices are evenly spaced
+SPACING_TOLERANCE = 0.01
+
+# Attributes every file of a plain series has, with the number of values of each (None: a single value)
+REQUIRED_FIELDS = [
+    ("Rows", None),
+    ("Columns", None),
+    ("PixelSpacing", 2),
+    ("ImageOrientationPatient", 6),
+    ("ImagePositionPatient", 3),
+    ("PixelData", None),
+]
+
+
+class UnsupportedSeries(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _plain(value):
+
+    # pydicom values (MultiValue, DSfloat, IS...) to JSON serializable python values
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        return [_plain(v) for v in value]
+
+    for cast in (int, float):
+        try:
+            if cast(value) == float(value):
+                return cast(value)
+        except (TypeError, ValueError):
+            pass
+
+    return str(value).strip()
+
+
+def _read_series(dcm_dir):
+
+    # Every file is read once, with its pixels: the checks and the conversion use the same datasets
+    dcm_files = sorted(f for f in os.listdir(dcm_dir) if ".dcm" in f)
+
+    if not dcm_files:
+        raise UnsupportedSeries("No DICOM files in {}".format(dcm_dir))
+
+    headers = []
+
+    for dcm_file in dcm_files:
+        fpath = os.path.join(dcm_dir, dcm_file)
+        try:
+            headers.append((fpath, pydicom.dcmread(fpath)))
+        except Exception as e:
+            raise UnsupportedSeries("Could not read {}: {}: {}".format(dcm_file, type(e).__name__, e))
+
+    return headers
+
+
+def _check_fields(fpath, dcm):
+
+    for field, n_values in REQUIRED_FIELDS:
+
+        if field not in dcm:
+            raise UnsupportedSeries("{} has no {}".format(os.path.basename(fpath), field))
+
+        if n_values is None:
+            continue
+
+        try:
+            values = [float(v) for v in getattr(dcm, field)]
+        except (TypeError, ValueError):
+            values = []
+
+        if len(values) != n_values:
+            raise UnsupportedSeries("{} has an invalid {}".format(os.path.basename(fpath), field))
+
+
+def _check_plain_series(headers):
+
+    first = headers[0][1]
+
+    if "SharedFunctionalGroupsSequence" in first or "PerFrameFunctionalGroupsSequence" in first:
+        raise UnsupportedSeries("Enhanced (multi-frame) DICOM")
+
+    image_type = [t.upper() for t in getattr(first, "ImageType", [])]
+
+    if len(image_type) > 2 and image_type[2] not in ("M", "MOSAIC", "ND", "NORM"):
+        raise UnsupportedSeries("Not a magnitude image ({})".format("\\".join(image_type)))
+
+    signature = None
+
+    for fpath, dcm in headers:
+
+        _check_fields(fpath, dcm)
+
+        curr = (int(dcm.Rows), int(dcm.Columns),
+                tuple(round(float(v), 4) for v in dcm.ImageOrientationPatient),
+                tuple(round(float(v), 4) for v in dcm.PixelSpacing),
+                float(getattr(dcm, "EchoTime", 0) or 0),
+                tuple(getattr(dcm, "ImageType", [])))
+
+        if signature is None:
+            signature = curr
+        elif curr != signature:
+            raise UnsupportedSeries("Series mixes geometries, echoes or image types")
+
+
+def _volume_order(dcm):
+    return (int(getattr(dcm, "AcquisitionNumber", 0) or 0), int(getattr(dcm, "InstanceNumber", 0) or 0))
+
+
+def _plan_mosaic(headers):
+
+    # One file per volume, every file is a mosaic with the same slices
+    headers = sorted(headers, key=lambda h: _volume_order(h[1]))
+
+    return [[fpath] for fpath, _ in headers]
+
+
+def _plan_slices(headers):
+
+    # One file per slice. Group files by slice position, every position must have the same number of volumes.
+    normal = np.cross(*np.array(headers[0][1].ImageOrientationPatient, dtype=np.float64).reshape(2, 3))
+
+    positions = {}
+
+    for fpath, dcm in headers:
+        indicator = round(float(np.dot(normal, np.array(dcm.ImagePositionPatient, dtype=np.float64))), 3)
+        positions.setdefault(indicator, []).append((fpath, dcm))
+
+    slice_positions = sorted(positions.keys())
+
+    n_vols = len(positions[slice_positions[0]])
+
+    if any(len(positions[p]) != n_vols for p in slice_positions):
+        raise UnsupportedSeries("Uneven number of volumes per slice position")
+
+    if len(slice_positions) > 2:
+        gaps = np.diff(slice_positions)
+        if np.abs(gaps - gaps.mean()).max() > SPACING_TOLERANCE * abs(gaps.mean()):
+            raise UnsupportedSeries("Slices are not evenly spaced")
+
+    for p in slice_positions:
+        positions[p].sort(key=lambda h: _volume_order(h[1]))
+
+    # volumes[t][z] = file
+    return [[positions[p][t][0] for p in slice_positions] for t in range(n_vols)]
+
+
+def _sidecar(dcm, slice_timing=None):
+
+    sidecar = {}
+
+    for field, scale in SIDECAR_FIELDS:
+        value = getattr(dcm, field, None)
+
+        if value is None or value == "":
+            continue
+
+        value = _plain(value)
+
+        if scale is not None:
+            value = float(value) * scale
+
+        sidecar[field] = value
+
+    if slice_timing is not None:
+        sidecar["SliceTiming"] = slice_timing
+
+    sidecar["ConversionSoftware"] = "7T_qc dicom_native"
+
+    return sidecar
+
+
+def _slice_timing(dcm):
+
+    try:
+        csa = csareader.get_csa_header(dcm, "image")
+        times = csareader.get_values(csa, "MosaicRefAcqTimes")
+    except Exception:
+        return None
+
+    if not times:
+        return None
+
+    return [round(float(t) / 1000.0, 4) for t in times]
+
+
+def native_dcm_to_nifti(dcm_dir, out_fname, out_dir, bids_meta=False):
+
+    headers = _read_series(dcm_dir)
+
+    _check_plain_series(headers)
+
+    first_wrapper = wrapper_from_data(headers[0][1])
+
+    if first_wrapper.is_multiframe:
+        raise UnsupportedSeries("Enhanced (multi-frame) DICOM")
+
+    is_mosaic = first_wrapper.is_mosaic
+
+    volumes = _plan_mosaic(headers) if is_mosaic else _plan_slices(headers)
+
+    header_by_file = dict(headers)
+
+    n_vols = len(volumes)
+
+    data = None
+    affine = None
+    slice_timing = None
+
+    for t, files in enumerate(volumes):
+
+        for z, fpath in enumerate(files):
+
+            wrapper = wrapper_from_data(header_by_file[fpath])
+            pixels = wrapper.get_data()
+
+            # The pixels of a file are only needed once they are copied
+            del header_by_file[fpath].PixelData
+
+            if data is None:
+                if is_mosaic:
+                    vol_shape = pixels.shape
+                else:
+                    vol_shape = pixels.shape + (len(files),)
+
+                data = np.empty(vol_shape + ((n_vols,) if n_vols > 1 else ()), dtype=pixels.dtype)
+
+                affine = np.array(wrapper.affine, dtype=np.float64)
+
+                if is_mosaic:
+                    slice_timing = _slice_timing(wrapper.dcm_data)
+                elif len(files) > 1:
+                    # Slice axis from the first to the last slice position
+                    last = wrapper_from_data(header_by_file[files[-1]])
+                    affine[:3, 2] = (np.array(last.image_position) - np.array(wrapper.image_position)) / \
+                        (len(files) - 1)
+
+            elif pixels.shape != (vol_shape if is_mosaic else vol_shape[:2]):
+                raise UnsupportedSeries("{} does not have the shape of the first image".format(
+                    os.path.basename(fpath)))
+
+            elif pixels.dtype != data.dtype:
+                data = data.astype(np.promote_types(data.dtype, pixels.dtype))
+
+            if is_mosaic:
+                target = data if n_vols == 1 else data[..., t]
+                target[...] = pixels
+            elif n_vols == 1:
+                data[:, :, z] = pixels
+            else:
+                data[:, :, z, t] = pixels
+
+    img = nb.Nifti1Image(data, LPS_TO_RAS.dot(affine))
+    img.set_qform(img.affine, code=1)
+    img.set_sform(img.affine, code=1)
+
+    dcm = headers[0][1]
+
+    if n_vols > 1:
+        tr = float(getattr(dcm, "RepetitionTime", 0) or 0) / 1000.0
+        zooms = img.header.get_zooms()[:3] + (tr,)
+        img.header.set_zooms(zooms)
+
+    img.header.set_xyzt_units(xyz="mm", t="sec")
+
+    nb.save(img, os.path.join(out_dir, "{}.nii.gz".format(out_fname)))
+
+    if bids_meta:
+        with open(os.path.join(out_dir, "{}.json".format(out_fname)), "w") as sidecar_file:
+            json.dump(_sidecar(dcm, slice_timing), sidecar_file, indent=4, sort_keys=True)
+
+    return len(headers)
@@ -1,15 +1,19 @@
 import os
+import sys
 import argparse
 import logging
-import multiprocessing
 import json
-from converters import convert_to_bids
+from converters import convert_to_bids, CPU_WORKERS, IO_WORKERS
+from mappings import MappingJournal, mapping_from_journal, write_mapping
+from progress import Progress
+from log_pipeline import start_logging, stop_logging
+from timeouts import set_timeout_policy
+from runner import set_runner_policy
+from planner import model_from_logs, plan_stage, suggest_allocation, format_plan, conversion_items
+from profiling import Profiler
 from utils import create_path, log_output
 from datetime import datetime
-from collections import OrderedDict
-
-
-MAX_WORKERS = multiprocessing.cpu_count() * 5
+from glob import glob
 
 
 if __name__ == "__main__":
@@ -38,10 +42,27 @@ if __name__ == "__main__":
         default=os.path.join(os.getcwd(), "mappings")
     )
 
+    parser.add_argument(
+        "--conversion_tool",
+        help="DICOM to NIfTI converter. 'native' converts plain EPI and T1 series in-process and falls back to "
+             "dcm2niix for anything else.",
+        choices=['dcm2niix', 'dimon', 'native'],
+        default='dcm2niix'
+    )
+
     parser.add_argument(
         "--nthreads",
-        help="number of threads to use when running this script. Use 0 for sequential run.",
-        default=MAX_WORKERS,
+        help="maximum number of concurrent DICOM conversions. The actual number is tuned from the measured conversion "
+             "throughput. Use 0 for sequential run. Default is NUM_CPU_CORES",
+        default=CPU_WORKERS,
+        type=int
+    )
+
+    parser.add_argument(
+        "--io_threads",
+        help="maximum number of concurrent archive extractions. The actual number is tuned from the measured "
+             "extraction throughput. Default is {}".format(IO_WORKERS),
+        default=IO_WORKERS,
         type=int
     )
 
@@ -52,6 +73,22 @@ if __name__ == "__main__":
         default=False
     )
 
+    parser.add_argument(
+        "--incremental",
+        help="Only convert new or changed series, using the most recent mapping in the mapping directory. Existing "
+             "BIDS files of unchanged series are left alone.",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--dedup",
+        help="Hash the archives and the DICOM files of each series, and skip (but record in the mapping) archives and "
+             "series whose content was already seen.",
+        action="store_true",
+        default=False
+    )
+
     parser.add_argument(
         "--filters",
         help="absolute path to json file containing series filters",
@@ -71,40 +108,145 @@ if __name__ == "__main__":
         default=False
     )
 
+    parser.add_argument(
+        "--status_file",
+        help="JSON file refreshed during the run with the queued, running, done and failed counts of each stage, the "
+             "throughput and the ETA. Default is bids_conversion_<date>_status.json in the log directory",
+        default=None
+    )
+
+    parser.add_argument(
+        "--status_prom",
+        help="Prometheus textfile (e.g. in the node_exporter textfile directory) refreshed with the same status",
+        default=None
+    )
+
+    parser.add_argument(
+        "--status_interval",
+        help="Seconds between status refreshes. Default is 10",
+        default=10.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile the Python code of the run: the cProfile profiles of all the threads are merged into "
+             "<log>_profile.pstats, and <log>_profile.txt reports the slowest functions, the hot paths (filter_series, "
+             "get_scanner_meta, the mapping build and sort) and the top memory allocations (tracemalloc). Slows the "
+             "run down",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--timeout_factor",
+        help="A dcm2niix or Dimon conversion is killed once it runs this many times longer than expected from the size "
+             "of its input (number of DICOM files), then restarted up to --max_retries times. 0 disables the timeouts. "
+             "Default is 5",
+        default=5.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--timeout_min",
+        help="Minimum timeout, in seconds, of a dcm2niix or Dimon conversion. Default is 300",
+        default=300.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--max_retries",
+        help="Number of times a timed out dcm2niix or Dimon conversion is restarted before its series is marked "
+             "failed. Default is 1",
+        default=1,
+        type=int
+    )
+
+    parser.add_argument(
+        "--plan",
+        help="Dry run: size the series from their DICOM file counts (from the archive sizes for archives not extracted "
+             "yet), predict the runtime and peak memory of the extractions and conversions from the logs of earlier "
+             "runs (--plan_history), and print the expected makespan and the suggested SLURM allocation. Nothing is "
+             "extracted or converted, and all the series found are planned (also with --incremental).",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--plan_history",
+        help="JSON lines logs of earlier runs the --plan cost model is fit to, as globs (repeatable). Default is the "
+             "*.jsonl logs of the log directory",
+        action="append",
+        default=None
+    )
+
     settings = parser.parse_args()
 
+    set_timeout_policy(factor=settings.timeout_factor, minimum=settings.timeout_min, retries=settings.max_retries)
+
+    # The converters run their commands on the shared runner, as many at once as there are conversion threads (even
+    # beyond the number of cores)
+    set_runner_policy(max_procs=max(settings.nthreads, 1))
+
     date_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     # Configure logger
     if not os.path.isdir(settings.log_dir):
         create_path(settings.log_dir)
 
+    if settings.status_file is None:
+        settings.status_file = os.path.join(settings.log_dir, "bids_conversion_{}_status.json".format(date_str))
+
     log_fname = "bids_conversion_{}.log".format(date_str)
     log_fpath = os.path.join(settings.log_dir, log_fname)
 
-    # Remove all handlers associated with the root logger object.
-    for handler in logging.root.handlers[:]:
-        handler.close()
-        logging.root.removeHandler(handler)
-
-    logging.basicConfig(
-        filename=log_fpath,
-        level=logging.DEBUG,
-        format='LOG ENTRY %(asctime)s - %(levelname)s \n%(message)s \nEND LOG ENTRY\n'
-    )
+    # Records go through a queue to a writer thread. The structured fields of each record are also written as JSON
+    # lines, and the output of the converters goes to side files in a directory named after the log.
+    log_listener = start_logging(log_fpath, json_fpath="{}.jsonl".format(log_fpath[:-4]), side_dir=log_fpath[:-4])
 
     # Print the settings
     settings_str = "Bids directory: {}\n".format(settings.bids_dir) + \
                    "Oxygen data: {}\n".format(settings.oxygen_dir) + \
                    "Mapping guide fpath: {}\n".format(settings.mapping_guide) + \
                    "Mapping directory: {}\n".format(settings.mapping_dir) + \
+                   "Conversion tool: {}\n".format(settings.conversion_tool) + \
+                   "No. of conversion threads: {}\n".format(settings.nthreads) + \
+                   "No. of extraction threads: {}\n".format(settings.io_threads) + \
                    "Overwrite: {}\n".format(settings.overwrite) + \
+                   "Incremental: {}\n".format(settings.incremental) + \
+                   "Deduplicate: {}\n".format(settings.dedup) + \
                    "Filter(s) fpath: {}\n".format(settings.filters) + \
                    "Log directory: {}\n".format(settings.log_dir) + \
+                   "Status file: {}\n".format(settings.status_file) + \
+                   "Timeouts: {}x expected, at least {}s, {} retries\n".format(settings.timeout_factor,
+                                                                             settings.timeout_min,
+                                                                             settings.max_retries) + \
+                   "Profile: {}\n".format(settings.profile) + \
                    "Include scanner metadata: {}\n\n".format(settings.scanner_meta)
 
     log_output(settings_str, logger=logging)
 
+    if settings.plan:
+
+        model, history = model_from_logs(settings.plan_history or [os.path.join(settings.log_dir, "*.jsonl")])
+
+        extractions, conversions = conversion_items(settings.oxygen_dir, settings.conversion_tool)
+
+        # Without a mapping guide every archive is extracted before the conversions start
+        stages = [plan_stage("extraction", extractions, model, settings.io_threads),
+                  plan_stage("conversion", conversions, model, settings.nthreads)]
+
+        tool_step = "dimon" if settings.conversion_tool == "dimon" else "dcm2niix"
+
+        plan_str = format_plan(stages, suggest_allocation(stages, max(settings.nthreads, 1)), model,
+                               ["extract", tool_step], history)
+
+        log_output(plan_str, logger=logging)
+        log_output(plan_str)
+
+        stop_logging(log_listener)
+        sys.exit(0)
+
     log_output("Beginning conversion to BIDS format of data in {} directory.\n"
                "Log located in {}.".format(settings.oxygen_dir, log_fpath), logger=logging)
 
@@ -114,49 +256,65 @@ if __name__ == "__main__":
     else:
         filters = None
 
-    mapping = convert_to_bids(settings.bids_dir, settings.oxygen_dir, mapping_guide=settings.mapping_guide,
-                              conversion_tool='dcm2niix', logger=logging, nthreads=settings.nthreads,
-                              overwrite=settings.overwrite, filters=filters,
-                              scanner_meta=settings.scanner_meta)
+    previous_mapping = None
 
-    log_output("BIDS conversion complete. Results stored in {} directory".format(settings.bids_dir), logger=logging)
+    if settings.incremental:
 
-    # Save mapping
+        prev_map_fpaths = sorted(glob(os.path.join(settings.mapping_dir, "bids_mapping_*.json")))
+
+        if prev_map_fpaths:
+            with open(prev_map_fpaths[-1], "r") as prev_map_file:
+                previous_mapping = json.load(prev_map_file)
+
+            log_output("Incremental conversion based on mapping {}".format(prev_map_fpaths[-1]), logger=logging)
+        else:
+            log_output("No previous mapping found in {}, converting all series.".format(settings.mapping_dir),
+                       logger=logging)
+
+    # Conversion outcomes are journaled as they complete, so the mapping survives a crash mid-conversion (see
+    # recover_mapping.py)
     if not os.path.isdir(settings.mapping_dir):
         create_path(settings.mapping_dir)
 
     map_fpath = os.path.join(settings.mapping_dir, "bids_mapping_{}.json".format(date_str))
+    journal_fpath = os.path.join(settings.mapping_dir, "bids_mapping_{}.jsonl".format(date_str))
 
-    log_output("Creating mappings file...", logger=logging)
+    journal = MappingJournal(journal_fpath)
 
-    with open(map_fpath, "w") as outfile:
-        contents = json.dumps(mapping, sort_keys=True, indent=4, separators=(',', ': '))
+    log_output("Mapping journal located in {}".format(journal_fpath), logger=logging)
 
-        # Sort the mapping by bids subject (YES, I KNOW THIS IS NOT THE MOST ELEGANT WAY TO DO THIS)
-        sorted_by_key = json.loads(contents, object_pairs_hook=OrderedDict)
+    # Started before the progress and the conversion stages, so that their threads are profiled too
+    profiler = Profiler("{}_profile".format(log_fpath[:-4])).start() if settings.profile else None
 
-        # Get the bids subject ids present
-        bids_ids = sorted([sorted_by_key[key]["bids_subject"] for key in sorted_by_key.keys()])
+    progress = Progress("gen_bids", settings.status_file, prom_file=settings.status_prom,
+                        interval=settings.status_interval).start()
 
-        sorted_by_bids = OrderedDict()
+    try:
+        convert_to_bids(settings.bids_dir, settings.oxygen_dir, mapping_guide=settings.mapping_guide,
+                        conversion_tool=settings.conversion_tool, logger=logging, nthreads=settings.nthreads,
+                        io_threads=settings.io_threads, overwrite=settings.overwrite, filters=filters,
+                        scanner_meta=settings.scanner_meta, previous_mapping=previous_mapping, journal=journal,
+                        dedup=settings.dedup, progress=progress)
+    finally:
+        journal.close()
+        progress.stop()
 
-        for bids_id in bids_ids:
+    log_output("BIDS conversion complete. Results stored in {} directory".format(settings.bids_dir), logger=logging)
 
-            for subject in sorted_by_key.keys():
+    # Save mapping
+    log_output("Creating mappings file...", logger=logging)
 
-                if sorted_by_key[subject]["bids_subject"] == bids_id:
-                    sorted_by_bids[subject] = sorted_by_key[subject]
-                    break
+    # Built from the journal in a single sorted pass, as recover_mapping.py would: the journal is only removed once it
+    # rebuilt the mapping, and the mapping file was written
+    write_mapping(mapping_from_journal(journal_fpath), map_fpath)
 
-        sorted_contents = json.dumps(sorted_by_bids, indent=4, separators=(',', ': '))
+    os.remove(journal_fpath)
 
-        outfile.write(sorted_contents)
+    log_output("Mapping file created in {}".format(map_fpath), logger=logging)
 
-        log_output("Mapping file created in {}".format(map_fpath), logger=logging)
+    if profiler:
+        log_output("Profile saved to {} (python -m pstats), report in {}".format(*profiler.stop()), logger=logging)
 
     log_output("Finished!!!", logger=logging)
 
-    # Remove all handlers associated with the root logger object.
-    for handler in logging.root.handlers[:]:
-        handler.close()
-        logging.root.removeHandler(handler)
+    stop_logging(log_listener)
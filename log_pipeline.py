@@ -0,0 +1,116 @@
+import os
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime
+
+
+# Logging of the entry points: workers only put their records on a queue (no lock is taken), a listener thread writes
+# them to the log file, and to a JSON lines file with the structured fields of each record. Tool output is not logged,
+# it stays in side files that the records point to (output_file).
+
+LOG_FORMAT = 'LOG ENTRY %(asctime)s - %(levelname)s \n%(message)s%(fields)s \nEND LOG ENTRY\n'
+
+# Structured fields a record may carry, passed to log_output as keyword arguments. units is the size of the input of a
+# step (see timeouts.py), max_rss_mb the peak resident memory of its command: planner.py fits its cost model to them.
+FIELDS = ["image", "step", "units", "duration", "max_rss_mb", "returncode", "attempts", "output_file"]
+
+# Directory of the side files of tools that do not write their output next to their results (the converters)
+SIDE_DIR = {"path": None}
+
+# Listeners started by start_logging and not stopped yet
+RUNNING_LISTENERS = set()
+
+
+def record_fields(record):
+    return [(field, getattr(record, field)) for field in FIELDS if getattr(record, field, None) is not None]
+
+
+class EntryFormatter(logging.Formatter):
+
+    # The usual log entries, with the structured fields of the record on their last line
+    def __init__(self):
+        logging.Formatter.__init__(self, LOG_FORMAT)
+
+    def format(self, record):
+        fields = record_fields(record)
+        record.fields = "\n[{}]".format(" ".join("{}={}".format(field, value) for field, value in fields)) \
+            if fields else ""
+        return logging.Formatter.format(self, record)
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = [
+            ("time", datetime.fromtimestamp(record.created).isoformat()),
+            ("level", record.levelname),
+            ("message", record.getMessage())
+        ]
+        return json.dumps(dict(entry + record_fields(record)))
+
+
+def start_logging(log_fpath, json_fpath=None, side_dir=None, level=logging.DEBUG):
+
+    # Replaces the handlers of the root logger with the queue. Returns the listener, to be passed to stop_logging (it is
+    # also stopped at exit, so the records of a run that died are written).
+    for handler in logging.root.handlers[:]:
+        handler.close()
+        logging.root.removeHandler(handler)
+
+    handlers = []
+
+    file_handler = logging.FileHandler(log_fpath)
+    file_handler.setFormatter(EntryFormatter())
+    handlers.append(file_handler)
+
+    if json_fpath:
+        json_handler = logging.FileHandler(json_fpath)
+        json_handler.setFormatter(JSONFormatter())
+        handlers.append(json_handler)
+
+    records = queue.SimpleQueue()
+
+    logging.root.addHandler(QueueHandler(records))
+    logging.root.setLevel(level)
+
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    RUNNING_LISTENERS.add(listener)
+
+    if side_dir:
+        if not os.path.isdir(side_dir):
+            os.makedirs(side_dir)
+        SIDE_DIR["path"] = side_dir
+
+    atexit.register(stop_logging, listener)
+
+    return listener
+
+
+def stop_logging(listener):
+
+    # Writes the queued records and closes the log files. Safe to call more than once.
+    if listener in RUNNING_LISTENERS:
+        RUNNING_LISTENERS.discard(listener)
+        listener.stop()
+
+    for handler in listener.handlers:
+        handler.close()
+
+    for handler in logging.root.handlers[:]:
+        handler.close()
+        logging.root.removeHandler(handler)
+
+    SIDE_DIR["path"] = None
+
+
+def side_file(name):
+
+    # Path of a side file called name, None when the run has no side directory
+    if SIDE_DIR["path"] is None:
+        return None
+
+    return os.path.join(SIDE_DIR["path"], name)
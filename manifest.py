@@ -0,0 +1,116 @@
+import os
+import gzip
+import json
+import hashlib
+from datetime import datetime
+
+
+# Record of the images analysed in an output directory, so that a run with --incremental only schedules the images that
+# are new, changed since their analysis or analysed by an older pipeline version (and, if asked, the failed ones). An
+# image is identified by its clean file name (the name of its folder and row of Statistics.csv), and considered changed
+# when its path, size, modification time or header differ from the ones recorded.
+
+MANIFEST_NAME = "manifest.json"
+
+# Bytes hashed at the start of an image: the whole NIfTI-1 (348 bytes) or NIfTI-2 (540 bytes) header
+HEADER_BYTES = 540
+
+
+def clean_fname(fpath):
+    return os.path.basename(fpath).split(".")[0]
+
+
+def header_hash(fpath):
+
+    # None for an unreadable (e.g. truncated) image, which is then analysed, and recorded as failed
+    opener = gzip.open if fpath.endswith(".gz") else open
+
+    try:
+        with opener(fpath, "rb") as infile:
+            return hashlib.sha1(infile.read(HEADER_BYTES)).hexdigest()
+    except (IOError, OSError, EOFError):
+        return None
+
+
+def image_fingerprint(fpath):
+
+    st = os.stat(fpath)
+
+    return {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "header_hash": header_hash(fpath)
+    }
+
+
+class AnalysisManifest(object):
+
+    def __init__(self, output_dir, pipeline_version, retry_failed=False):
+
+        self.fpath = os.path.join(output_dir, MANIFEST_NAME)
+        self.pipeline_version = pipeline_version
+        self.retry_failed = retry_failed
+        self.images = {}
+
+        if os.path.isfile(self.fpath):
+            with open(self.fpath, "r") as infile:
+                self.images = json.load(infile)["images"]
+
+    def reason(self, fpath, fingerprint=None):
+
+        # Why the image at fpath has to be analysed, None if its recorded analysis is up to date
+        entry = self.images.get(clean_fname(fpath))
+
+        if entry is None:
+            return "new"
+
+        if entry["pipeline_version"] != self.pipeline_version:
+            return "pipeline {}".format(entry["pipeline_version"])
+
+        if self.retry_failed and not entry["success"]:
+            return "failed"
+
+        fingerprint = fingerprint or image_fingerprint(fpath)
+
+        if entry["path"] != os.path.abspath(fpath) or \
+                any(entry[key] != value for key, value in fingerprint.items()):
+            return "changed"
+
+        return None
+
+    def schedule(self, fingerprints):
+
+        # The images to analyse, and the reason of each, from the fingerprints of the images found
+        scheduled = []
+
+        for fpath in sorted(fingerprints):
+            reason = self.reason(fpath, fingerprint=fingerprints[fpath])
+            if reason is not None:
+                scheduled.append((fpath, reason))
+
+        return scheduled
+
+    def record(self, fpath, success, analysis_date, fingerprint=None):
+
+        entry = {
+            "path": os.path.abspath(fpath),
+            "pipeline_version": self.pipeline_version,
+            "success": success,
+            "analysis_date": analysis_date
+        }
+        entry.update(fingerprint or image_fingerprint(fpath))
+
+        self.images[clean_fname(fpath)] = entry
+
+    def update(self, other):
+        self.images.update(other.images)
+
+    def save(self):
+
+        # Written to a temporary file first, so an interrupted save keeps the previous manifest
+        tmp_fpath = "{}.tmp".format(self.fpath)
+
+        with open(tmp_fpath, "w") as outfile:
+            json.dump({"date": datetime.now().isoformat(), "images": self.images}, outfile, indent=4, sort_keys=True)
+
+        os.replace(tmp_fpath, self.fpath)
@@ -0,0 +1,103 @@
+import os
+import json
+from threading import Lock
+from collections import OrderedDict
+from profiling import hot_path
+
+
+class MappingJournal(object):
+
+    # Append-only JSON-lines record of a BIDS conversion. The planned mapping is written one subject per line once
+    # it is known, and every conversion outcome is appended as soon as it completes, so the mapping can be rebuilt
+    # after a crash (see mapping_from_journal).
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.lock = Lock()
+        self.outfile = open(fpath, "a")
+
+    def _write(self, record):
+
+        line = json.dumps(record, sort_keys=True) + "\n"
+
+        with self.lock:
+            self.outfile.write(line)
+            self.outfile.flush()
+
+    def record_plan(self, mapping):
+        for subject in mapping.keys():
+            self._write({"event": "plan", "subject": subject, "entry": mapping[subject]})
+
+    def record_result(self, subject, session, scan, bids_fpath, success):
+        self._write({
+            "event": "converted",
+            "subject": subject,
+            "session": session,
+            "scan": scan,
+            "bids_fpath": bids_fpath if success else "",
+            "conversion_status": success
+        })
+
+    def close(self):
+        with self.lock:
+            self.outfile.close()
+
+
+def mapping_from_journal(fpath):
+
+    mapping = {}
+
+    with open(fpath, "r") as infile:
+
+        for line in infile:
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line of a journal that was being written when the process died
+                continue
+
+            if record["event"] == "plan":
+                mapping[record["subject"]] = record["entry"]
+
+            elif record["event"] == "converted":
+                try:
+                    scan = mapping[record["subject"]]["sessions"][record["session"]]["scans"][record["scan"]]
+                except KeyError:
+                    continue
+
+                scan["bids_fpath"] = record["bids_fpath"]
+                scan["conversion_status"] = record["conversion_status"]
+
+    return mapping
+
+
+def _sorted_copy(obj):
+
+    if isinstance(obj, dict):
+        return OrderedDict((key, _sorted_copy(obj[key])) for key in sorted(obj.keys()))
+
+    if isinstance(obj, list):
+        return [_sorted_copy(item) for item in obj]
+
+    return obj
+
+
+@hot_path("mapping_sort")
+def sort_mapping(mapping):
+
+    # Subjects ordered by BIDS subject id, everything below them by key
+    subjects = sorted(mapping.keys(), key=lambda subject: (mapping[subject]["bids_subject"], subject))
+
+    return OrderedDict((subject, _sorted_copy(mapping[subject])) for subject in subjects)
+
+
+def write_mapping(mapping, fpath):
+
+    # Write to a temporary file first so an interrupted write never leaves a truncated mapping behind
+    tmp_fpath = "{}.tmp".format(fpath)
+
+    with open(tmp_fpath, "w") as outfile:
+        outfile.write(json.dumps(sort_mapping(mapping), indent=4, separators=(',', ': ')))
+
+    os.rename(tmp_fpath, fpath)
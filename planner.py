@@ -0,0 +1,310 @@
+import os
+import json
+import math
+import heapq
+import tarfile
+from glob import glob
+from timeouts import EXPECTED_SECONDS, FUNC_STEPS, nifti_units, dicom_units
+
+
+# Dry-run planning of a run (--plan of run_analysis.py and gen_bids.py). The inputs are sized from their NIfTI headers
+# (voxels times volumes) or DICOM file counts, nothing is read or converted. The duration and peak memory of each step
+# are predicted from a model fit to the structured logs (JSON lines) of earlier runs, which record the size of the input
+# (units), the duration and the peak resident memory (max_rss_mb) of every step. The predicted makespan and the
+# suggested SLURM allocation follow.
+
+# Seconds per unit of input of the steps the timeouts do not cover: the image metrics (per million voxels times
+# volumes, in-process) and the archive extractions (per MB of archive)
+DEFAULT_SECONDS = {
+    "metrics": 0.5,
+    "extract": 0.02
+}
+
+# Peak resident memory of the commands of the steps without history: MB, and MB per unit of input
+DEFAULT_RSS_MB = {
+    "despike": (50.0, 12.0),
+    "tshift": (50.0, 12.0),
+    "fwhm": (50.0, 8.0),
+    "volreg": (50.0, 16.0),
+    "automask": (50.0, 8.0),
+    "anat_volreg": (100.0, 24.0),
+    "anat_avg": (50.0, 8.0),
+    "dcm2niix": (50.0, 1.0),
+    "dimon": (50.0, 1.0),
+    "extract": (20.0, 0.0)
+}
+
+# The metrics hold about this many arrays of the size of the image, in the voxel dtype (see algorithms.DTYPE_POLICY)
+METRICS_ARRAYS = 4
+
+# time_margin and mem_margin: safety factors of the suggested allocation. process_mb: memory of the Python process
+# itself. dicom_files_per_mb: DICOM files per MB of an archive that was not extracted yet.
+PLAN_POLICY = {
+    "time_margin": 1.5,
+    "mem_margin": 1.25,
+    "process_mb": 500.0,
+    "dicom_files_per_mb": 2.0
+}
+
+
+def load_records(fpaths):
+
+    # Records of the steps that succeeded, from the JSON lines logs of earlier runs
+    records = []
+
+    for fpath in fpaths:
+        with open(fpath, "r") as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("level") in ["INFO", "DEBUG"] and record.get("step") and \
+                        record.get("units") is not None and record.get("duration") is not None:
+                    records.append(record)
+
+    return records
+
+
+def fit_line(points):
+
+    # Least squares fit of y = a + b * x to (x, y) points, with a and b kept non-negative. With a single size of input,
+    # y is taken as proportional to x. None without points.
+    if not points:
+        return None
+
+    n = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+
+    if var_x <= 1e-12 * max(mean_x ** 2, 1e-12):
+        return (0.0, mean_y / mean_x) if mean_x > 0 else (mean_y, 0.0)
+
+    slope = max(sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x, 0.0)
+
+    return max(mean_y - slope * mean_x, 0.0), slope
+
+
+class CostModel(object):
+
+    # Per step: seconds = a + b * units and peak MB = c + d * units, fit to the records of earlier runs. Steps without
+    # records use the defaults.
+
+    def __init__(self, records=()):
+
+        samples = {}
+
+        for record in records:
+            samples.setdefault(record["step"], []).append(record)
+
+        self.fits = {}
+
+        for step, step_records in samples.items():
+            self.fits[step] = {
+                "records": len(step_records),
+                "seconds": fit_line([(r["units"], r["duration"]) for r in step_records]),
+                "rss_mb": fit_line([(r["units"], r["max_rss_mb"]) for r in step_records
+                                    if r.get("max_rss_mb") is not None])
+            }
+
+    def seconds(self, step, units):
+
+        fit = self.fits.get(step, {}).get("seconds")
+
+        if fit is None:
+            fit = (0.0, EXPECTED_SECONDS.get(step, DEFAULT_SECONDS.get(step, 0.0)))
+
+        return fit[0] + fit[1] * units
+
+    def rss_mb(self, step, units):
+
+        # The metrics run in-process, their memory is estimated from the size of the image
+        if step == "metrics":
+            return metrics_mb(units)
+
+        fit = self.fits.get(step, {}).get("rss_mb") or DEFAULT_RSS_MB.get(step, (0.0, 0.0))
+
+        return fit[0] + fit[1] * units
+
+    def describe(self, steps):
+        return ["{}: {} (seconds = {:.3g} + {:.3g} * units, peak MB = {:.3g} + {:.3g} * units)".format(
+            step, "{} records".format(self.fits[step]["records"]) if step in self.fits else "defaults",
+            self.seconds(step, 0.0), self.seconds(step, 1.0) - self.seconds(step, 0.0),
+            self.rss_mb(step, 0.0), self.rss_mb(step, 1.0) - self.rss_mb(step, 0.0)) for step in steps]
+
+
+def model_from_logs(patterns):
+
+    # patterns: globs of JSON lines logs of earlier runs
+    fpaths = sorted(set(fpath for pattern in patterns for fpath in glob(pattern)))
+
+    return CostModel(load_records(fpaths)), fpaths
+
+
+def metrics_mb(units):
+
+    import numpy as np
+    from algorithms import DTYPE_POLICY
+
+    return METRICS_ARRAYS * units * 1e6 * np.dtype(DTYPE_POLICY["voxel"]).itemsize / (1024.0 * 1024.0)
+
+
+def item_cost(model, steps):
+
+    # Seconds and peak MB of an item whose steps [(step, units), ...] run one after the other
+    seconds = sum(model.seconds(step, units) for step, units in steps)
+    peak_mb = max(model.rss_mb(step, units) for step, units in steps)
+
+    return seconds, peak_mb
+
+
+def list_makespan(durations, workers):
+
+    # Items started in the given order, each on the first worker to become free
+    finish = [0.0] * max(workers, 1)
+
+    for duration in durations:
+        heapq.heappush(finish, heapq.heappop(finish) + duration)
+
+    return max(finish)
+
+
+def plan_stage(name, items, model, workers):
+
+    # items: [(item name, [(step, units), ...]), ...], submitted longest first like run_analysis.py and gen_bids.py do.
+    # The peak memory is the one of the workers running the largest items at once.
+    costs = sorted([(item, ) + item_cost(model, steps) for item, steps in items], key=lambda c: c[1], reverse=True)
+
+    peaks = sorted((peak_mb for _, _, peak_mb in costs), reverse=True)
+
+    return {
+        "stage": name,
+        "items": costs,
+        "workers": max(workers, 1),
+        "makespan": list_makespan([seconds for _, seconds, _ in costs], workers),
+        "peak_mb": sum(peaks[:max(workers, 1)])
+    }
+
+
+def format_walltime(seconds):
+
+    # SLURM walltime, rounded up to a quarter of an hour
+    minutes = int(math.ceil(seconds / 900.0)) * 15 or 15
+    days, minutes = divmod(minutes, 24 * 60)
+
+    walltime = "{:02d}:{:02d}:00".format(minutes // 60, minutes % 60)
+
+    return "{}-{}".format(days, walltime) if days else walltime
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def suggest_allocation(stages, cpus):
+
+    # The stages run one after the other
+    makespan = sum(stage["makespan"] for stage in stages)
+    peak_mb = PLAN_POLICY["process_mb"] + max(stage["peak_mb"] for stage in stages)
+
+    return {
+        "cpus": cpus,
+        "mem": "{}g".format(int(math.ceil(peak_mb * PLAN_POLICY["mem_margin"] / 1024.0))),
+        "time": format_walltime(makespan * PLAN_POLICY["time_margin"]),
+        "makespan": makespan,
+        "peak_mb": peak_mb
+    }
+
+
+def format_plan(stages, allocation, model, steps, history, largest=5):
+
+    lines = ["Plan (dry run, nothing is run):"]
+
+    if history:
+        lines.append("Cost model fit to {} log(s) of earlier runs:".format(len(history)))
+    else:
+        lines.append("No logs of earlier runs found, the cost model uses the defaults:")
+
+    lines.extend("  {}".format(line) for line in model.describe(steps))
+
+    for stage in stages:
+
+        if not stage["items"]:
+            continue
+
+        lines.append("{}: {} items on {} workers, makespan {}, peak {:.0f} MB".format(
+            stage["stage"], len(stage["items"]), stage["workers"], format_duration(stage["makespan"]),
+            stage["peak_mb"]))
+
+        for item, seconds, peak_mb in sorted(stage["items"], key=lambda i: i[1], reverse=True)[:largest]:
+            lines.append("  {}: {}, {:.0f} MB".format(item, format_duration(seconds), peak_mb))
+
+    lines.append("Expected makespan: {}, peak memory: {:.0f} MB".format(format_duration(allocation["makespan"]),
+                                                                      allocation["peak_mb"]))
+    lines.append("Suggested allocation: --cpus-per-task={} --mem={} --time={}".format(
+        allocation["cpus"], allocation["mem"], allocation["time"]))
+
+    return "\n".join(lines)
+
+
+def func_items(images):
+    items = []
+    for image in images:
+        units = nifti_units(image)
+        items.append((os.path.basename(image).split(".")[0],
+                      [(step, units) for step in FUNC_STEPS] + [("metrics", units)]))
+    return items
+
+
+def anat_items(session_dirs):
+
+    # The registrations to the first run, then the average of all the runs
+    items = []
+
+    for session_dir in session_dirs:
+        images = sorted(glob(os.path.join(session_dir, "*.nii*")))
+        base = [image for image in images if "run-01_T1w" in image]
+        if not base:
+            continue
+        steps = [("anat_volreg", nifti_units(image)) for image in images if image not in base]
+        steps.append(("anat_avg", nifti_units(base[0]) * len(images)))
+        items.append((session_dir, steps))
+
+    return items
+
+
+def conversion_items(oxygen_dir, conversion_tool):
+
+    # Archives are extracted, then their series converted. A series is sized by its DICOM file count once extracted,
+    # otherwise from the size of its archive (the first member of an archive names the folder it extracts to).
+    step = "dimon" if conversion_tool == "dimon" else "dcm2niix"
+
+    extractions = []
+    conversions = []
+
+    for archive in sorted(f for f in glob(os.path.join(oxygen_dir, "*")) if os.path.isfile(f)):
+
+        size_mb = os.path.getsize(archive) / 1e6
+
+        try:
+            with tarfile.open(archive, "r:gz") as tar:
+                scans_folder = tar.next().name.split("/")[0]
+        except (tarfile.TarError, IOError, OSError, AttributeError):
+            continue
+
+        extractions.append((os.path.basename(archive), [("extract", size_mb)]))
+
+        if os.path.isdir(os.path.join(oxygen_dir, scans_folder)):
+            continue
+
+        conversions.append(("{} (estimated)".format(os.path.basename(archive)),
+                            [(step, size_mb * PLAN_POLICY["dicom_files_per_mb"])]))
+
+    for scan_dir in sorted(glob(os.path.join(oxygen_dir, "*", "*", "mr_*"))):
+        if os.path.isdir(scan_dir):
+            conversions.append(("/".join(scan_dir.split("/")[-3:]), [(step, dicom_units(scan_dir))]))
+
+    return extractions, conversions
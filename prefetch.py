@@ -0,0 +1,165 @@
+import os
+import time
+from threading import Thread, Lock, Condition
+from collections import OrderedDict
+from utils import log_output
+
+
+# Read-ahead of the inputs of the next queued jobs into the page cache, while the running jobs compute, so that the
+# first step of a job does not stall on cold reads from a network filesystem. The inputs of at most depth jobs ahead are
+# prefetched, and at most budget_mb of them at once: a file counts against the budget from the moment it is wanted
+# until its job starts (or leaves the queue), so read-ahead never grows beyond the budget and evicts the data of the
+# running jobs. Files are read sequentially by one I/O thread, after a posix_fadvise(WILLNEED) hint where available.
+# A file whose job starts while it is read is left to the job.
+
+# depth: jobs ahead whose inputs are prefetched (0: off). budget_mb: MB of inputs prefetched and not yet started.
+# chunk_mb: size of the sequential reads.
+PREFETCH_POLICY = {
+    "depth": 4,
+    "budget_mb": 1024.0,
+    "chunk_mb": 4.0
+}
+
+
+def set_prefetch_policy(depth=None, budget_mb=None, chunk_mb=None):
+
+    if depth is not None:
+        PREFETCH_POLICY["depth"] = max(int(depth), 0)
+    if budget_mb is not None:
+        PREFETCH_POLICY["budget_mb"] = max(float(budget_mb), 0.0)
+    if chunk_mb is not None:
+        PREFETCH_POLICY["chunk_mb"] = max(float(chunk_mb), 0.0625)
+
+
+def _size(fpath):
+    try:
+        return os.path.getsize(fpath)
+    except OSError:
+        return None
+
+
+class Prefetcher(object):
+
+    def __init__(self, depth=None, budget_mb=None, chunk_mb=None, logger=None):
+        self.depth = PREFETCH_POLICY["depth"] if depth is None else depth
+        self.budget = int((PREFETCH_POLICY["budget_mb"] if budget_mb is None else budget_mb) * 1024 * 1024)
+        self.chunk = int((PREFETCH_POLICY["chunk_mb"] if chunk_mb is None else chunk_mb) * 1024 * 1024)
+        self.logger = logger
+
+        # Files wanted and not started yet, in the order they were wanted, with their size. The I/O thread reads the
+        # ones not read yet.
+        self.wanted = OrderedDict()
+        self.done = set()
+        self.sizes = {}
+        self.nbytes = 0
+        self.closed = False
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+
+        self.stats = {"files": 0, "bytes": 0, "seconds": 0.0}
+
+        self.thread = Thread(target=self._run, name="prefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def want(self, upcoming):
+
+        # upcoming: the inputs of the queued jobs, one list of paths per job, next job first. Prefetches the inputs of
+        # the first depth jobs, in order, until the budget is used: the nearest jobs come first, so a file that does not
+        # fit stops the read-ahead.
+        with self.lock:
+
+            for fpath in (fpath for fpaths in upcoming[:self.depth] for fpath in fpaths):
+
+                if fpath in self.wanted:
+                    continue
+
+                if fpath not in self.sizes:
+                    self.sizes[fpath] = _size(fpath)
+
+                size = self.sizes[fpath]
+
+                if size is None:
+                    continue
+
+                if self.nbytes + size > self.budget:
+                    break
+
+                self.wanted[fpath] = size
+                self.nbytes += size
+
+            self.cond.notify()
+
+    def release(self, fpaths):
+
+        # The inputs of a job that started, or left the queue: no longer counted, and no longer read
+        with self.lock:
+            for fpath in fpaths:
+                size = self.wanted.pop(fpath, None)
+                if size is not None:
+                    self.nbytes -= size
+                self.done.discard(fpath)
+
+    def _next(self):
+        with self.lock:
+            while not self.closed:
+                for fpath in self.wanted:
+                    if fpath not in self.done:
+                        return fpath
+                self.cond.wait()
+            return None
+
+    def _run(self):
+
+        buf = bytearray(self.chunk)
+
+        while True:
+
+            fpath = self._next()
+
+            if fpath is None:
+                return
+
+            start = time.time()
+            nbytes = 0
+
+            try:
+                with open(fpath, "rb", buffering=0) as infile:
+
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+                    while True:
+                        # Stop as soon as the job of the file started, it reads the rest itself
+                        with self.lock:
+                            if fpath not in self.wanted or self.closed:
+                                break
+                        n = infile.readinto(buf)
+                        if not n:
+                            break
+                        nbytes += n
+
+            except (IOError, OSError) as e:
+                log_output("Could not prefetch {}: {}".format(fpath, e), level="DEBUG", logger=self.logger)
+
+            with self.lock:
+                if fpath in self.wanted:
+                    self.done.add(fpath)
+                self.stats["files"] += 1
+                self.stats["bytes"] += nbytes
+                self.stats["seconds"] += time.time() - start
+
+            log_output("Prefetched {:.1f} MB of {}".format(nbytes / 1e6, fpath), level="DEBUG", logger=self.logger,
+                       image=os.path.basename(fpath), step="prefetch", units=round(nbytes / 1e6, 3),
+                       duration=round(time.time() - start, 2))
+
+    def close(self):
+
+        with self.lock:
+            self.closed = True
+            self.cond.notify()
+
+        self.thread.join()
+
+        log_output("Prefetched {} file(s), {:.1f} MB in {:.1f}s".format(
+            self.stats["files"], self.stats["bytes"] / 1e6, self.stats["seconds"]), level="DEBUG", logger=self.logger)
@@ -0,0 +1,275 @@
+import sys
+import time
+import threading
+from functools import wraps
+
+
+# Python-level profiling of a run (--profile of run_analysis.py and gen_bids.py), without external tools. Every thread
+# started once profiling is on (the workers of the stages and of the command runner, the event loop) gets its own
+# cProfile profile; from Python 3.12 a single profile sees all the threads. At the end the profiles are merged into one
+# pstats file, and tracemalloc gives the top allocations of the largest heap sampled during the run and the growth of
+# the heap over the run. Named hot paths (hot_path, section) also report their calls and wall time.
+# Nothing is imported or hooked while profiling is off: a hot path then costs one global lookup per call.
+
+# nframes: frames kept per traced allocation. interval: seconds between heap samples. top: lines of each report table.
+PROFILE_POLICY = {
+    "nframes": 10,
+    "interval": 30.0,
+    "top": 30
+}
+
+_profiler = None
+
+
+def set_profile_policy(nframes=None, interval=None, top=None):
+
+    if nframes is not None:
+        PROFILE_POLICY["nframes"] = max(int(nframes), 1)
+    if interval is not None:
+        PROFILE_POLICY["interval"] = max(float(interval), 1.0)
+    if top is not None:
+        PROFILE_POLICY["top"] = max(int(top), 1)
+
+
+class _Section(object):
+
+    def __init__(self, name, profiler):
+        self.name = name
+        self.profiler = profiler
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        return self
+
+    def stop(self):
+        if self.start_time is not None:
+            self.profiler.record_section(self.name, time.time() - self.start_time)
+            self.start_time = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+
+class _NullSection(object):
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+def section(name):
+
+    # Wall time of a block, e.g. with section("mapping_build"): ..., or start() and stop() around code that does not
+    # fit in a with block
+    if _profiler is None:
+        return _NULL_SECTION
+
+    return _Section(name, _profiler)
+
+
+def hot_path(name):
+
+    # Decorator: calls and wall time of a function, under name
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+
+            if _profiler is None:
+                return fn(*args, **kwargs)
+
+            with _Section(name, _profiler):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Profiler(object):
+
+    # out_prefix: the merged profile is written to <out_prefix>.pstats and the report to <out_prefix>.txt
+
+    def __init__(self, out_prefix):
+        self.out_prefix = out_prefix
+
+        self.profiles = []
+        self.sections = {}
+        self.lock = threading.Lock()
+
+        self.baseline = None
+        self.largest = None
+        self.largest_bytes = 0
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.start_time = None
+
+    def start(self):
+
+        global _profiler
+
+        import cProfile
+        import tracemalloc
+
+        tracemalloc.start(PROFILE_POLICY["nframes"])
+        self.baseline = tracemalloc.take_snapshot()
+
+        # The heap is sampled from its own thread, which is not profiled
+        self.sampler = threading.Thread(target=self._sample, name="profile-sampler")
+        self.sampler.daemon = True
+        self.sampler.start()
+
+        if sys.version_info < (3, 12):
+            # Each thread started from now on replaces this hook by a profile of its own on its first call
+            threading.setprofile(self._profile_thread)
+
+        profile = cProfile.Profile()
+        self._add_profile(threading.current_thread().name, profile)
+        profile.enable()
+
+        self.start_time = time.time()
+        _profiler = self
+
+        return self
+
+    def _add_profile(self, thread_name, profile):
+        with self.lock:
+            self.profiles.append((thread_name, profile))
+
+    def _profile_thread(self, frame, event, arg):
+
+        import cProfile
+
+        sys.setprofile(None)
+
+        profile = cProfile.Profile()
+        self._add_profile(threading.current_thread().name, profile)
+        profile.enable()
+
+    def record_section(self, name, seconds):
+        with self.lock:
+            calls, total, longest = self.sections.get(name, (0, 0.0, 0.0))
+            self.sections[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def _sample(self):
+
+        import tracemalloc
+
+        # Keeps the snapshot of the largest heap seen
+        while not self.stopped.wait(PROFILE_POLICY["interval"]):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > self.largest_bytes:
+                self.largest_bytes = current
+                self.largest = tracemalloc.take_snapshot()
+
+    def stop(self):
+
+        # Call once the workers are done: the profiles of threads still running are read as they are
+        global _profiler
+
+        import pstats
+        import tracemalloc
+
+        _profiler = None
+
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+
+        self.profiles[0][1].disable()
+
+        self.stopped.set()
+        self.sampler.join()
+
+        final = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if self.largest is None or current > self.largest_bytes:
+            self.largest_bytes = current
+            self.largest = final
+
+        # The code of the modules imported during the run is not what we are after
+        filters = [tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                   tracemalloc.Filter(False, "<unknown>"),
+                   tracemalloc.Filter(False, tracemalloc.__file__)]
+
+        merged = None
+        threads = []
+
+        for thread_name, profile in self.profiles:
+
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:
+                # Nothing was recorded in the thread
+                continue
+
+            threads.append((thread_name, stats.total_calls, stats.total_tt))
+
+            if merged is None:
+                merged = stats
+            else:
+                merged.add(stats)
+
+        pstats_fpath = "{}.pstats".format(self.out_prefix)
+        report_fpath = "{}.txt".format(self.out_prefix)
+
+        if merged is not None:
+            merged.dump_stats(pstats_fpath)
+
+        top = PROFILE_POLICY["top"]
+
+        with open(report_fpath, "w") as outfile:
+
+            outfile.write("Profile of {:.1f}s, {} profiled thread(s)\n\n".format(time.time() - self.start_time,
+                                                                                 len(threads)))
+
+            if sys.version_info < (3, 12):
+                outfile.write("Threads (calls, seconds in profiled functions, waits included):\n")
+                for thread_name, calls, seconds in sorted(threads, key=lambda t: t[2], reverse=True)[:top]:
+                    outfile.write("  {:<40} {:>12} {:>10.3f}\n".format(thread_name, calls, seconds))
+                outfile.write("\n")
+
+            if self.sections:
+                outfile.write("Hot paths (calls, total seconds, mean seconds, max seconds):\n")
+                for name, (calls, total, longest) in sorted(self.sections.items(), key=lambda s: s[1][1],
+                                                            reverse=True):
+                    outfile.write("  {:<40} {:>8} {:>10.3f} {:>10.4f} {:>10.3f}\n".format(name, calls, total,
+                                                                                          total / calls, longest))
+                outfile.write("\n")
+
+            outfile.write("Traced memory: peak {:.1f} MB, largest sampled heap {:.1f} MB, at the end {:.1f} MB\n\n"
+                          .format(peak / 1e6, self.largest_bytes / 1e6, current / 1e6))
+
+            outfile.write("Top allocations of the largest sampled heap:\n")
+            for stat in self.largest.filter_traces(filters).statistics("lineno")[:top]:
+                outfile.write("  {}\n".format(stat))
+
+            outfile.write("\nGrowth of the heap over the run:\n")
+            for stat in final.filter_traces(filters).compare_to(self.baseline.filter_traces(filters), "lineno")[:top]:
+                outfile.write("  {}\n".format(stat))
+
+            if merged is not None:
+                outfile.write("\nFunctions by cumulative time, all threads:\n")
+                merged.stream = outfile
+                merged.sort_stats("cumulative").print_stats(top)
+                merged.sort_stats("tottime").print_stats(top)
+
+        return pstats_fpath, report_fpath
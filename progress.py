@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import atexit
+from threading import Thread, Event
+from collections import deque, OrderedDict
+from datetime import datetime
+
+
+# Status of a long run, refreshed every few seconds as JSON and in the Prometheus textfile format: per stage the number
+# of queued, running, done and failed items, the items/min and bytes/s over a rolling window and the ETA.
+# Workers only append events to a deque (atomic, no lock taken); the reporter thread folds them into the counters.
+
+STATES = ["queued", "running", "done", "failed"]
+
+
+class Progress(object):
+
+    def __init__(self, name, status_file, prom_file=None, interval=10.0, window=300.0):
+        self.name = name
+        self.status_file = status_file
+        self.prom_file = prom_file
+        self.interval = interval
+        self.window = window
+
+        self.events = deque()
+        self.stages = OrderedDict()
+        self.started_at = time.time()
+        self.stop_event = Event()
+        self.reporter = Thread(target=self._report_loop, name="progress-reporter")
+        self.reporter.daemon = True
+
+    # Hot path: called from the workers
+
+    def queued(self, stage, n=1):
+        self.events.append((time.time(), stage, "queued", n, 0))
+
+    def started(self, stage):
+        self.events.append((time.time(), stage, "started", 1, 0))
+
+    def finished(self, stage, success=True, nbytes=0):
+        self.events.append((time.time(), stage, "done" if success else "failed", 1, nbytes))
+
+    def track(self, stage, fn, *args, **kwargs):
+
+        # Runs fn(*args, **kwargs) as one item of stage. nbytes: size of the item's input, succeeded: callable telling
+        # from fn's return value whether the item failed (exceptions always count as failures)
+        nbytes = kwargs.pop("nbytes", 0)
+        succeeded = kwargs.pop("succeeded", None)
+
+        self.started(stage)
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.finished(stage, success=False, nbytes=nbytes)
+            raise
+
+        self.finished(stage, success=succeeded(result) if succeeded else True, nbytes=nbytes)
+
+        return result
+
+    async def atrack(self, stage, coro_fn, *args, **kwargs):
+
+        # track() for coroutine functions
+        nbytes = kwargs.pop("nbytes", 0)
+        succeeded = kwargs.pop("succeeded", None)
+
+        self.started(stage)
+
+        try:
+            result = await coro_fn(*args, **kwargs)
+        except Exception:
+            self.finished(stage, success=False, nbytes=nbytes)
+            raise
+
+        self.finished(stage, success=succeeded(result) if succeeded else True, nbytes=nbytes)
+
+        return result
+
+    # Reporter
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {"queued": 0, "running": 0, "done": 0, "failed": 0, "bytes": 0,
+                                  "recent": deque()}
+        return self.stages[stage]
+
+    def _drain(self):
+
+        while True:
+            try:
+                when, stage, kind, n, nbytes = self.events.popleft()
+            except IndexError:
+                break
+
+            counts = self._stage(stage)
+
+            if kind == "queued":
+                counts["queued"] += n
+            elif kind == "started":
+                counts["queued"] = max(counts["queued"] - 1, 0)
+                counts["running"] += 1
+            else:
+                counts["running"] = max(counts["running"] - 1, 0)
+                counts[kind] += 1
+                counts["bytes"] += nbytes
+                counts["recent"].append((when, nbytes))
+
+    def status(self):
+
+        self._drain()
+
+        now = time.time()
+        stages = OrderedDict()
+
+        for stage, counts in self.stages.items():
+
+            recent = counts["recent"]
+            while recent and recent[0][0] < now - self.window:
+                recent.popleft()
+
+            # Rates over the window, or since the start while the run is younger than the window
+            span = min(self.window, now - self.started_at) or 1.0
+            rate = len(recent) / span
+            remaining = counts["queued"] + counts["running"]
+
+            stages[stage] = OrderedDict([
+                ("queued", counts["queued"]),
+                ("running", counts["running"]),
+                ("done", counts["done"]),
+                ("failed", counts["failed"]),
+                ("items_per_min", round(60.0 * rate, 2)),
+                ("bytes_per_sec", round(sum(b for _, b in recent) / span, 1)),
+                ("eta_seconds", round(remaining / rate, 1) if rate else None),
+            ])
+
+        return OrderedDict([
+            ("name", self.name),
+            ("pid", os.getpid()),
+            ("started", datetime.fromtimestamp(self.started_at).isoformat()),
+            ("updated", datetime.fromtimestamp(now).isoformat()),
+            ("elapsed_seconds", round(now - self.started_at, 1)),
+            ("stages", stages),
+        ])
+
+    def _prometheus(self, status):
+
+        job = self.name
+        lines = []
+
+        metrics = [
+            ("qc_stage_items", "Items per stage and state", [(s, st, c[st]) for s, c in status["stages"].items()
+                                                             for st in STATES]),
+            ("qc_stage_items_per_minute", "Items completed per minute over the rolling window",
+             [(s, None, c["items_per_min"]) for s, c in status["stages"].items()]),
+            ("qc_stage_bytes_per_second", "Input bytes processed per second over the rolling window",
+             [(s, None, c["bytes_per_sec"]) for s, c in status["stages"].items()]),
+            ("qc_stage_eta_seconds", "Estimated seconds until the stage is done",
+             [(s, None, c["eta_seconds"]) for s, c in status["stages"].items() if c["eta_seconds"] is not None]),
+        ]
+
+        for metric, help_str, samples in metrics:
+            lines.append("# HELP {} {}".format(metric, help_str))
+            lines.append("# TYPE {} gauge".format(metric))
+            for stage, state, value in samples:
+                labels = 'job="{}",stage="{}"'.format(job, stage)
+                if state:
+                    labels += ',state="{}"'.format(state)
+                lines.append("{}{{{}}} {}".format(metric, labels, value))
+
+        lines.append("# HELP qc_last_update_timestamp_seconds Time of the last status update")
+        lines.append("# TYPE qc_last_update_timestamp_seconds gauge")
+        lines.append('qc_last_update_timestamp_seconds{{job="{}"}} {:.0f}'.format(job, time.time()))
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(fpath, content):
+        # Readers never see a partially written file
+        tmp_fpath = "{}.tmp".format(fpath)
+        with open(tmp_fpath, "w") as outfile:
+            outfile.write(content)
+        os.rename(tmp_fpath, fpath)
+
+    def write(self):
+
+        status = self.status()
+
+        self._write(self.status_file, json.dumps(status, indent=4))
+
+        if self.prom_file:
+            self._write(self.prom_file, self._prometheus(status))
+
+    def _report_loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError):
+                pass
+
+    def start(self):
+        self.write()
+        self.reporter.start()
+        # The final status is also written when the run dies on an exception
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        if self.reporter.is_alive():
+            self.reporter.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
@@ -0,0 +1,41 @@
+import os
+import argparse
+from mappings import mapping_from_journal, write_mapping
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild a BIDS mapping file from the (possibly partial) journal left by an interrupted "
+                    "gen_bids.py run. Series whose conversion did not complete are marked with conversion_status "
+                    "false."
+    )
+
+    parser.add_argument(
+        "journal",
+        help="absolute path to the bids_mapping_<date>.jsonl journal"
+    )
+
+    parser.add_argument(
+        "--out_file",
+        help="absolute path for the rebuilt mapping. Defaults to the journal path with a .json extension",
+        default=None
+    )
+
+    settings = parser.parse_args()
+
+    out_file = settings.out_file
+
+    if not out_file:
+        out_file = "{}.json".format(os.path.splitext(settings.journal)[0])
+
+    mapping = mapping_from_journal(settings.journal)
+
+    write_mapping(mapping, out_file)
+
+    converted = sum(1 for subject in mapping.values() for session in subject["sessions"].values()
+                    for scan in session["scans"].values() if scan["conversion_status"])
+    total = sum(len(session["scans"]) for subject in mapping.values() for session in subject["sessions"].values())
+
+    print("Rebuilt mapping for {} subjects ({} of {} series converted) in {}".format(len(mapping), converted, total,
+                                                                                     out_file))
@@ -0,0 +1,196 @@
+import os
+import csv
+import sqlite3
+import argparse
+from threading import Lock
+
+
+# SQLite store of the analysis results: one row per image, keyed by the image name, with its BIDS entities split into
+# indexed columns. Rows are upserted, so a database can be shared by several runs (e.g. incremental ones) and holds the
+# latest result of every image.
+
+# BIDS entity -> column
+ENTITY_COLUMNS = [
+    ("sub", "subject"),
+    ("ses", "session"),
+    ("task", "task"),
+    ("acq", "acquisition"),
+    ("run", "run"),
+    ("echo", "echo")
+]
+
+INDEXED_COLUMNS = ["subject", "session", "task", "run_date"]
+
+
+def parse_entities(clean_fname):
+
+    # sub-0001_ses-0001_task-rest_run-01_bold -> {"sub": "0001", "ses": "0001", "task": "rest", "run": "01"}, "bold"
+    entities = {}
+    suffix = None
+
+    for part in clean_fname.split("_"):
+        if "-" in part:
+            key, value = part.split("-", 1)
+            entities[key] = value
+        else:
+            suffix = part
+
+    return entities, suffix
+
+
+def _number(value):
+
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultsDB(object):
+
+    def __init__(self, fpath, metric_columns):
+        self.fpath = fpath
+        self.metric_columns = list(metric_columns)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(fpath, check_same_thread=False)
+        self._create()
+
+    def _create(self):
+
+        with self.lock, self.conn:
+
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                              "image TEXT PRIMARY KEY, " +
+                              "".join("{} TEXT, ".format(column) for _, column in ENTITY_COLUMNS) +
+                              "suffix TEXT, run_date TEXT, status TEXT)")
+
+            # Metric columns are added as needed, so databases written by older versions keep working
+            existing = set(row[1] for row in self.conn.execute("PRAGMA table_info(results)"))
+
+            for column in self.metric_columns:
+                if column not in existing:
+                    self.conn.execute("ALTER TABLE results ADD COLUMN {} REAL".format(column))
+
+            for column in INDEXED_COLUMNS:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS results_{0} ON results ({0})".format(column))
+
+    def upsert(self, results, run_date):
+
+        # results: {clean_fname: statistics or None (failed)}
+        columns = ["image"] + [column for _, column in ENTITY_COLUMNS] + ["suffix", "run_date", "status"] + \
+            self.metric_columns
+
+        rows = []
+
+        for clean_fname, statistics in results.items():
+
+            entities, suffix = parse_entities(clean_fname)
+
+            row = [clean_fname] + [entities.get(key) for key, _ in ENTITY_COLUMNS] + \
+                  [suffix, run_date, "failed" if statistics is None else "ok"]
+
+            row.extend(_number(statistics.get(column)) if statistics else None for column in self.metric_columns)
+
+            rows.append(row)
+
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results ({}) VALUES ({})".format(
+                ", ".join(columns), ", ".join("?" for _ in columns)), rows)
+
+    def merge(self, fpath):
+
+        # Upserts the rows of another results database, e.g. the one of a shard of a run
+        own_columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(results)"))
+
+        with self.lock:
+
+            self.conn.execute("ATTACH DATABASE ? AS other", (fpath,))
+
+            try:
+                columns = [row[1] for row in self.conn.execute("PRAGMA other.table_info(results)")
+                           if row[1] in own_columns]
+
+                with self.conn:
+                    cursor = self.conn.execute("INSERT OR REPLACE INTO results ({0}) SELECT {0} FROM other.results"
+                                               .format(", ".join(columns)))
+
+                return cursor.rowcount
+
+            finally:
+                self.conn.execute("DETACH DATABASE other")
+
+    def query(self, where="", params=()):
+
+        # Returns the column names and the rows, ordered by image
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM results {} ORDER BY image".format(
+                "WHERE {}".format(where) if where else ""), params)
+            return [d[0] for d in cursor.description], cursor.fetchall()
+
+    def export(self, fpath, where="", params=()):
+
+        # CSV, or Parquet (needs pyarrow) if fpath ends with .parquet
+        header, rows = self.query(where, params)
+
+        if fpath.endswith(".parquet"):
+
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("pyarrow is required to export the results to Parquet")
+
+            table = pa.Table.from_arrays([pa.array(list(column)) for column in zip(*rows)] if rows else
+                                         [pa.array([]) for _ in header], names=header)
+            pq.write_table(table, fpath)
+
+        else:
+            with open(fpath, "w", newline="") as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+        return fpath
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export the results database written by run_analysis.py.")
+
+    parser.add_argument(
+        "results_db",
+        help="results database"
+    )
+
+    parser.add_argument(
+        "out_file",
+        help="CSV file, or Parquet file if the name ends with .parquet"
+    )
+
+    parser.add_argument(
+        "--where",
+        help="SQL condition on the rows to export, e.g. \"subject = '0001' AND task = 'rest'\"",
+        default=""
+    )
+
+    settings = parser.parse_args()
+
+    if not os.path.isfile(settings.results_db):
+        raise IOError("No results database at {}".format(settings.results_db))
+
+    conn = sqlite3.connect(settings.results_db)
+    metric_columns = [row[1] for row in conn.execute("PRAGMA table_info(results)") if row[2] == "REAL"]
+    conn.close()
+
+    db = ResultsDB(settings.results_db, metric_columns)
+    db.export(settings.out_file, where=settings.where)
+    db.close()
+
+    print("Results exported to {}".format(settings.out_file))
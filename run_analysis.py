@@ -1,14 +1,24 @@
 import argparse
 import os
+import sys
 import logging
 import shutil
-from concurrent.futures import ThreadPoolExecutor, wait
-from threading import Semaphore
+from progress import Progress
+from log_pipeline import start_logging, stop_logging
 from utils import log_output, create_path
-from workflows import seven_tesla_wf, anat_average_wf
+from workflows import seven_tesla_wf, seven_tesla_wf_async, anat_average_wf_async, STATISTICS_COLUMNS, \
+    PIPELINE_VERSION, statistics_row, read_statistics, write_statistics
+from manifest import AnalysisManifest, image_fingerprint
+from planner import model_from_logs, plan_stage, suggest_allocation, format_plan, func_items, anat_items, item_cost, \
+    PLAN_POLICY
+from runner import CommandRunner, default_runner
+from algorithms import set_dtype_policy
+from timeouts import set_timeout_policy, FUNC_STEPS
+from prefetch import Prefetcher, set_prefetch_policy
+from profiling import Profiler
+from results_db import ResultsDB
 from glob import glob
 from multiprocessing import cpu_count
-from collections import OrderedDict
 from datetime import datetime
 
 
@@ -20,9 +30,48 @@ class DuplicateFile(Exception):
         self.message = message
 
 
-if __name__ == "__main__":
+def _func_images(bids_dir, image_list=None, with_anat=False):
+
+    # All the Nifti images from the BIDS directory, or the ones of the list. When the anat workflow runs as well, the
+    # images of the anat folders are left to it.
+    if image_list:
+        with open(image_list, "r") as infile:
+            return [line.strip() for line in infile if line.strip()]
+
+    images = glob(os.path.join(bids_dir, "*", "*", "*", "*.nii*"))
+
+    if with_anat:
+        images = [img for img in images if os.path.basename(os.path.dirname(img)) != "anat"]
+
+    return images
+
+
+async def _anat_session(progress, session_dir, out_dir, runner=None):
+
+    # The anat workflow of a session. A session whose workflow raised is logged as failed.
+    try:
+        status = await progress.atrack("anat", anat_average_wf_async, session_dir, out_dir, logger=logging,
+                                       runner=runner, succeeded=bool)
+    except Exception as e:
+        log_output("Error analyzing anatomical images in folder {}: {}: {}".format(session_dir, type(e).__name__, e),
+                   level="ERROR", logger=logging)
+        return
+
+    if not status:
+        log_output("Error analyzing anatomical images in folder {}".format(session_dir), logger=logging)
 
-    tsnr_semaphore = Semaphore(value=1)
+
+def _collect(img, fn, *args, **kwargs):
+
+    # Result of the func workflow of img, (clean_fname, None) if it raised
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        log_output("Error analyzing {}: {}: {}".format(img, type(e).__name__, e), level="ERROR", logger=logging)
+        return os.path.basename(img).split(".")[0], None
+
+
+if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
 
@@ -45,7 +94,8 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--nthreads",
-        help="Number of threads to use. Choose 0 to run sequentially. Default is (NUM_CPU_CORES * 5) // 4",
+        help="Number of images processed at once (and of commands running at once). Choose 0 to run sequentially. "
+             "Default is (NUM_CPU_CORES * 5) // 4",
         default=MAX_WORKERS,
         type=int
     )
@@ -57,49 +107,255 @@ if __name__ == "__main__":
         default=False
     )
 
+    parser.add_argument(
+        "--incremental",
+        help="Only analyse the images that are new, changed or analysed with an older pipeline version, according "
+             "to the manifest of the output directory, and update its Statistics.csv in place (func workflow). The "
+             "output directory is kept.",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--retry_failed",
+        help="With --incremental, also analyse again the images whose analysis failed",
+        action="store_true",
+        default=False
+    )
+
     parser.add_argument(
         "--workflow",
-        help="Overwrite existing BIDS files. NOT RECOMMENDED.",
-        choices=['anat', 'func'],
-        default='func'
+        help="Workflow(s) to run: func (per image metrics), anat (average of the T1w runs of each session), or all. "
+             "Several workflows share the same scheduler, progress, logs and results, and run concurrently",
+        nargs="+",
+        choices=['anat', 'func', 'all'],
+        default=['func']
+    )
+
+    parser.add_argument(
+        "--mem_budget",
+        help="Memory, in GB, the images analysed at once may use together, from the peak memory predicted for each "
+             "(see --plan). Smaller images are analysed meanwhile when the next large one does not fit. Default is the "
+             "memory of the SLURM allocation (SLURM_MEM_PER_NODE), if any, otherwise no budget",
+        default=None,
+        type=float
+    )
+
+    parser.add_argument(
+        "--prefetch_depth",
+        help="Number of queued images whose files are read ahead into the page cache while the running images are "
+             "analysed, so that their first step does not wait on cold reads. 0 disables the read-ahead. Default is 4",
+        default=4,
+        type=int
+    )
+
+    parser.add_argument(
+        "--prefetch_mb",
+        help="MB of queued images read ahead at most at once (see --prefetch_depth). Default is 1024",
+        default=1024.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--plan",
+        help="Dry run: size the images from their headers, predict the runtime and peak memory of each from the logs "
+             "of earlier runs (--plan_history), and print the expected makespan with --nthreads and the suggested "
+             "SLURM allocation. Nothing is analysed.",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--plan_history",
+        help="JSON lines logs of earlier runs the --plan cost model is fit to, as globs (repeatable). Default is the "
+             "*.jsonl logs of the log directory and of <output_dir>/logs",
+        action="append",
+        default=None
+    )
+
+    parser.add_argument(
+        "--image_list",
+        help="File with the paths of the images to analyse, one per line (e.g. one shard written by cluster.py). "
+             "Default is all the images in the BIDS directory",
+        default=None
+    )
+
+    parser.add_argument(
+        "--voxel_dtype",
+        help="Floating point type used to compute the image metrics. float32 halves the memory used per image.",
+        choices=['float32', 'float64'],
+        default='float32'
+    )
+
+    parser.add_argument(
+        "--results_db",
+        help="SQLite database the results are upserted into, one row per image. Point several runs at the same "
+             "database to keep their results together. Default is results.sqlite in the output directory",
+        default=None
+    )
+
+    parser.add_argument(
+        "--results_export",
+        help="Export of the whole results database, as CSV, or Parquet if the name ends with .parquet (needs pyarrow). "
+             "Default is the database path with a .csv extension",
+        default=None
+    )
+
+    parser.add_argument(
+        "--status_file",
+        help="JSON file refreshed during the run with the queued, running, done and failed counts of each stage, the "
+             "throughput and the ETA. Default is run_analysis_<date>_status.json in the log directory",
+        default=None
+    )
+
+    parser.add_argument(
+        "--status_prom",
+        help="Prometheus textfile (e.g. in the node_exporter textfile directory) refreshed with the same status",
+        default=None
+    )
+
+    parser.add_argument(
+        "--status_interval",
+        help="Seconds between status refreshes. Default is 10",
+        default=10.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile the Python code of the run: the cProfile profiles of all the threads are merged into "
+             "<log>_profile.pstats, and <log>_profile.txt reports the slowest functions, the hot paths (calc_tsnr, "
+             "fd_jenkinson, ...) and the top memory allocations (tracemalloc). Slows the run down",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--timeout_factor",
+        help="A command (3dvolreg, 3dDespike, ...) is killed once it runs this many times longer than expected from "
+             "the size of its input (voxels times volumes), then restarted up to --max_retries times. 0 disables the "
+             "timeouts. Default is 5",
+        default=5.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--timeout_min",
+        help="Minimum timeout, in seconds, of a command (3dvolreg, 3dDespike, ...). Default is 300",
+        default=300.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--max_retries",
+        help="Number of times a timed out command (3dvolreg, 3dDespike, ...) is restarted before its image is marked "
+             "failed. Default is 1",
+        default=1,
+        type=int
     )
 
     settings = parser.parse_args()
 
+    workflows = ["func", "anat"] if "all" in settings.workflow else [w for w in ["func", "anat"]
+                                                                     if w in settings.workflow]
+
+    if settings.mem_budget is None and os.environ.get("SLURM_MEM_PER_NODE", "").isdigit():
+        settings.mem_budget = int(os.environ["SLURM_MEM_PER_NODE"]) / 1024.0
+
+    if settings.plan_history is None:
+        settings.plan_history = [os.path.join(settings.log_dir, "*.jsonl"),
+                                 os.path.join(settings.output_dir, "logs", "*.jsonl")]
+
+    if settings.results_db is None:
+        settings.results_db = os.path.join(settings.output_dir, "results.sqlite")
+
+    if settings.results_export is None:
+        settings.results_export = "{}.csv".format(os.path.splitext(settings.results_db)[0])
+
+    set_dtype_policy(voxel=settings.voxel_dtype)
+    set_timeout_policy(factor=settings.timeout_factor, minimum=settings.timeout_min, retries=settings.max_retries)
+    set_prefetch_policy(depth=settings.prefetch_depth, budget_mb=settings.prefetch_mb)
+
     if not os.path.isdir(settings.log_dir):
         create_path(settings.log_dir)
 
     date_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
+    if settings.status_file is None:
+        settings.status_file = os.path.join(settings.log_dir, "run_analysis_{}_status.json".format(date_str))
+
     # Configure logger
     log_fname = "run_analysis_{}.log".format(date_str)
     log_fpath = os.path.join(settings.log_dir, log_fname)
 
-    # Remove all handlers associated with the root logger object.
-    for handler in logging.root.handlers[:]:
-        handler.close()
-        logging.root.removeHandler(handler)
-
-    logging.basicConfig(
-        filename=log_fpath,
-        level=logging.DEBUG,
-        format='LOG ENTRY %(asctime)s - %(levelname)s \n%(message)s \nEND LOG ENTRY\n'
-    )
+    # Records go through a queue to a writer thread. The structured fields of each record are also written as JSON
+    # lines. The output of the tools is in the image folders, next to their results.
+    log_listener = start_logging(log_fpath, json_fpath="{}.jsonl".format(log_fpath[:-4]))
 
     settings_str = "Bids directory: {}\n".format(settings.bids_dir) + \
                    "Output directory: {}\n".format(settings.output_dir) + \
                    "Log directory: {}\n".format(settings.log_dir) + \
                    "No. of Threads: {}\n".format(settings.nthreads) + \
                    "Overwrite: {}\n".format(settings.overwrite) + \
-                   "Workflow: {}".format(settings.workflow)
+                   "Incremental: {}{}\n".format(settings.incremental,
+                                                 " (retrying failed images)" if settings.retry_failed else "") + \
+                   "Workflow: {}\n".format(", ".join(workflows)) + \
+                   "Image list: {}\n".format(settings.image_list) + \
+                   "Memory budget: {}\n".format("{:g} GB".format(settings.mem_budget) if settings.mem_budget
+                                                 else None) + \
+                   "Read-ahead: {} images, at most {:g} MB\n".format(settings.prefetch_depth, settings.prefetch_mb) + \
+                   "Voxel dtype: {}\n".format(settings.voxel_dtype) + \
+                   "Results database: {}\n".format(settings.results_db) + \
+                   "Results export: {}\n".format(settings.results_export) + \
+                   "Profile: {}\n".format(settings.profile) + \
+                   "Timeouts: {}x expected, at least {}s, {} retries\n".format(settings.timeout_factor,
+                                                                             settings.timeout_min,
+                                                                             settings.max_retries) + \
+                   "Status file: {}".format(settings.status_file)
 
     log_output(settings_str, logger=logging)
 
+    if settings.plan:
+
+        # Dry run: only the headers of the inputs are read, nothing is written to the output directory
+        model, history = model_from_logs(settings.plan_history)
+
+        items = []
+        steps = []
+
+        if "func" in workflows:
+
+            nii_imgs = _func_images(settings.bids_dir, settings.image_list, with_anat="anat" in workflows)
+
+            if settings.incremental:
+                manifest = AnalysisManifest(settings.output_dir, PIPELINE_VERSION, retry_failed=settings.retry_failed)
+                nii_imgs = [img for img, _ in manifest.schedule(dict((img, image_fingerprint(img))
+                                                                     for img in nii_imgs))]
+
+            items.extend(func_items(nii_imgs))
+            steps.extend(sorted(set(FUNC_STEPS)) + ["metrics"])
+
+        if "anat" in workflows:
+
+            items.extend(anat_items(glob(os.path.join(settings.bids_dir, "*", "*", "anat"))))
+
+            steps.extend(["anat_volreg", "anat_avg"])
+
+        stage = plan_stage(" + ".join(workflows), items, model, settings.nthreads)
+
+        plan_str = format_plan([stage], suggest_allocation([stage], max(settings.nthreads, 1)), model, steps, history)
+
+        log_output(plan_str, logger=logging)
+        log_output(plan_str)
+
+        stop_logging(log_listener)
+        sys.exit(0)
+
     log_output("Beginning analysis...", logger=logging)
 
-    # If analysis output directory exists, verify that it's either empty, or that overwrite is allowed.
-    # Otherwise create directory.
-    if os.path.isdir(settings.output_dir):
+    # If analysis output directory exists, verify that it's either empty, or that overwrite is allowed (an incremental
+    # run adds to it). Otherwise create directory.
+    if os.path.isdir(settings.output_dir) and not settings.incremental:
 
         analysis_files = glob(os.path.join(settings.output_dir, '*'))
 
@@ -109,66 +365,65 @@ if __name__ == "__main__":
             else:
                 rm_files = glob(os.path.join(settings.output_dir, '*'))
                 list(map(shutil.rmtree, rm_files))
-    else:
+    elif not os.path.isdir(settings.output_dir):
         create_path(settings.output_dir)
 
-    if settings.workflow == 'func':
+    # Started before the runner and the progress, so that their threads are profiled too
+    profiler = Profiler("{}_profile".format(log_fpath[:-4])).start() if settings.profile else None
+
+    progress = Progress("run_analysis", settings.status_file, prom_file=settings.status_prom,
+                        interval=settings.status_interval).start()
+
+    # The func images and the anat sessions share one runner, so they share its limits on commands, jobs and memory
+    runner = None
+
+    if settings.nthreads > 0:
+
+        mem_budget_mb = settings.mem_budget * 1024.0 - PLAN_POLICY["process_mb"] if settings.mem_budget else None
+
+        # The images are coroutines on the runner's event loop, not threads: only the image metrics take a (CPU) thread
+        # while they are computed
+        # The files of the next queued images are read ahead while the running ones are analysed
+        prefetcher = Prefetcher(logger=logging) if settings.prefetch_depth > 0 else None
+
+        runner = CommandRunner(max_procs=settings.nthreads, max_jobs=settings.nthreads, mem_budget_mb=mem_budget_mb,
+                               prefetcher=prefetcher)
+
+    # Predicted duration and peak memory of the items, from their headers and the logs of earlier runs. The longest
+    # items start first, so that none of them is left running alone at the end of the run.
+    model, _ = model_from_logs(settings.plan_history)
+
+    # (seconds, MB, workflow, item)
+    jobs = []
+
+    if "func" in workflows:
 
-        # Create summary file and add the header row
         summary_file = os.path.join(settings.output_dir, "Statistics.csv")
-        with open(summary_file, "w") as f:
-            f.write("Image,Mean tSNR,Pre-reg FWHM X,Pre-reg FWHM Y,Pre-reg FWHM Z,Pre-reg FWHM,"
-                    "Post-reg FWHM X,Post-reg FWHM Y,Post-reg FWHM Z,Post-reg FWHM,Mean FD (mm),"
-                    "No. FD > 0.2mm,% FD > 0.2mm\n")
 
-        # Get all the Nifti images from the BIDS directory
-        nii_imgs = glob(os.path.join(settings.bids_dir, "*", "*", "*", "*.nii*"))
+        nii_imgs = _func_images(settings.bids_dir, settings.image_list, with_anat="anat" in workflows)
 
-        analysis_results = {}
+        # Fingerprints (size, mtime, header hash) of the images as they are analysed, recorded in the manifest
+        manifest = AnalysisManifest(settings.output_dir, PIPELINE_VERSION, retry_failed=settings.retry_failed)
+        fingerprints = dict((img, image_fingerprint(img)) for img in nii_imgs)
 
-        if settings.nthreads > 0:
+        if settings.incremental:
 
-            futures = []
-            with ThreadPoolExecutor(max_workers=settings.nthreads) as executor:
-                for img in nii_imgs:
-                    futures.append(executor.submit(seven_tesla_wf, img, settings.output_dir, logging, tsnr_semaphore))
+            scheduled = manifest.schedule(fingerprints)
+            nii_imgs = [img for img, _ in scheduled]
 
-            wait(futures)
-            for future in futures:
-                clean_fname, statistics = future.result()
-                analysis_results[clean_fname] = statistics
+            log_output("Incremental analysis: {} of {} images to analyse (pipeline version {})\n{}".format(
+                len(scheduled), len(fingerprints), PIPELINE_VERSION,
+                "\n".join("{} ({})".format(img, reason) for img, reason in scheduled)), logger=logging)
 
-        else:
-            for img in nii_imgs:
-                clean_fname, statistics = seven_tesla_wf(img, settings.output_dir, logger=logging)
-                analysis_results[clean_fname] = statistics
+        jobs.extend(item_cost(model, steps) + ("func", img) for img, (_, steps) in zip(nii_imgs,
+                                                                                       func_items(nii_imgs)))
 
-        sorted_results = OrderedDict(sorted(analysis_results.items(), key=lambda t: t[0]))
-
-        # Write results to summary file
-        with open(summary_file, "a") as f:
-            for clean_fname, statistics in sorted_results.items():
-
-                if statistics is None:
-                    f.write("{},None,None,None,None,None,None,None,None,None,None,None,None\n".format(clean_fname))
-                else:
-                    f.write("{},{},{},{},{},{},{},{},{},{},{},{},{}\n".format(
-                        clean_fname,
-                        statistics['tsnr_val'],
-                        statistics['prereg_fwhm_x'],
-                        statistics['prereg_fwhm_y'],
-                        statistics['prereg_fwhm_z'],
-                        statistics['prereg_fwhm_combined'],
-                        statistics['postreg_fwhm_x'],
-                        statistics['postreg_fwhm_y'],
-                        statistics['postreg_fwhm_z'],
-                        statistics['postreg_fwhm_combined'],
-                        statistics['mean_fd'],
-                        statistics['num_fd_above_cutoff'],
-                        statistics['perc_fd_above_cutoff']
-                    ))
-
-    elif settings.workflow == 'anat':
+        analysis_results = {}
+        analysis_date = datetime.now().isoformat()
+
+        progress.queued("func", len(nii_imgs))
+
+    if "anat" in workflows:
 
         anat_output_dir = os.path.join(settings.output_dir, "anat_results")
 
@@ -177,16 +432,83 @@ if __name__ == "__main__":
 
         session_dirs = glob(os.path.join(settings.bids_dir, "*", "*", "anat"))
 
-        for session_dir in session_dirs:
+        # Each session is a job of its own. Sessions without a first run are not costed, their workflow fails.
+        session_steps = dict(anat_items(session_dirs))
+
+        jobs.extend((item_cost(model, session_steps[session_dir]) if session_dir in session_steps else (0.0, 0.0)) +
+                    ("anat", session_dir) for session_dir in session_dirs)
+
+        progress.queued("anat", len(session_dirs))
+
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    if runner:
+
+        futures = []
+
+        for seconds, mb, workflow, item in jobs:
+            if workflow == "func":
+                future = runner.submit_job(progress.atrack, "func", seven_tesla_wf_async, item, settings.output_dir,
+                                           logging, runner=runner, nbytes=os.path.getsize(item),
+                                           succeeded=lambda result: result[1] is not None, job_seconds=seconds,
+                                           job_mb=mb, job_inputs=[item])
+            else:
+                future = runner.submit_job(_anat_session, progress, item, anat_output_dir, runner=runner,
+                                           job_seconds=seconds, job_mb=mb,
+                                           job_inputs=sorted(glob(os.path.join(item, "*.nii*"))))
+            futures.append(future)
+
+        # Every command of a workflow has a timeout, so every image finishes (or fails) in bounded time. An image
+        # whose workflow raised is recorded as failed, the others keep their results.
+        for (_, _, workflow, item), future in zip(jobs, futures):
+            if workflow == "func":
+                clean_fname, statistics = _collect(item, future.result)
+                analysis_results[clean_fname] = statistics
+                manifest.record(item, statistics is not None, analysis_date, fingerprint=fingerprints[item])
+            else:
+                future.result()
+
+        runner.close()
+
+    else:
+
+        for _, _, workflow, item in jobs:
+            if workflow == "func":
+                clean_fname, statistics = _collect(item, progress.track, "func", seven_tesla_wf, item,
+                                                   settings.output_dir, logger=logging, nbytes=os.path.getsize(item),
+                                                   succeeded=lambda result: result[1] is not None)
+                analysis_results[clean_fname] = statistics
+                manifest.record(item, statistics is not None, analysis_date, fingerprint=fingerprints[item])
+            else:
+                default_runner().run_sync(_anat_session(progress, item, anat_output_dir))
+
+    if "func" in workflows:
+
+        # Rows of the images analysed now replace (or are added to) the rows of an incremental run's Statistics.csv
+        rows = {}
+
+        if settings.incremental and os.path.isfile(summary_file):
+            rows = read_statistics(summary_file)
+
+        rows.update((clean_fname, statistics_row(statistics)) for clean_fname, statistics in analysis_results.items())
+
+        write_statistics(summary_file, rows)
+
+        manifest.save()
+
+        results_db = ResultsDB(settings.results_db, [key for key, _ in STATISTICS_COLUMNS])
+        results_db.upsert(analysis_results, analysis_date)
+        results_db.export(settings.results_export)
+        results_db.close()
+
+        log_output("Results saved to {} and exported to {}".format(settings.results_db, settings.results_export),
+                   logger=logging)
 
-            status = anat_average_wf(session_dir, anat_output_dir, logger=logging)
+    progress.stop()
 
-            if not status:
-                log_output("Error analyzing anatomical images in folder {}".format(session_dir), logger=logging)
+    if profiler:
+        log_output("Profile saved to {} (python -m pstats), report in {}".format(*profiler.stop()), logger=logging)
 
     log_output("Analysis complete!", logger=logging)
 
-    # Remove all handlers associated with the root logger object.
-    for handler in logging.root.handlers[:]:
-        handler.close()
-        logging.root.removeHandler(handler)
+    stop_logging(log_listener)
@@ -0,0 +1,267 @@
+import os
+import time
+import signal
+import itertools
+import asyncio
+from subprocess import CalledProcessError, Popen, STDOUT
+from functools import partial
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from utils import log_output
+from scheduling import BackfillPolicy
+
+
+# Runs the external tools (AFNI, dcm2niix, Dimon) on a single asyncio event loop in a background thread. A command
+# waiting on its process costs a coroutine instead of a blocked thread, so any number of images can be in flight. The
+# output (stdout and stderr) of every command goes straight to a file while it runs, nothing is buffered in memory;
+# only its tail is read back when the command fails.
+
+# Bytes of output kept in the error message of a failed command
+OUTPUT_TAIL_BYTES = 4096
+
+# max_procs: commands the shared runner (default_runner) runs at once, None: one per core. gen_bids.py sets it from
+# --nthreads before the runner is first used.
+RUNNER_POLICY = {
+    "max_procs": None
+}
+
+
+def set_runner_policy(max_procs=None):
+
+    if max_procs is not None:
+        RUNNER_POLICY["max_procs"] = max(int(max_procs), 1)
+
+
+class CommandTimeout(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def output_tail(fpath, nbytes=OUTPUT_TAIL_BYTES):
+
+    try:
+        with open(fpath, "rb") as infile:
+            infile.seek(0, os.SEEK_END)
+            infile.seek(max(infile.tell() - nbytes, 0))
+            return infile.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return ""
+
+
+def _reap(proc):
+
+    # Waits for proc like Popen.wait, and also returns its peak resident memory in MB (ru_maxrss is in kB on Linux)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    return proc.returncode, usage.ru_maxrss / 1024.0
+
+
+class CommandRunner(object):
+
+    # max_procs: commands running at once, max_jobs: jobs (e.g. the workflow of one image) in flight at once,
+    # cpu_workers: threads running the Python steps of the jobs (the image metrics), mem_budget_mb: memory the jobs in
+    # flight may use together, from the peak memory predicted for each (see BackfillPolicy), prefetcher: a Prefetcher
+    # reading the inputs of the next queued jobs ahead (owned by the runner, closed with it)
+    def __init__(self, max_procs=None, max_jobs=None, cpu_workers=None, mem_budget_mb=None, prefetcher=None):
+        self.max_procs = max_procs or cpu_count()
+        self.max_jobs = max_jobs or self.max_procs
+
+        # Only used on the loop
+        self.admission = BackfillPolicy(self.max_jobs, mem_budget_mb)
+        self.admission_waiters = {}
+        self.admission_inputs = {}
+        self.prefetcher = prefetcher
+
+        self.executor = ThreadPoolExecutor(max_workers=cpu_workers or cpu_count())
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run_loop, name="command-runner")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # The limit belongs to the loop, it is created on it
+        self.procs = self.run_sync(self._create_limit())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create_limit(self):
+        return asyncio.Semaphore(self.max_procs)
+
+    # Coroutines, to be awaited on the runner's loop
+
+    async def run(self, cmd, cwd=None, output_file=os.devnull, timeout=None, retries=0, env=None, logger=None):
+
+        # Returns the peak resident memory of the command in MB. Raises CalledProcessError (with the tail of the output)
+        # if cmd fails. A command running longer than timeout seconds is killed, together with any process it started,
+        # and restarted at most retries times before CommandTimeout is raised. A cancelled command is killed as well.
+        for attempt in range(retries + 1):
+
+            async with self.procs:
+
+                with open(output_file, "wb") as outfile:
+                    proc = Popen(cmd, cwd=cwd, env=env, stdout=outfile, stderr=STDOUT, start_new_session=True)
+
+                # The wait outlives a timeout or a cancellation (shield): the process is reaped once, by it
+                exited = self._wait(proc)
+
+                try:
+                    returncode, max_rss_mb = await asyncio.wait_for(asyncio.shield(exited), timeout)
+                except asyncio.TimeoutError:
+                    await self._kill(proc, exited)
+                except asyncio.CancelledError:
+                    await self._kill(proc, exited)
+                    raise
+                else:
+                    break
+
+            if attempt < retries:
+                log_output("{} did not finish within {:g}s, killed and restarted (retry {} of {}). Command:\n{}".format(
+                    cmd[0], timeout, attempt + 1, retries, " ".join(cmd)), level="WARNING", logger=logger)
+
+        else:
+            raise CommandTimeout("{} did not finish within {:g}s in {} attempt(s), killed. Command:\n{}".format(
+                cmd[0], timeout, retries + 1, " ".join(cmd)))
+
+        if returncode:
+            raise CalledProcessError(returncode, cmd, output=output_tail(output_file))
+
+        return max_rss_mb
+
+    def _wait(self, proc):
+
+        # Returns a future of the return code and the peak resident memory (MB) of the process, on the loop. The exit
+        # of the process is watched through a pidfd by the loop's selector (Linux 5.3+), no thread waits for it.
+        # Elsewhere (no os.pidfd_open, or a kernel without pidfd_open: ENOSYS) a thread of the default executor does.
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            return self.loop.run_in_executor(None, _reap, proc)
+
+        exited = self.loop.create_future()
+
+        def on_exit():
+
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+
+            # Only reaps the process, it has exited
+            try:
+                exited.set_result(_reap(proc))
+            except OSError as e:
+                exited.set_exception(e)
+
+        self.loop.add_reader(pidfd, on_exit)
+
+        return exited
+
+    async def _kill(self, proc, exited):
+
+        # exited: the future of _wait(proc), which reaps the process once it is killed
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        await exited
+
+    async def in_executor(self, fn, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    async def job(self, coro_fn, *args, job_seconds=0.0, job_mb=0.0, job_inputs=(), **kwargs):
+
+        # Jobs start in submission order, within max_jobs and the memory budget. job_seconds and job_mb are the
+        # predicted duration and peak memory of the job, they let smaller jobs start while a large one waits for memory.
+        # job_inputs: the files the job reads first, prefetched while it waits.
+        key = object()
+        admitted = self.loop.create_future()
+
+        self.admission_waiters[key] = admitted
+        self.admission_inputs[key] = list(job_inputs)
+        self.admission.add(key, job_seconds, job_mb)
+        self._admit()
+
+        try:
+            await admitted
+            return await coro_fn(*args, **kwargs)
+        finally:
+            self.admission.remove(key)
+            self.admission_waiters.pop(key, None)
+            inputs = self.admission_inputs.pop(key)
+            if self.prefetcher:
+                self.prefetcher.release(inputs)
+            self._admit()
+
+    def _admit(self):
+
+        for key in self.admission.admit(time.time()):
+            admitted = self.admission_waiters.pop(key)
+            # A cancelled job is removed from the policy once its task resumes
+            if not admitted.done():
+                admitted.set_result(None)
+            if self.prefetcher:
+                self.prefetcher.release(self.admission_inputs[key])
+
+        # The next jobs to start are the first waiting ones
+        if self.prefetcher and self.admission.pending:
+            self.prefetcher.want([self.admission_inputs[key] for key in
+                                  itertools.islice(self.admission.pending, self.prefetcher.depth)])
+
+    # Thread-safe entry points, usable from any thread but the runner's
+
+    def submit(self, coro):
+        # Returns a concurrent.futures.Future, cancelling it cancels the coroutine (and kills its command)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit_job(self, coro_fn, *args, **kwargs):
+        return self.submit(self.job(coro_fn, *args, **kwargs))
+
+    def run_sync(self, coro):
+        return self.submit(coro).result()
+
+    def call(self, cmd, **kwargs):
+        return self.run_sync(self.run(cmd, **kwargs))
+
+    async def _cancel_all(self):
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled commands to be killed
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel_all(self):
+        self.run_sync(self._cancel_all())
+
+    def close(self, cancel=False):
+
+        if not self.loop.is_running():
+            return
+
+        if cancel:
+            self.cancel_all()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+
+        if self.prefetcher:
+            self.prefetcher.close()
+
+
+_default_runner = None
+_default_lock = Lock()
+
+
+def default_runner():
+
+    # Shared by the callers that are not handed a runner, started on first use
+    global _default_runner
+
+    with _default_lock:
+        if _default_runner is None:
+            _default_runner = CommandRunner(max_procs=RUNNER_POLICY["max_procs"])
+
+    return _default_runner
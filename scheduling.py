@@ -0,0 +1,234 @@
+import os
+import time
+from threading import Condition
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import log_output
+
+
+class AdaptiveLimiter(object):
+
+    # Concurrency limit for one pipeline stage. The limit is tuned between minimum and maximum by hill climbing on the
+    # throughput measured over consecutive windows (work units completed per second, e.g. MB extracted or series
+    # converted): a step that improved throughput is repeated, otherwise the direction is reversed.
+
+    def __init__(self, name, initial, minimum=1, maximum=None, window=10.0, tolerance=0.05, logger=None):
+        self.name = name
+        self.maximum = max(maximum or initial, 1)
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+        self.tolerance = tolerance
+        self.logger = logger
+
+        self.active = 0
+        self.cond = Condition()
+
+        self.window_units = 0.0
+        self.window_completions = 0
+        self.window_start = time.time()
+        self.last_throughput = None
+        self.step = 1
+        self.hold = False
+
+    def acquire(self):
+
+        # Blocks while the stage is at its limit, which is what back-pressures whoever submits work to it
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, units=1.0):
+
+        with self.cond:
+            self.active -= 1
+            self.window_units += units
+            self.window_completions += 1
+
+            elapsed = time.time() - self.window_start
+
+            # Only judge a window once it is long enough and at least one full round of work completed in it
+            if elapsed >= self.window and self.window_completions >= self.limit:
+                self._adjust(self.window_units / elapsed)
+                self.window_units = 0.0
+                self.window_completions = 0
+                self.window_start = time.time()
+
+            self.cond.notify_all()
+
+    def _adjust(self, throughput):
+
+        if self.hold:
+            # First window after stepping back from a worse limit: only re-measure the baseline
+            self.hold = False
+            self.last_throughput = throughput
+            return
+
+        if self.last_throughput is not None and throughput < self.last_throughput * (1.0 + self.tolerance):
+            self.step = -self.step
+
+            if throughput < self.last_throughput * (1.0 - self.tolerance):
+                # The last step made things worse: undo it and stay there for a window
+                self.hold = True
+
+        new_limit = min(max(self.limit + self.step, self.minimum), self.maximum)
+
+        if new_limit == self.limit:
+            # Reached a bound, explore the other direction next time
+            self.step = -self.step
+        else:
+            log_output("{} stage: {:.2f} units/s with {} workers, limit set to {}.".format(
+                self.name, throughput, self.limit, new_limit), level="DEBUG", logger=self.logger)
+
+        self.limit = new_limit
+        self.last_throughput = throughput
+
+
+class Stage(object):
+
+    # A thread pool whose number of running tasks is bounded by an AdaptiveLimiter. submit() blocks until the stage
+    # has a free slot. With a Progress, tasks are reported as items of the stage named progress_stage (queuing them is
+    # up to the caller, who knows how many there will be).
+
+    def __init__(self, limiter, progress=None, progress_stage=None, succeeded=None):
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=limiter.maximum)
+        self.progress = progress
+        self.progress_stage = progress_stage or limiter.name.lower()
+        self.succeeded = succeeded
+
+    def submit(self, fn, *args, **kwargs):
+
+        units = kwargs.pop("units", 1.0)
+        nbytes = kwargs.pop("nbytes", 0)
+
+        if self.progress:
+            kwargs["nbytes"] = nbytes
+            kwargs["succeeded"] = self.succeeded
+            args = (self.progress_stage, fn) + args
+            fn = self.progress.track
+
+        self.limiter.acquire()
+
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.limiter.release(0.0)
+            raise
+
+        future.add_done_callback(
+            lambda f: self.limiter.release(units if not f.cancelled() and f.exception() is None else 0.0))
+
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+
+def file_size_mb(fpath):
+    try:
+        return os.path.getsize(fpath) / (1024.0 * 1024.0)
+    except OSError:
+        return 0.0
+
+
+class BackfillPolicy(object):
+
+    # Admission of jobs with a predicted duration (seconds) and peak memory (MB): at most slots jobs run at once, and
+    # their memory stays within budget_mb (None: no budget). Jobs start in the order they were added. When the first
+    # waiting job does not fit yet, a later one may start in its place (backfill) if it fits now and either ends before
+    # the first one could start (its shadow time, from the predicted ends of the running jobs) or only uses memory the
+    # first one will not need, so backfilling never delays it. A job larger than the budget starts once nothing else
+    # runs. Without backfill the jobs start strictly in order. Not thread-safe: the caller serializes the calls (e.g. on
+    # an event loop).
+
+    def __init__(self, slots, budget_mb=None, backfill=True):
+        self.slots = max(slots, 1)
+        self.budget_mb = budget_mb
+        self.backfill = backfill
+        self.pending = OrderedDict()
+        self.running = {}
+
+    def add(self, key, seconds=0.0, mb=0.0):
+        self.pending[key] = (seconds or 0.0, mb or 0.0)
+
+    def remove(self, key):
+        self.pending.pop(key, None)
+        self.running.pop(key, None)
+
+    def finish(self, key):
+        self.running.pop(key, None)
+
+    def _free_mb(self):
+        if self.budget_mb is None:
+            return float("inf")
+        return self.budget_mb - sum(mb for _, mb in self.running.values())
+
+    def _fits(self, mb):
+        return mb <= self._free_mb() or not self.running
+
+    def _shadow(self, mb, now):
+
+        # Predicted time at which a job of mb could start, and the memory and slots it leaves free then
+        free_mb = self._free_mb()
+        slots = self.slots - len(self.running)
+
+        for end, job_mb in sorted((max(end, now), job_mb) for end, job_mb in self.running.values()):
+            free_mb += job_mb
+            slots += 1
+            if slots > 0 and free_mb >= mb:
+                return end, free_mb - mb, slots - 1
+
+        return now, 0.0, 0
+
+    def admit(self, now):
+
+        # The keys of the jobs to start now
+        started = []
+
+        while self.pending and len(self.running) < self.slots:
+
+            key, (seconds, mb) = next(iter(self.pending.items()))
+
+            if not self._fits(mb):
+                break
+
+            del self.pending[key]
+            self.running[key] = (now + seconds, mb)
+            started.append(key)
+
+        if not self.backfill or not self.pending or len(self.running) >= self.slots:
+            return started
+
+        # The first waiting job does not fit: backfill
+        shadow, extra_mb, extra_slots = self._shadow(next(iter(self.pending.values()))[1], now)
+
+        for key, (seconds, mb) in list(self.pending.items())[1:]:
+
+            if len(self.running) >= self.slots:
+                break
+
+            if mb > self._free_mb():
+                continue
+
+            if now + seconds <= shadow:
+                pass
+            elif mb <= extra_mb and extra_slots > 0:
+                extra_mb -= mb
+                extra_slots -= 1
+            else:
+                continue
+
+            del self.pending[key]
+            self.running[key] = (now + seconds, mb)
+            started.append(key)
+
+        return started
@@ -0,0 +1,80 @@
+import os
+
+
+# Timeouts of the external commands, scaled from the size of their input. A command running far longer than expected
+# for its input (a hung 3dvolreg or dcm2niix) is killed and retried, and its item fails if it times out again.
+
+# Expected seconds per unit of input of each step: per million voxels (times volumes) of the input image for the AFNI
+# programs, per DICOM file for the converters. Estimated on the slow side.
+EXPECTED_SECONDS = {
+    "despike": 1.0,
+    "tshift": 0.5,
+    "fwhm": 0.5,
+    "volreg": 2.0,
+    "automask": 0.2,
+    "anat_volreg": 10.0,
+    "anat_avg": 0.5,
+    "dcm2niix": 0.1,
+    "dimon": 0.2
+}
+
+# Commands of the func workflow, in order
+FUNC_STEPS = ["despike", "tshift", "fwhm", "volreg", "fwhm", "automask"]
+
+# timeout = max(factor * expected duration, minimum) seconds, a factor of 0 disables the timeouts. A command that times
+# out is restarted at most retries times.
+TIMEOUT_POLICY = {
+    "factor": 5.0,
+    "minimum": 300.0,
+    "retries": 1
+}
+
+
+def set_timeout_policy(factor=None, minimum=None, retries=None):
+
+    if factor is not None:
+        TIMEOUT_POLICY["factor"] = float(factor)
+    if minimum is not None:
+        TIMEOUT_POLICY["minimum"] = float(minimum)
+    if retries is not None:
+        TIMEOUT_POLICY["retries"] = max(int(retries), 0)
+
+
+def step_timeout(step, units):
+
+    if not TIMEOUT_POLICY["factor"]:
+        return None
+
+    return max(TIMEOUT_POLICY["factor"] * EXPECTED_SECONDS[step] * units, TIMEOUT_POLICY["minimum"])
+
+
+def expected_duration(steps, units):
+    return sum(EXPECTED_SECONDS[step] for step in steps) * units
+
+
+def func_cost(fpath):
+    # Expected seconds of the external commands of the func workflow of an image
+    return expected_duration(FUNC_STEPS, nifti_units(fpath))
+
+
+def nifti_units(fpath):
+
+    # Millions of voxels times volumes, read from the header only
+    import nibabel as nib
+    from nibabel.filebasedimages import ImageFileError
+
+    try:
+        shape = nib.load(fpath).shape
+    except (ImageFileError, IOError, OSError, ValueError):
+        # Unreadable header: about one compressed byte per voxel
+        return os.path.getsize(fpath) / 1e6
+
+    units = 1.0
+    for dim in shape:
+        units *= dim
+
+    return units / 1e6
+
+
+def dicom_units(dcm_dir):
+    return len([f for f in os.listdir(dcm_dir) if ".dcm" in f])
@@ -1,34 +1,21 @@
 import os
+import time
 import errno
 import tarfile
-import dicom
+import hashlib
 import re
+import logging
+from profiling import hot_path
 
 
-def log_output(log_str, level="INFO", logger=None, semaphore=None):
-
-    if semaphore:
-        semaphore.acquire()
+def log_output(log_str, level="INFO", logger=None, **fields):
 
+    # fields: structured fields of the record (image, step, duration, returncode, ...), see log_pipeline.FIELDS
     if logger:
-
-        if level == 'DEBUG':
-            logger.debug(log_str)
-        elif level == 'WARNING':
-            logger.warning(log_str)
-        elif level == 'CRITICAL':
-            logger.critical(log_str)
-        elif level == 'ERROR':
-            logger.error(log_str)
-        elif level == 'INFO':
-            logger.info(log_str)
-
+        logger.log(getattr(logging, level), log_str, extra=fields or None)
     else:
         print(log_str)
 
-    if semaphore:
-        semaphore.release()
-
 
 def create_path(path):
     try:
@@ -38,11 +25,13 @@ def create_path(path):
             raise
 
 
-def extract_tgz(fpath, out_path='.', logger=None, semaphore=None):
+def extract_tgz(fpath, out_path='.', logger=None):
 
     if not tarfile.is_tarfile(fpath):
         raise tarfile.TarError("{} is not a valid tar/gzip file.".format(fpath))
 
+    start = time.time()
+
     tar = tarfile.open(fpath, "r:gz")
     scans_folder = tar.next().name
     tar.extractall(path=out_path)
@@ -55,11 +44,14 @@ def extract_tgz(fpath, out_path='.', logger=None, semaphore=None):
     else:
         extracted_dir = extracted_dir.format(os.path.join(out_path, scans_folder))
 
-    log_output("Extracted file {} to {} directory.".format(fpath, extracted_dir), logger=logger, semaphore=semaphore)
+    log_output("Extracted file {} to {} directory.".format(fpath, extracted_dir), logger=logger,
+               image=os.path.basename(fpath), step="extract", units=round(os.path.getsize(fpath) / 1e6, 3),
+               duration=round(time.time() - start, 2))
 
     return extracted_dir
 
 
+@hot_path("filter_series")
 def filter_series(scan_dir, filters=None, logger=None):
 
     if filters:
@@ -74,9 +66,11 @@ def filter_series(scan_dir, filters=None, logger=None):
 
             if scan_filter == "sequences":
 
+                import pydicom
+
                 # Pick an arbitrary DICOM file from the current scan folder, and retrieve the sequence
                 # name
-                curr_dcm = dicom.read_file(os.path.join(scan_dir, dcm_files[0]))
+                curr_dcm = pydicom.dcmread(os.path.join(scan_dir, dcm_files[0]))
                 try:
                     seq_name = curr_dcm.SequenceName
                 except AttributeError:
@@ -100,10 +94,59 @@ def filter_series(scan_dir, filters=None, logger=None):
     return False
 
 
+def fingerprint_series(scan_dir):
+
+    # Cheap fingerprint of a DICOM series: the sorted list of DICOM files together with their sizes and modification
+    # times. tarfile restores member mtimes on extraction, so re-extracting an unchanged archive keeps the fingerprint.
+    dcm_files = sorted(f for f in os.listdir(scan_dir) if ".dcm" in f)
+
+    sha = hashlib.sha1()
+
+    for dcm_file in dcm_files:
+        st = os.stat(os.path.join(scan_dir, dcm_file))
+        sha.update("{}:{}:{}\n".format(dcm_file, st.st_size, int(st.st_mtime)).encode("utf-8"))
+
+    return "{}:{}".format(len(dcm_files), sha.hexdigest())
+
+
+# Archives and DICOM files are hashed in chunks of this size, so memory use does not depend on the file size
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def hash_file(fpath, sha=None, chunk_size=HASH_CHUNK_SIZE):
+
+    digest = sha is None
+
+    if digest:
+        sha = hashlib.sha1()
+
+    with open(fpath, "rb") as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest() if digest else sha
+
+
+def hash_series(scan_dir):
+
+    # Content hash of all the DICOM files of a series
+    sha = hashlib.sha1()
+
+    for dcm_file in sorted(f for f in os.listdir(scan_dir) if ".dcm" in f):
+        hash_file(os.path.join(scan_dir, dcm_file), sha=sha)
+
+    return sha.hexdigest()
+
+
+def series_size_mb(scan_dir):
+    return sum(os.path.getsize(os.path.join(scan_dir, f)) for f in os.listdir(scan_dir)) / (1024.0 * 1024.0)
+
+
 def clean(var_str):
     return re.sub('\W|^(?=\d)', '_', var_str)
 
 
+@hot_path("get_scanner_meta")
 def get_scanner_meta(scan_dir):
 
     series_file = os.path.join(scan_dir, "README-Series.txt")
@@ -0,0 +1,140 @@
+import os
+from threading import Lock
+from collections import OrderedDict
+
+
+# Decoded voxel arrays shared between the steps of a workflow, so each image is read (and gunzipped) once. Entries are
+# keyed by path, modification time and size, so a file rewritten by a later step is read again. Arrays are handed out as
+# read-only views; uncompressed NIfTI files are memory-mapped by nibabel instead of read into memory.
+# An image can be requested in a given dtype: the scale factors are then applied in that dtype rather than through
+# nibabel's float64 result, and each dtype is cached separately.
+
+DEFAULT_MAX_MB = 2048
+
+
+def decode(img, dtype=None):
+
+    import numpy as np
+
+    if dtype is None:
+        return np.asanyarray(img.dataobj)
+
+    dataobj = img.dataobj
+
+    if not hasattr(dataobj, "get_unscaled"):
+        return np.asarray(dataobj, dtype=dtype)
+
+    raw = dataobj.get_unscaled()
+    slope, inter = float(dataobj.slope), float(dataobj.inter)
+
+    # Unscaled data already in the requested dtype is used as is (memory-mapped if the file is uncompressed)
+    if raw.dtype == dtype and slope == 1.0 and inter == 0.0:
+        return raw
+
+    data = raw.astype(dtype)
+
+    if slope != 1.0:
+        data *= slope
+    if inter != 0.0:
+        data += inter
+
+    return data
+
+
+def _nbytes(data):
+    import numpy as np
+    return 0 if isinstance(data, np.memmap) else data.nbytes
+
+
+class VolumeStore(object):
+
+    def __init__(self, max_mb=DEFAULT_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.load_locks = {}
+
+    @staticmethod
+    def _key(fpath, dtype):
+        import numpy as np
+        fpath = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        return fpath, stat.st_mtime, stat.st_size, np.dtype(dtype).str if dtype is not None else None
+
+    def load(self, fpath, dtype=None):
+
+        # Returns (image, data): the nibabel image (for its header and affine) and a read-only view of its data
+        key = self._key(fpath, dtype)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                img, data = self.entries[key]
+                return img, data.view()
+            load_lock = self.load_locks.setdefault(key[0], Lock())
+
+        # Concurrent loads of the same file wait for the first one instead of decoding it again
+        with load_lock:
+
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    img, data = self.entries[key]
+                    return img, data.view()
+
+            import nibabel as nb
+            img = nb.load(key[0])
+            data = decode(img, dtype)
+            data.flags.writeable = False
+
+            self._add(key, img, data)
+
+        return img, data.view()
+
+    def get(self, fpath, dtype=None):
+        return self.load(fpath, dtype)[1]
+
+    def _add(self, key, img, data):
+
+        # Memory-mapped arrays are backed by the page cache and do not count against the budget
+        size = _nbytes(data)
+
+        with self.lock:
+
+            # Entries of an older version of the file
+            for old_key in [k for k in self.entries if k[0] == key[0] and k[1:3] != key[1:3]]:
+                self._remove(old_key)
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (img, data)
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, data = self.entries.pop(key)
+        self.nbytes -= _nbytes(data)
+
+    def release(self, path_prefix):
+
+        # Drops every entry under path_prefix, e.g. the working directory of an image once its workflow is done
+        path_prefix = os.path.abspath(path_prefix)
+
+        with self.lock:
+            for key in [k for k in self.entries if k[0].startswith(path_prefix)]:
+                self._remove(key)
+            for fpath in [f for f in self.load_locks if f.startswith(path_prefix)]:
+                del self.load_locks[fpath]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.load_locks.clear()
+            self.nbytes = 0
+
+
+VOLUMES = VolumeStore()
@@ -1,20 +1,129 @@
 import os
-from subprocess import CalledProcessError, check_output, STDOUT
+import csv
+import time
+import asyncio
+from subprocess import CalledProcessError
 from utils import log_output, create_path
-from algorithms import calc_tsnr, parse_fwhm, fd_jenkinson, extract_fd_results
+from runner import CommandTimeout, default_runner
+from timeouts import TIMEOUT_POLICY, step_timeout, nifti_units
+from algorithms import calc_epi_metrics, parse_fwhm, fd_jenkinson, extract_fd_results
+from volumes import VOLUMES
 from collections import OrderedDict
 from glob import glob
 from string import ascii_lowercase
 
 
+# Columns of Statistics.csv: key in the statistics record returned by seven_tesla_wf, and header
+STATISTICS_COLUMNS = [
+    ('tsnr_val', 'Mean tSNR'),
+    ('prereg_fwhm_x', 'Pre-reg FWHM X'),
+    ('prereg_fwhm_y', 'Pre-reg FWHM Y'),
+    ('prereg_fwhm_z', 'Pre-reg FWHM Z'),
+    ('prereg_fwhm_combined', 'Pre-reg FWHM'),
+    ('postreg_fwhm_x', 'Post-reg FWHM X'),
+    ('postreg_fwhm_y', 'Post-reg FWHM Y'),
+    ('postreg_fwhm_z', 'Post-reg FWHM Z'),
+    ('postreg_fwhm_combined', 'Post-reg FWHM'),
+    ('mean_fd', 'Mean FD (mm)'),
+    ('num_fd_above_cutoff', 'No. FD > 0.2mm'),
+    ('perc_fd_above_cutoff', '% FD > 0.2mm'),
+    ('gs_drift', 'GS drift (%)'),
+    ('mean_dvars', 'Mean DVARS'),
+    ('max_dvars', 'Max DVARS'),
+    ('mean_outlier_frac', 'Mean outlier fraction'),
+    ('max_outlier_frac', 'Max outlier fraction'),
+    ('gsr', 'GSR')
+]
+
+# Version of the func analysis recorded in the manifest of the output directory. Bump it when the commands or the
+# metrics change, so that run_analysis.py --incremental reanalyses the images analysed with the previous version.
+PIPELINE_VERSION = "2.0"
+
+
+def statistics_row(statistics):
+    # Row of Statistics.csv (by header) of the statistics returned by seven_tesla_wf, None for a failed image
+    return dict((header, "None" if statistics is None else str(statistics[key])) for key, header in STATISTICS_COLUMNS)
+
+
+def read_statistics(fpath):
+
+    # Rows of a Statistics.csv file by image. Columns it lacks (written by an older version) are written as None.
+    with open(fpath, "r") as infile:
+        return dict((row["Image"], row) for row in csv.DictReader(infile))
+
+
+def write_statistics(fpath, rows):
+
+    # Written to a temporary file first, so an interrupted write keeps the previous Statistics.csv
+    tmp_fpath = "{}.tmp".format(fpath)
+
+    with open(tmp_fpath, "w") as outfile:
+        outfile.write("Image,{}\n".format(",".join(header for _, header in STATISTICS_COLUMNS)))
+        for image in sorted(rows):
+            outfile.write("{},{}\n".format(image, ",".join(rows[image].get(header) or "None"
+                                                           for _, header in STATISTICS_COLUMNS)))
+
+    os.replace(tmp_fpath, fpath)
+
+
 LOG_MESSAGES = {
     "success": "Command:\n{}\nReturn Code:\n{}\n",
     "output": "Output:\n{}\n",
-    "error": "Error running {}.\nCommand:\n{}\nReturn Code:\n\{}\n"
+    "error": "Error running {}.\nCommand:\n{}\nReturn Code:\n\{}\n",
+    "timeout": "Timeout running {}.\n{}\n"
 }
 
 
-def seven_tesla_wf(in_file, out_dir, logger=None, semaphore=None):
+async def _run_command(runner, cmd, cwd, output_file, image=None, step=None, units=None, logger=None):
+
+    # Runs one step of a workflow, on an input of the given size (units, see timeouts.py). Its output goes to
+    # output_file (referenced from the log, only the end of the output of a failed command is logged). Returns whether
+    # it succeeded.
+    start = time.time()
+    retries = TIMEOUT_POLICY["retries"]
+    timeout = step_timeout(step, units) if units is not None else None
+
+    try:
+        max_rss_mb = await runner.run(cmd, cwd=cwd, output_file=output_file, timeout=timeout, retries=retries,
+                                      logger=logger)
+
+    except CalledProcessError as e:
+
+        log_str = LOG_MESSAGES["error"].format(cmd[0], " ".join(cmd), e.returncode)
+
+        if e.output:
+            log_str += LOG_MESSAGES["output"].format(e.output)
+
+        log_output(log_str, level="ERROR", logger=logger, image=image, step=step, units=units,
+                   duration=round(time.time() - start, 2), returncode=e.returncode, output_file=output_file)
+
+        return False
+
+    except CommandTimeout as e:
+
+        log_output(LOG_MESSAGES["timeout"].format(cmd[0], e.message), level="ERROR", logger=logger, image=image,
+                   step=step, units=units, duration=round(time.time() - start, 2), attempts=retries + 1,
+                   output_file=output_file)
+
+        return False
+
+    log_output(LOG_MESSAGES["success"].format(" ".join(cmd), 0), logger=logger, image=image, step=step, units=units,
+               duration=round(time.time() - start, 2), max_rss_mb=round(max_rss_mb, 1), returncode=0,
+               output_file=output_file)
+
+    return True
+
+
+def seven_tesla_wf(in_file, out_dir, logger=None, runner=None):
+
+    runner = runner or default_runner()
+
+    return runner.run_sync(seven_tesla_wf_async(in_file, out_dir, logger=logger, runner=runner))
+
+
+async def seven_tesla_wf_async(in_file, out_dir, logger=None, runner=None):
+
+    runner = runner or default_runner()
 
     if ".nii" in in_file or ".nii.gz" in in_file:
         clean_fname = os.path.basename(in_file).split(".")[0]
@@ -104,139 +213,86 @@ def seven_tesla_wf(in_file, out_dir, logger=None, semaphore=None):
         "{}.nii.gz".format(volreg_fname)
     ]
 
-    mean_fname = "{}_mean".format(volreg_fname)
-
-    mean = [
-        "3dTstat",
-        "-overwrite",
-        "-mean",
-        "-prefix",
-        "{}.nii.gz".format(mean_fname),
-        "{}.nii.gz".format(volreg_fname)
-    ]
-
-    detrend_fname = "{}_detrend".format(volreg_fname)
-
-    detrend = [
-        "3dDetrend",
-        "-overwrite",
-        "-polort",
-        "1",
-        "-prefix",
-        "{}.nii.gz".format(detrend_fname),
-        "{}.nii.gz".format(volreg_fname)
-    ]
-
-    detrend_with_mean_fname = "{}_detrend_with_mean".format(volreg_fname)
-
-    detrend_with_mean = [
-        "3dcalc",
-        "-overwrite",
-        "-a",
-        "{}.nii.gz".format(mean_fname),
-        "-b",
-        "{}.nii.gz".format(detrend_fname),
-        "-expr",
-        "a+b",
-        "-prefix",
-        "{}.nii.gz".format(detrend_with_mean_fname)
-    ]
+    # Each step writes its output into a file of its own, the output of 3dFWHMx is the estimate itself
+    step_log = "{}_{{}}.log".format(os.path.join(cwd, clean_fname))
 
     workflow = [
-        despike,
-        tshift,
-        prereg_fwhm,
-        volreg,
-        postreg_fwhm,
-        epi_mask,
-        mean,
-        detrend,
-        detrend_with_mean
+        ("despike", despike, step_log.format("despike")),
+        ("tshift", tshift, step_log.format("tshift")),
+        ("fwhm", prereg_fwhm, prereg_fname),
+        ("volreg", volreg, step_log.format("volreg")),
+        ("fwhm", postreg_fwhm, postreg_fname),
+        ("automask", epi_mask, step_log.format("automask"))
     ]
 
-    wf_success = True
-
-    for cmd in workflow:
+    # All the steps work on data of the size of the input image
+    units = await runner.in_executor(nifti_units, in_file)
 
-        if not wf_success:
-            break
+    for step, cmd, output_file in workflow:
+        if not await _run_command(runner, cmd, cwd, output_file, image=clean_fname, step=step, units=units,
+                                  logger=logger):
+            return clean_fname, None
 
-        try:
-            result = check_output(cmd, cwd=cwd, stderr=STDOUT, universal_newlines=True)
+    # The image metrics are computed on the runner's CPU threads, the loop keeps running the other images' commands
+    start = time.time()
 
-            # The 3dFWHMx command outputs to stdout, capture this into a file
-            if "3dFWHMx" in cmd:
+    statistics = await runner.in_executor(_func_statistics, cwd, clean_fname, volreg_fname, epi_mask_fname,
+                                          prereg_fname, postreg_fname, oned_matrix)
 
-                outfname = ""
+    log_output("Metrics of {} computed".format(clean_fname), level="DEBUG", logger=logger, image=clean_fname,
+               step="metrics", units=units, duration=round(time.time() - start, 2))
 
-                if "{}.nii.gz".format(tshift_fname) in cmd:
-                    outfname = prereg_fname
-                elif "{}.nii.gz".format(volreg_fname) in cmd:
-                    outfname = postreg_fname
+    return clean_fname, statistics
 
-                if outfname:
-                    with open(outfname, "w") as outfile:
-                        outfile.write(result)
 
-            log_str = LOG_MESSAGES["success"].format(" ".join(cmd), 0)
+def _func_statistics(cwd, clean_fname, volreg_fname, epi_mask_fname, prereg_fname, postreg_fname, oned_matrix):
 
-            if result:
-                log_str += LOG_MESSAGES["output"].format(result)
+    # Compute the TSNR image and the mean TSNR value, along with the other metrics of the registered run (the
+    # run is detrended in memory, in the same pass)
+    tsnr_fname = "{}_TSNR".format(os.path.join(cwd, clean_fname))
+    epi_mask = "{}.nii.gz".format(os.path.join(cwd, epi_mask_fname))
 
-            log_output(log_str, logger=logger, semaphore=semaphore)
+    epi_metrics = calc_epi_metrics(tsnr_fname, "{}.nii.gz".format(volreg_fname), epi_mask)
 
-        except CalledProcessError as e:
+    # Calculate the FWHM of the dataset before and after registration (using linear detrending)
+    prereg_fname = os.path.join(cwd, prereg_fname)
+    postreg_fname = os.path.join(cwd, postreg_fname)
 
-            log_str = LOG_MESSAGES["error"].format(cmd[0], " ".join(cmd), e.returncode)
+    pre_fwhm_x, pre_fwhm_y, pre_fwhm_z, pre_fwhm_combined = parse_fwhm(prereg_fname)
+    post_fwhm_x, post_fwhm_y, post_fwhm_z, post_fwhm_combined = parse_fwhm(postreg_fname)
 
-            if e.output:
-                log_str += LOG_MESSAGES["output"].format(e.output)
+    # Calculate the framewise displacement
+    fd_fname = os.path.join(cwd, "{}_fd.txt".format(clean_fname))
+    fd_res = fd_jenkinson(os.path.join(cwd, oned_matrix), out_file=fd_fname)
 
-            log_output(log_str, logger=logger, semaphore=semaphore)
+    # Parse fd results
+    mean_fd, num_above_cutoff, perc_above_cutoff = extract_fd_results(fd_res, cutoff=0.2)
 
-            wf_success = False
+    # The decoded volumes of this image are not needed by anyone else
+    VOLUMES.release(cwd)
 
-    if wf_success:
+    statistics = OrderedDict({
+        'tsnr_val': epi_metrics['tsnr_val'],
+        'prereg_fwhm_x': pre_fwhm_x,
+        'prereg_fwhm_y': pre_fwhm_y,
+        'prereg_fwhm_z': pre_fwhm_z,
+        'prereg_fwhm_combined': pre_fwhm_combined,
+        'postreg_fwhm_x': post_fwhm_x,
+        'postreg_fwhm_y': post_fwhm_y,
+        'postreg_fwhm_z': post_fwhm_z,
+        'postreg_fwhm_combined': post_fwhm_combined,
+        'mean_fd': mean_fd,
+        'num_fd_above_cutoff': num_above_cutoff,
+        'perc_fd_above_cutoff': perc_above_cutoff,
+        'gs_drift': epi_metrics['gs_drift'],
+        'mean_dvars': epi_metrics['mean_dvars'],
+        'max_dvars': epi_metrics['max_dvars'],
+        'mean_outlier_frac': epi_metrics['mean_outlier_frac'],
+        'max_outlier_frac': epi_metrics['max_outlier_frac'],
+        'gsr': epi_metrics['gsr']
+    })
 
-        # Compute the TSNR image and the mean TSNR value
-        tsnr_fname = "{}_TSNR".format(os.path.join(cwd, clean_fname))
-        tsnr_infile = "{}.nii.gz".format(detrend_with_mean_fname)
-        epi_mask = "{}.nii.gz".format(os.path.join(cwd, epi_mask_fname))
-
-        tsnr_val = calc_tsnr(tsnr_fname, tsnr_infile, epi_mask)
-
-        # Calculate the FWHM of the dataset before and after registration (using linear detrending)
-        prereg_fname = os.path.join(cwd, prereg_fname)
-        postreg_fname = os.path.join(cwd, postreg_fname)
-
-        pre_fwhm_x, pre_fwhm_y, pre_fwhm_z, pre_fwhm_combined = parse_fwhm(prereg_fname)
-        post_fwhm_x, post_fwhm_y, post_fwhm_z, post_fwhm_combined = parse_fwhm(postreg_fname)
-
-        # Calculate the framewise displacement
-        fd_fname = os.path.join(cwd, "{}_fd.txt".format(clean_fname))
-        fd_res = fd_jenkinson(os.path.join(cwd, oned_matrix), out_file=fd_fname)
-
-        # Parse fd results
-        mean_fd, num_above_cutoff, perc_above_cutoff = extract_fd_results(fd_res, cutoff=0.2)
-
-        statistics = OrderedDict({
-            'tsnr_val': tsnr_val,
-            'prereg_fwhm_x': pre_fwhm_x,
-            'prereg_fwhm_y': pre_fwhm_y,
-            'prereg_fwhm_z': pre_fwhm_z,
-            'prereg_fwhm_combined': pre_fwhm_combined,
-            'postreg_fwhm_x': post_fwhm_x,
-            'postreg_fwhm_y': post_fwhm_y,
-            'postreg_fwhm_z': post_fwhm_z,
-            'postreg_fwhm_combined': post_fwhm_combined,
-            'mean_fd': mean_fd,
-            'num_fd_above_cutoff': num_above_cutoff,
-            'perc_fd_above_cutoff': perc_above_cutoff
-        })
-
-        return clean_fname, statistics
-
-    return clean_fname, None
+    return statistics
 
 
 def _register_anat(base_img, img, out_dir):
@@ -264,45 +320,33 @@ def _register_anat(base_img, img, out_dir):
     return volreg
 
 
-def anat_average_wf(session_dir, out_dir, logger=None, semaphore=None):
+def anat_average_wf(session_dir, out_dir, logger=None, runner=None):
 
-    base_img = glob(os.path.join(session_dir, "*run-01_T1w.nii*"))[0]
-    additional_imgs = [img for img in glob(os.path.join(session_dir, "*.nii*")) if "run-01_T1w" not in img]
+    runner = runner or default_runner()
 
-    wf = []
-
-    for img in additional_imgs:
-        wf.append(_register_anat(base_img, img, out_dir))
-
-    wf_success = True
-
-    for cmd in wf:
+    return runner.run_sync(anat_average_wf_async(session_dir, out_dir, logger=logger, runner=runner))
 
-        if not wf_success:
-            break
 
-        try:
-            result = check_output(cmd, cwd=session_dir, stderr=STDOUT, universal_newlines=True)
+async def anat_average_wf_async(session_dir, out_dir, logger=None, runner=None):
 
-            log_str = LOG_MESSAGES["success"].format(" ".join(cmd), 0)
+    runner = runner or default_runner()
 
-            if result:
-                log_str += LOG_MESSAGES["output"].format(result)
-
-            log_output(log_str, logger=logger, semaphore=semaphore)
-
-        except CalledProcessError as e:
-
-            log_str = LOG_MESSAGES["error"].format(cmd[0], " ".join(cmd), e.returncode)
+    base_img = glob(os.path.join(session_dir, "*run-01_T1w.nii*"))[0]
+    additional_imgs = [img for img in glob(os.path.join(session_dir, "*.nii*")) if "run-01_T1w" not in img]
 
-            if e.output:
-                log_str += LOG_MESSAGES["output"].format(e.output)
+    wf = []
 
-            log_output(log_str, logger=logger, semaphore=semaphore)
+    for img in additional_imgs:
+        wf.append((_register_anat(base_img, img, out_dir), await runner.in_executor(nifti_units, img)))
 
-            wf_success = False
+    # The registrations are independent of each other, they run concurrently (within the runner's limit)
+    results = await asyncio.gather(*[_run_command(runner, cmd, session_dir,
+                                                  cmd[cmd.index("-prefix") + 1].replace(".nii.gz", ".log"),
+                                                  image=os.path.basename(cmd[-1]).split(".")[0], step="anat_volreg",
+                                                  units=units, logger=logger)
+                                     for cmd, units in wf])
 
-    if wf_success:
+    if all(results):
 
         alphabet = list(ascii_lowercase)
 
@@ -310,7 +354,8 @@ def anat_average_wf(session_dir, out_dir, logger=None, semaphore=None):
             "3dcalc"
         ]
         used_letters = []
-        volreg_imgs = glob(os.path.join(out_dir, "*_volreg.nii.gz"))
+        # Only the registrations of this session: the sessions share out_dir, and run concurrently
+        volreg_imgs = [cmd[cmd.index("-prefix") + 1] for cmd, _ in wf]
         volreg_imgs.insert(0, base_img)
 
         for img in volreg_imgs:
@@ -337,28 +382,12 @@ def anat_average_wf(session_dir, out_dir, logger=None, semaphore=None):
             "{}_anat_avg.nii.gz".format(os.path.join(out_dir, calc_name))
         ])
 
-        try:
-            result = check_output(calc_cmd, cwd=session_dir, stderr=STDOUT, universal_newlines=True)
-
-            log_str = LOG_MESSAGES["success"].format(" ".join(calc_cmd), 0)
-
-            if result:
-                log_str += LOG_MESSAGES["output"].format(result)
-
-            log_output(log_str, logger=logger, semaphore=semaphore)
-
-        except CalledProcessError as e:
-
-            log_str = LOG_MESSAGES["error"].format(calc_cmd[0], " ".join(calc_cmd), e.returncode)
-
-            if e.output:
-                log_str += LOG_MESSAGES["output"].format(e.output)
-
-            log_output(log_str, logger=logger, semaphore=semaphore)
+        calc_log = "{}_anat_avg.log".format(os.path.join(out_dir, calc_name))
 
-            return False
+        calc_units = await runner.in_executor(nifti_units, base_img)
 
-        return True
+        return await _run_command(runner, calc_cmd, session_dir, calc_log, image=calc_name, step="anat_avg",
+                                  units=calc_units * len(volreg_imgs), logger=logger)
 
     return False
 